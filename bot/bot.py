@@ -1,37 +1,63 @@
 import io
 import sys
+import time
 import psutil
 import datetime
 import asyncio
 import textwrap
 import traceback
 import contextlib
+import concurrent.futures
 import logging
-import aiohttp
+import importlib
 import aioredis
 import asyncpg
 import discord
 from logging.handlers import TimedRotatingFileHandler
 from discord.ext.modules import AutoShardedModularCommandClient
 
+from core import ipc_classes
+from core import async_logging
+from core import queries
+from core import revision
+from core import static
+from bot.commands.util import command_tree
+from bot.commands.util.leases import LeaseTracker
+from bot.commands.util.log_sink import WebhookLogSink
 from core.game_user import UserManager
+from core.latency_stats import CommandStats, LatencyHistogram
+from core.shared_prices import SharedPriceTable
 
 
 if sys.platform == "linux":
     import uvloop
     uvloop.install()
 
+# The code revision this process has imported, reported to the launcher
+CODE_REVISION = revision.get_code_revision()
+
 
 class BotClient(AutoShardedModularCommandClient):
     def __init__(self, **kwargs) -> None:
+        self.startup_started = time.perf_counter()
+        self.startup_phases = {}
         self.pipe = kwargs.pop("pipe")
         self.cluster_name = kwargs.pop("cluster_name")
         config = kwargs.pop("config")
+        farm_guard_duration = kwargs.pop("farm_guard_duration", None)
+        if farm_guard_duration is None:
+            farm_guard_duration = config['bot']['startup-farm-guard-duration']
         self.config = config
-        self._log_webhook = config['bot']['logs-webhook']
         self.maintenance_mode = config['bot']['start-in-maintenance']
         self.is_beta = config['bot']['beta']
         self.ipc_ping = 0
+        self.heartbeat_interval = config['launcher']['heartbeat-interval']
+        self.last_interaction = None
+        self.price_epoch = 0
+        self.shared_prices_sequence = 0
+        self.command_stats = CommandStats()
+        self.db_acquire_wait = LatencyHistogram()
+        self.loop_lag = 0.0
         self.owner_ids = set()
         self.process_info = psutil.Process()
 
@@ -51,22 +77,36 @@ class BotClient(AutoShardedModularCommandClient):
             log.setLevel(logging.DEBUG)
         else:
             log.setLevel(logging.INFO)
-        log_formatter = logging.Formatter("[%(asctime)s %(name)s/%(levelname)s] %(message)s")
         file_handler = TimedRotatingFileHandler(
             f"./logs/cluster-{self.cluster_name}.log",
             encoding="utf-8",
             when="W0",
             interval=2
         )
-        file_handler.setFormatter(log_formatter)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(log_formatter)
-        log.handlers = [file_handler, stream_handler]
+        self.log_handler = async_logging.create_queue_handler(
+            [file_handler, logging.StreamHandler()], config.get("logging")
+        )
+        log.handlers = [self.log_handler]
         self.log = log
+        self.lease_tracker = LeaseTracker(log, config['bot']['lease-capture-stacks'])
+        self.log_sink = WebhookLogSink(
+            config['bot']['logs-webhook'],
+            prefix=f"**[{self.cluster_name}]**",
+            flush_delay=config['bot']['logs-webhook-flush-delay'],
+            max_pending=config['bot']['logs-webhook-max-pending'],
+            log=log
+        )
         self.log.info(f"Shards: {kwargs['shard_ids']}, shard count: {kwargs['shard_count']}")
 
-        loop.run_until_complete(self._connect_postgres())
-        loop.run_until_complete(self._connect_redis())
+        try:
+            self.shared_prices = SharedPriceTable(config['launcher']['shared-prices-path'])
+        except OSError:
+            self.log.warning("Shared market prices not available, using IPC broadcasts")
+            self.shared_prices = None
+
+        with self.startup_phase("connect_databases"):
+            self._create_redis()
+            loop.run_until_complete(asyncio.gather(self._connect_postgres(), self._connect_redis()))
         self.user_cache = UserManager(self.redis, self.db_pool)
 
         super().__init__(
@@ -76,19 +116,31 @@ class BotClient(AutoShardedModularCommandClient):
             loop=loop
         )
 
-        for extension in self.config['bot']['initial-extensions']:
-            try:
-                self.log.debug(f"Loading extension: {extension}")
-                self.load_extension(extension)
-            except Exception:
-                self.log.exception(f"Failed to load extension: {extension}")
-
+        extensions = self.config['bot']['initial-extensions']
         if self.is_beta:
             self.log.warning("Loading the beta debug extension")
-            self.load_extension("bot.commands.beta")
+            extensions = extensions + ["bot.commands.beta"]
+
+        # The cluster with shard zero uploads the application commands,
+        # so it needs every command loaded before connecting
+        if 0 in kwargs['shard_ids']:
+            self.lazy_extensions = []
+        else:
+            lazy = self.config['bot'].get("lazy-extensions", [])
+            self.lazy_extensions = [x for x in extensions if x in lazy]
+            extensions = [x for x in extensions if x not in lazy]
+
+        with self.startup_phase("import_extensions"):
+            self._import_extensions(extensions)
+        self._load_extensions(extensions)
 
-        self.enable_field_guard(config['bot']['startup-farm-guard-duration'])
-        self.run()
+        self.enable_field_guard(farm_guard_duration)
+        self.startup_connect_started = time.perf_counter()
+        try:
+            self.run()
+        finally:
+            # Cluster processes exit without running the exit handlers
+            async_logging.stop_queue_handler(self.log_handler)
 
     @property
     def uptime(self) -> datetime.datetime:
@@ -99,25 +151,146 @@ class BotClient(AutoShardedModularCommandClient):
         return self.guard_mode > datetime.datetime.now()
 
     async def setup(self):
+        self.log_sink.start(self.loop)
+        self.loop.create_task(self._heartbeat_task())
+
         # Upload commands only once (if this client has shard zero)
         if 0 in self.shard_ids:
-            await self.upload_global_application_commands()
-            await self.upload_guild_application_commands()
+            with self.startup_phase("upload_commands"):
+                await self.sync_application_commands()
+
+    async def sync_application_commands(self) -> None:
+        """Uploads the application commands of each scope, only if they have changed"""
+        tree = command_tree.serialize_command_tree(self.command_collections.values())
+        force = self.config['bot'].get("force-command-upload", False)
+
+        try:
+            stored = await command_tree.get_stored_commands(self.redis)
+        except Exception:
+            self.log.exception("Failed to fetch the stored command tree, uploading")
+            stored = {}
+
+        uploads = {
+            "global": self.upload_global_application_commands,
+            "guild": self.upload_guild_application_commands
+        }
+        for scope, upload in uploads.items():
+            commands = tree[scope]
+            digest, _ = stored.get(scope, (None, None))
+
+            if not force and digest == command_tree.hash_commands(commands):
+                self.log.info(f"The {scope} application commands are up to date")
+                continue
+
+            self.log.info(f"Uploading the {scope} application commands")
+            await upload()
+            await command_tree.store_commands(self.redis, scope, commands)
+
+    @contextlib.contextmanager
+    def startup_phase(self, name: str):
+        """Records how long a startup phase took for the startup report"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_phases[name] = time.perf_counter() - start
+
+    def _import_extensions(self, extensions: list) -> None:
+        """
+        Imports the extension modules from a thread pool, so that the imports waiting
+        on disk overlap. Loading the extensions afterwards only sets up the collections.
+        """
+        def import_extension(name: str) -> None:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                # Reported when the extension is actually loaded
+                pass
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(extensions) or 1) as executor:
+            list(executor.map(import_extension, extensions))
+
+    def _load_extensions(self, extensions: list) -> None:
+        for extension in extensions:
+            with self.startup_phase(f"load:{extension}"):
+                try:
+                    self.log.debug(f"Loading extension: {extension}")
+                    self.load_extension(extension)
+                except Exception:
+                    self.log.exception(f"Failed to load extension: {extension}")
+
+    async def _finish_startup(self) -> None:
+        """Loads the lazy extensions and reports where the startup time went"""
+        self.startup_phases['connect_gateway'] = time.perf_counter() - self.startup_connect_started
+
+        if self.lazy_extensions:
+            with self.startup_phase("lazy_extensions"):
+                self._load_extensions(self.lazy_extensions)
+
+        report = ipc_classes.StartupReport(
+            cluster_name=self.cluster_name,
+            phases=self.startup_phases,
+            lazy_extensions=self.lazy_extensions,
+            total=time.perf_counter() - self.startup_started
+        )
+        phases = " ".join(f"{name}={duration:.3f}s" for name, duration in report.phases.items())
+        self.log.info(f"Startup report: total={report.total:.3f}s {phases}")
+
+        try:
+            collection = self.get_command_collection("Clusters")
+        except KeyError:
+            return
+
+        try:
+            await collection.send_startup_report_message(report)
+        except Exception:
+            self.log.exception("Failed to send the startup report")
+
+    async def _get_pool_max_size(self) -> int:
+        """This cluster's share of the Postgres connection budget of all clusters"""
+        postgres = self.config['postgres']
+        planned = await self.redis.execute_command("HGETALL", static.DB_POOL_CLUSTERS_KEY)
+        cluster_count = sum(int(x) for x in planned.values()) or 1
+
+        share = postgres['connection-budget'] // cluster_count
+        if share < 1:
+            raise RuntimeError(
+                f"Postgres connection budget {postgres['connection-budget']} is too small "
+                f"for {cluster_count} clusters"
+            )
+        if share < postgres['pool-min-size']:
+            self.log.warning(
+                f"Postgres pool share {share} of {cluster_count} clusters is below the "
+                f"pool-min-size {postgres['pool-min-size']}, raise the connection-budget"
+            )
+
+        return min(postgres['pool-max-size'], share)
 
     async def _connect_postgres(self) -> None:
+        postgres = self.config['postgres']
         connect_args = {
-            "user": self.config['postgres']['user'],
-            "password": self.config['postgres']['password'],
-            "database": self.config['postgres']['database'],
-            "host": self.config['postgres']['host']
+            "user": postgres['user'],
+            "password": postgres['password'],
+            "database": postgres['database'],
+            "host": postgres['host']
         }
+        if postgres['pgbouncer']:
+            # Transaction pooling can't keep prepared statements between transactions
+            connect_args['statement_cache_size'] = 0
+        else:
+            # Prepare the hot statements once, when a connection is opened
+            connect_args['init'] = queries.prepare_statements
+
+        max_size = await self._get_pool_max_size()
+        self.log.info(f"Postgres pool size: {max_size}")
 
         self.db_pool = await asyncpg.create_pool(
             **connect_args,
-            min_size=10,
-            max_size=15,
+            connection_class=queries.FarmConnection,
+            min_size=min(postgres['pool-min-size'], max_size),
+            max_size=max_size,
             command_timeout=60.0,
-            max_inactive_connection_lifetime=30.0
+            max_inactive_connection_lifetime=postgres['max-inactive-connection-lifetime']
         )
 
         # Check if Postgres is connected
@@ -128,7 +301,8 @@ class BotClient(AutoShardedModularCommandClient):
             self.log.exception("Failed to connect to Postgres")
             raise ex
 
-    async def _connect_redis(self) -> None:
+    def _create_redis(self) -> None:
+        # Connections are made on the first use
         pool = aioredis.ConnectionPool.from_url(
             self.config['redis']['host'],
             password=self.config['redis']['password'],
@@ -136,6 +310,7 @@ class BotClient(AutoShardedModularCommandClient):
         )
         self.redis = aioredis.Redis(connection_pool=pool)
 
+    async def _connect_redis(self) -> None:
         # Check if the Redis is connected
         try:
             await self.redis.time()
@@ -170,6 +345,29 @@ class BotClient(AutoShardedModularCommandClient):
 
         return None
 
+    def read_shared_prices(self, item_pool) -> bool:
+        """Applies the host's shared market prices to the item pool, if they have changed"""
+        if self.shared_prices is None:
+            return False
+
+        sequence = self.shared_prices.sequence
+        if sequence == 0:
+            return False  # Nothing published yet
+        if sequence == self.shared_prices_sequence:
+            return True
+
+        result = self.shared_prices.read()
+        if result is None:
+            return False
+
+        sequence, epoch, prices = result
+        if not item_pool.set_market_prices(prices):
+            return False
+
+        self.shared_prices_sequence = sequence
+        self.price_epoch = epoch
+        return True
+
     def cleanup_code(self, content: str) -> str:
         if content.startswith("```") and content.endswith("```"):
             return "\n".join(content.split("\n")[1:-1])
@@ -209,15 +407,31 @@ class BotClient(AutoShardedModularCommandClient):
         self.log.info(f"Enabled field guard until: {self.guard_mode}")
         return self.guard_mode
 
-    async def log_to_discord(self, content: str, embed: discord.Embed = None) -> None:
-        async with aiohttp.ClientSession() as session:
-            webhook = discord.Webhook.from_url(self._log_webhook, session=session)
+    def request_rolling_restart(self) -> None:
+        """Asks the launcher to restart all clusters one identify bucket batch at a time"""
+        self.pipe.send("rolling_restart")
 
-            await webhook.send(
-                f"**[{self.cluster_name}]** " + content,
-                embed=embed,
-                username=self.user.name
+    async def log_to_discord(self, content: str, embed: discord.Embed = None) -> None:
+        """Queues a message for the log webhook, those are sent in batches"""
+        self.log_sink.send(content, embed=embed)
+
+    async def _heartbeat_task(self) -> None:
+        """Reports the event loop lag and the last interaction time to the launcher"""
+        while not self.is_closed():
+            start = self.loop.time()
+            await asyncio.sleep(self.heartbeat_interval)
+
+            self.loop_lag = self.loop.time() - start - self.heartbeat_interval
+            heartbeat = ipc_classes.ClusterHeartbeat(
+                loop_lag=self.loop_lag,
+                last_interaction=self.last_interaction,
+                sent_at=time.time()
             )
+            try:
+                self.pipe.send(heartbeat)
+            except OSError:
+                self.log.warning("Launcher pipe closed, stopping heartbeats")
+                return
 
     async def on_shard_ready(self, shard_id: int) -> None:
         self.log.info(f"Shard {shard_id} ready")
@@ -226,13 +440,17 @@ class BotClient(AutoShardedModularCommandClient):
         self.log.info("Cluster ready called")
 
         try:
+            # Sent before the ready message, so the launcher has it once the start completes
+            self.pipe.send(("revision", CODE_REVISION))
             self.pipe.send(1)
-            self.pipe.close()
         except OSError:
             pass
 
+        self.log_sink.username = self.user.name
+
         if not hasattr(self, "launch_time"):
             self.launch_time = datetime.datetime.now()
+            await self._finish_startup()
 
         await self.log_to_discord(
             f"\N{LARGE GREEN CIRCLE} Ready! Maintenance mode: `{self.maintenance_mode}` "
@@ -240,6 +458,8 @@ class BotClient(AutoShardedModularCommandClient):
         )
 
     async def on_interaction(self, interaction: discord.Interaction):
+        self.last_interaction = time.time()
+
         if interaction.type == discord.InteractionType.application_command \
                 and interaction.guild_id is None:
             await interaction.response.send_message(
@@ -274,6 +494,7 @@ class BotClient(AutoShardedModularCommandClient):
         async with self.db_pool.acquire() as conn:
             query = "DELETE FROM store WHERE guild_id = $1;"
             await conn.execute(query, guild.id)
+        await self.redis.execute_command("HINCRBY", static.TRADES_CACHE_VERSION_KEY, guild.id, 1)
 
         await self.log_to_discord(
             f"\N{OUTBOX TRAY} Left guild: {guild.name} "
@@ -287,8 +508,10 @@ class BotClient(AutoShardedModularCommandClient):
         await self.log_to_discord("Shutting down")
 
         await super().close()
+        await self.log_sink.close()
         await self.db_pool.close()
         await self.redis.connection_pool.disconnect()
+        self.pipe.close()
 
     def run(self) -> None:
         super().run(self.config['bot']['discord-token'], reconnect=True)
@@ -4,6 +4,7 @@ import discord
 
 from core import static
 from .util import exceptions
+from .util import command_tree
 from .util.commands import FarmSlashCommand, FarmCommandCollection
 
 
@@ -115,5 +116,64 @@ class RunRedisCommand(
             await self.reply(f"```py\n{results}\n```")
 
 
+class RunLeasesCommand(
+    RunCommand,
+    name="leases",
+    description="\N{WRENCH} [Developer only] Lists the database connections held on this cluster",
+    parent=RunCommand
+):
+
+    async def callback(self):
+        tracker = self.client.lease_tracker
+        fmt = (
+            f"Live leases: {tracker.count}, pool size: {self.client.db_pool.get_size()}, "
+            f"force released: {tracker.force_released}, "
+            f"held across prompts: {tracker.held_across_prompts}\n\n"
+        )
+
+        for lease in tracker.oldest():
+            fmt += f"/{lease.command} by {lease.owner_id} for {lease.held_for:.1f}s\n"
+            fmt += lease.format_stack() + "\n"
+
+        if len(fmt) > 1994:  # 2000 - 6 for code block
+            fp = io.BytesIO(fmt.encode("utf-8"))
+            await self.reply("Output too long...", file=discord.File(fp, "data.txt"))
+        else:
+            await self.reply(f"```{fmt}```")
+
+
+class RunCommandsDiffCommand(
+    RunCommand,
+    name="commands_diff",
+    description="\N{WRENCH} [Developer only] Shows what the next command upload would change",
+    parent=RunCommand
+):
+    """
+    Dry run of the application command upload. Compares the commands loaded on this cluster
+    to the ones stored after the last upload, without calling Discord.
+    """
+
+    async def callback(self):
+        tree = command_tree.serialize_command_tree(self.client.command_collections.values())
+        stored = await command_tree.get_stored_commands(self.redis)
+
+        fmt = ""
+        for scope in command_tree.SCOPES:
+            digest, commands = stored[scope]
+            lines = command_tree.diff_commands(commands, tree[scope])
+
+            if digest is None:
+                fmt += f"{scope}: never uploaded\n"
+            elif not lines:
+                fmt += f"{scope}: up to date\n"
+            fmt += "".join(f"{line}\n" for line in lines)
+
+        if len(fmt) > 1994:  # 2000 - 6 for code block
+            fp = io.BytesIO(fmt.encode("utf-8"))
+            await self.reply("Output too long...", file=discord.File(fp, "data.txt"))
+        else:
+            await self.reply(f"```{fmt}```")
+
+
 def setup(client) -> list:
     return [AdminCollection(client)]
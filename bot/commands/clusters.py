@@ -1,4 +1,6 @@
 import io
+import time
+import uuid
 import asyncio
 import datetime
 import discord
@@ -6,22 +8,59 @@ import jsonpickle
 from typing import Optional
 
 from core import ipc_classes
+from core import item_catalog
+from core import queries
 from core import static
+from core.cluster_registry import ClusterRegistry
+from core.ipc_transport import create_transport
 from .util import exceptions
 from .util import time as time_util
 from .util.commands import FarmSlashCommand, FarmCommandCollection
 
 
+class PendingIPCRequest:
+    """
+    Collects the replies for a single correlated IPC request.
+    If expected authors are not provided, the first reply completes the request.
+    """
+
+    __slots__ = ("action", "expected", "responses", "future")
+
+    def __init__(self, loop, action: str, expected: set = None) -> None:
+        self.action = action
+        self.expected = expected
+        self.responses = {}
+        self.future = loop.create_future()
+
+    @property
+    def missing(self) -> set:
+        if self.expected is None:
+            return set() if self.responses else {"IPC"}
+
+        return self.expected - self.responses.keys()
+
+    def add_response(self, author: str, data) -> None:
+        self.responses[author] = data
+
+        if not self.future.done() and not self.missing:
+            self.future.set_result(self.responses)
+
+
 class ClustersCollection(FarmCommandCollection):
     """Developer only commands for bot management purposes."""
     hidden_in_help_command = True
 
     def __init__(self, client) -> None:
         super().__init__(client, [ClustersCommand], name="Clusters")
-        self.redis_pubsub = client.redis.pubsub()
         self.global_channel = "global"
-        self.self_name = "cluster-" + client.cluster_name
+        self.cluster_channel_prefix = "cluster-"
+        self.self_name = self.cluster_channel_prefix + client.cluster_name
+        self.transport = create_transport(client.redis, self.self_name, client.config['ipc'])
         self.cluster_update_delay = client.config['ipc']['cluster-update-delay']
+        self.request_timeout = client.config['ipc']['request-timeout']
+        self.cluster_registry = ClusterRegistry(
+            client.redis, client.config['ipc']['cluster-inactive-timeout']
+        )
         self.last_ping = None
         # We will execute these too (don't ignore as self author)
         self.self_execute_actions = (
@@ -31,11 +70,9 @@ class ClustersCollection(FarmCommandCollection):
             "result",
             "shutdown"
         )
-        self.responses = {}
-        self.response_lock = asyncio.Lock()
+        self.pending_requests = {}
 
-        self.client.loop.create_task(self._register_tasks_and_channels())
-        self.client.loop.create_task(self._request_all_required_data())
+        self.client.loop.run_until_complete(self._register_tasks_and_channels())
         # Block the bot from firing ready until
         # ensuring that we have the mandatory data
         self.client.loop.run_until_complete(self._ensure_all_required_data())
@@ -49,12 +86,10 @@ class ClustersCollection(FarmCommandCollection):
         self.client.loop.create_task(self._unregister_tasks_and_channels())
 
     async def _register_redis_channels(self) -> None:
-        await self.redis_pubsub.subscribe(self.global_channel)
-        await self.redis_pubsub.subscribe(self.self_name)
+        await self.transport.subscribe([self.global_channel, self.self_name])
 
     async def _unregister_redis_channels(self) -> None:
-        await self.redis_pubsub.unsubscribe(self.global_channel)
-        await self.redis_pubsub.unsubscribe(self.self_name)
+        await self.transport.unsubscribe()
 
     async def _register_tasks_and_channels(self) -> None:
         await self._register_redis_channels()
@@ -64,16 +99,14 @@ class ClustersCollection(FarmCommandCollection):
     async def _unregister_tasks_and_channels(self) -> None:
         self._handler_task.cancel()
         self._ping_task.cancel()
+        await self.cluster_registry.remove(self.client.cluster_name)
         await self._unregister_redis_channels()
-        await self.redis_pubsub.close()
+        await self.transport.close()
 
     async def _redis_event_handler(self) -> None:
-        async for message in self.redis_pubsub.listen():
-            if message['type'] != "message":
-                continue
-
+        async for data in self.transport.listen():
             try:
-                ipc_message = jsonpickle.decode(message['data'])
+                ipc_message = jsonpickle.decode(data)
             except TypeError:
                 continue
 
@@ -91,6 +124,8 @@ class ClustersCollection(FarmCommandCollection):
                 self._handle_update_cluster_data(ipc_message)
             elif ipc_message.action == "get_items":
                 self._handle_update_items(ipc_message)
+            elif ipc_message.action == "get_prices":
+                await self._handle_update_prices(ipc_message)
             elif ipc_message.action == "get_game_news":
                 self._handle_update_game_news(ipc_message)
             elif ipc_message.action == "maintenance":
@@ -98,49 +133,80 @@ class ClustersCollection(FarmCommandCollection):
             elif ipc_message.action == "enable_guard":
                 await self._handle_farm_guard(ipc_message)
             elif ipc_message.action == "eval":
-                await self._handle_eval_command(ipc_message)
-            elif ipc_message.action == "result":
-                self.responses[ipc_message.author] = ipc_message.data
+                # The evaluated code might wait for IPC replies, that this loop has to handle
+                self.client.loop.create_task(self._handle_eval_command(ipc_message))
+            elif ipc_message.action == "result" or ipc_message.action == "get_command_stats":
+                pass  # Handled as a reply below
             elif ipc_message.action == "shutdown":
                 self._handle_shutdown()
             else:
-                self.log.error(f"Unknown action: {ipc_message.action}")
+                self.client.log.error(f"Unknown action: {ipc_message.action}")
+
+            self._resolve_pending_request(ipc_message)
+
+    def _resolve_pending_request(self, message: ipc_classes.IPCMessage) -> None:
+        if message.correlation_id is None:
+            return
+
+        try:
+            request = self.pending_requests[message.correlation_id]
+        except KeyError:
+            return  # Not our request or a late reply
+
+        request.add_response(message.author, message.data)
 
     async def _request_all_required_data(self) -> None:
+        requests = []
         if not hasattr(self.client, "item_pool"):
-            await self.send_get_items_message()
-        if not hasattr(self.client, "cluster_data"):
-            await self.send_ping_message()
+            requests.append(self._request_item_pool())
+        if not hasattr(self.client, "cluster_totals"):
+            requests.append(self.send_ping_message())
         if not hasattr(self.client, "game_news"):
-            await self.send_get_game_news_message()
+            requests.append(self.send_get_game_news_message())
+
+        await asyncio.gather(*requests)
+
+    async def _request_item_pool(self) -> None:
+        # The catalog is loaded from the item data on disk when this process starts,
+        # so then we only need the current prices instead of the whole pool
+        if self.client.read_shared_prices(item_catalog.item_pool):
+            self.client.item_pool = item_catalog.item_pool
+            return
+
+        request = await self.send_get_item_prices_message()
+        if request.missing:
+            return
+
+        market_prices = request.responses["IPC"]
+        if item_catalog.item_pool.set_market_prices(market_prices.prices):
+            self.client.item_pool = item_catalog.item_pool
+            self.client.price_epoch = market_prices.epoch
+            return
+
+        self.client.log.warning("Local item catalog does not match IPC, requesting all items")
+        await self.send_get_items_message()
 
     async def _ensure_all_required_data(self) -> None:
         retry_in = 0
-        # Well, we can't get the responses instantly
-        await asyncio.sleep(0.1)
 
         while not self.client.is_closed():
-            missing = False
-            if not hasattr(self.client, "item_pool"):
-                missing = True
-            if not hasattr(self.client, "cluster_data"):
-                missing = True
-            if not hasattr(self.client, "game_news"):
-                missing = True
+            await self._request_all_required_data()
 
+            missing = [
+                x for x in ("item_pool", "cluster_totals", "game_news")
+                if not hasattr(self.client, x)
+            ]
             if not missing:
                 return
 
             self.client.log.critical(
-                f"Missing required data from IPC. Retrying in: {retry_in} seconds"
+                f"Missing required data from IPC: {missing}. Retrying in: {retry_in} seconds"
             )
 
             await asyncio.sleep(retry_in)
             if retry_in < 60:
                 retry_in += 3
 
-            await self._request_all_required_data()
-
     async def _cluster_ping_task(self) -> None:
         await self.client.wait_until_ready()
 
@@ -151,26 +217,48 @@ class ClustersCollection(FarmCommandCollection):
     def _handle_update_items(self, message: ipc_classes.IPCMessage) -> None:
         self.client.item_pool = message.data
 
+    async def _handle_update_prices(self, message: ipc_classes.IPCMessage) -> None:
+        if not hasattr(self.client, "item_pool") or self.client.shared_prices is not None:
+            # Bootstrapping or the launcher updates the host's shared prices for us
+            return
+
+        if self.client.item_pool.set_market_prices(message.data.prices):
+            self.client.price_epoch = message.data.epoch
+        else:
+            self.client.log.warning("Local item catalog does not match IPC, requesting all items")
+            # Not awaited as a request, because its reply is handled by this same loop
+            await self.send_ipc_message("get_items", False)
+
     async def _handle_maintenance(self, message: ipc_classes.IPCMessage) -> None:
         self.client.maintenance_mode = message.data
-        await self.send_results(f"\N{WHITE HEAVY CHECK MARK} {self.client.maintenance_mode}")
+        await self.send_results(
+            f"\N{WHITE HEAVY CHECK MARK} {self.client.maintenance_mode}", message.correlation_id
+        )
 
     async def _handle_farm_guard(self, message: ipc_classes.IPCMessage) -> None:
         self.client.enable_field_guard(message.data)
-        await self.send_results(self.client.guard_mode)
+        await self.send_results(self.client.guard_mode, message.correlation_id)
 
     def _handle_update_cluster_data(self, message: ipc_classes.IPCMessage) -> None:
-        self.client.cluster_data = message.data
+        self.client.cluster_totals = message.data
 
         time_delta = datetime.datetime.now() - self.last_ping
         self.client.ipc_ping = time_delta.total_seconds() * 1000  # ms
 
+    async def active_cluster_channels(self) -> set:
+        """Channel names of the clusters that are expected to reply to a global request"""
+        clusters = await self.cluster_registry.get_all()
+        channels = {self.cluster_channel_prefix + x.name for x in clusters}
+        # We might not be in the data yet, but we execute our own requests too
+        channels.add(self.self_name)
+        return channels
+
     def _handle_update_game_news(self, message: ipc_classes.IPCMessage) -> None:
         self.client.game_news = message.data
 
     async def _handle_eval_command(self, message: ipc_classes.IPCMessage) -> None:
         result = await self.client.eval_code(message.data)
-        await self.send_results(result)
+        await self.send_results(result, message.correlation_id)
 
     def _handle_shutdown(self) -> None:
         self.client.loop.create_task(self.client.close())
@@ -180,18 +268,55 @@ class ClustersCollection(FarmCommandCollection):
         action: str,
         reply_global: bool,
         data=None,
-        global_channel: bool = False
+        global_channel: bool = False,
+        correlation_id: str = None
     ) -> None:
         message = ipc_classes.IPCMessage(
             author=self.self_name,
             action=action,
             reply_global=reply_global,
-            data=data
+            data=data,
+            correlation_id=correlation_id
         )
         channel = self.self_name if not global_channel else self.global_channel
-        await self.client.redis.publish(channel, jsonpickle.encode(message))
+        await self.transport.publish(
+            channel, jsonpickle.encode(message), durable=action in ipc_classes.DURABLE_ACTIONS
+        )
+
+    async def send_ipc_request(
+        self,
+        action: str,
+        reply_global: bool,
+        data=None,
+        global_channel: bool = False,
+        expected: set = None,
+        timeout: float = None
+    ) -> PendingIPCRequest:
+        """
+        Sends a message with a new correlation ID and waits until all of the expected
+        authors have replied or the request has timed out.
+        If expected authors are not provided, waits for the first reply only.
+        """
+        correlation_id = uuid.uuid4().hex
+        request = PendingIPCRequest(self.client.loop, action, expected)
+        self.pending_requests[correlation_id] = request
+
+        try:
+            await self.send_ipc_message(
+                action, reply_global, data, global_channel, correlation_id
+            )
+            await asyncio.wait_for(request.future, timeout or self.request_timeout)
+        except asyncio.TimeoutError:
+            self.client.log.warning(
+                f"IPC request \"{action}\" ({correlation_id}) timed out. "
+                f"Missing replies from: {request.missing}"
+            )
+        finally:
+            del self.pending_requests[correlation_id]
+
+        return request
 
-    async def send_ping_message(self) -> None:
+    async def send_ping_message(self) -> PendingIPCRequest:
         self.last_ping = datetime.datetime.now()
 
         if hasattr(self.client, "launch_time"):
@@ -208,7 +333,27 @@ class ClustersCollection(FarmCommandCollection):
             uptime=uptime
         )
 
-        await self.send_ipc_message("ping", False, cluster)
+        start = time.perf_counter()
+        await self.cluster_registry.update(cluster)
+        redis_latency = time.perf_counter() - start
+
+        metrics = ipc_classes.ClusterMetrics(
+            loop_lag=self.client.loop_lag,
+            db_pool_size=self.client.db_pool.get_size(),
+            db_pool_max_size=self.client.db_pool.get_max_size(),
+            db_pool_idle=self.client.db_pool.get_idle_size(),
+            db_acquire_wait=self.client.db_acquire_wait,
+            db_leases=self.client.lease_tracker.count,
+            db_leases_force_released=self.client.lease_tracker.force_released,
+            redis_latency=redis_latency,
+            statement_stats=queries.statement_stats,
+            command_stats=self.client.command_stats
+        )
+        # IPC replies only with the totals of all clusters
+        return await self.send_ipc_request("ping", False, metrics)
+
+    async def send_get_command_stats_message(self) -> PendingIPCRequest:
+        return await self.send_ipc_request("get_command_stats", False)
 
     async def send_set_reminder_message(self, reminder: ipc_classes.Reminder) -> None:
         await self.send_ipc_message("add_reminder", False, reminder)
@@ -222,41 +367,56 @@ class ClustersCollection(FarmCommandCollection):
     async def send_delete_reminders_message(self, user_id: int) -> None:
         await self.send_ipc_message("del_reminders", False, user_id)
 
-    async def send_get_items_message(self) -> None:
-        await self.send_ipc_message("get_items", False, None)
+    async def send_get_items_message(self) -> PendingIPCRequest:
+        return await self.send_ipc_request("get_items", False)
+
+    async def send_get_item_prices_message(self) -> PendingIPCRequest:
+        return await self.send_ipc_request("get_prices", False)
 
-    async def send_set_items_message(self) -> None:
-        await self.send_ipc_message("set_items", True, None)
+    async def send_set_items_message(self) -> PendingIPCRequest:
+        return await self.send_ipc_request("set_items", True)
 
-    async def send_get_game_news_message(self) -> None:
-        await self.send_ipc_message("get_game_news", False, None)
+    async def send_get_game_news_message(self) -> PendingIPCRequest:
+        return await self.send_ipc_request("get_game_news", False)
 
-    async def send_set_game_news_message(self, game_news: str) -> None:
-        await self.send_ipc_message("set_game_news", True, game_news)
+    async def send_set_game_news_message(self, game_news: str) -> PendingIPCRequest:
+        return await self.send_ipc_request("set_game_news", True, game_news)
 
-    async def send_set_farm_guard_message(self, duration: int) -> None:
-        await self.send_ipc_message("enable_guard", True, duration, global_channel=True)
+    async def send_set_farm_guard_message(self, duration: int) -> PendingIPCRequest:
+        return await self.send_ipc_request(
+            "enable_guard", True, duration, global_channel=True,
+            expected=await self.active_cluster_channels()
+        )
+
+    async def send_set_maintenance_message(self, enabled: bool) -> PendingIPCRequest:
+        return await self.send_ipc_request(
+            "maintenance", True, enabled, global_channel=True,
+            expected=await self.active_cluster_channels()
+        )
 
-    async def send_set_maintenance_message(self, enabled: bool) -> None:
-        await self.send_ipc_message("maintenance", True, enabled, global_channel=True)
+    async def send_eval_message(self, eval_code: str) -> PendingIPCRequest:
+        return await self.send_ipc_request(
+            "eval", True, eval_code, global_channel=True,
+            expected=await self.active_cluster_channels()
+        )
 
-    async def send_eval_message(self, eval_code: str) -> None:
-        await self.send_ipc_message("eval", True, eval_code, global_channel=True)
+    async def send_results(self, result: str, correlation_id: str = None) -> None:
+        await self.send_ipc_message(
+            "result", True, result, global_channel=True, correlation_id=correlation_id
+        )
 
-    async def send_results(self, result: str) -> None:
-        await self.send_ipc_message("result", True, result, global_channel=True)
+    async def send_startup_report_message(self, report: ipc_classes.StartupReport) -> None:
+        await self.send_ipc_message("startup_report", False, report)
 
     async def send_shutdown_message(self) -> None:
         await self.send_ipc_message("shutdown", True, None, global_channel=True)
 
-    async def wait_and_publish_responses(self, cmd) -> None:
-        # Wait for responses
-        await cmd.defer()
-        await asyncio.sleep(3)
-
+    async def publish_responses(self, cmd, request: PendingIPCRequest) -> None:
         fmt = ""
-        for cluster_name, result in self.responses.items():
+        for cluster_name, result in request.responses.items():
             fmt += f"{cluster_name}: {result}\n"
+        for cluster_name in request.missing:
+            fmt += f"{cluster_name}: No response\n"
 
         if len(fmt) > 1994:  # 2000 - 6 for code block
             fp = io.BytesIO(fmt.encode("utf-8"))
@@ -290,10 +450,9 @@ class ClustersEvalCommand(
 
     async def callback(self) -> None:
         clusters_collection = get_cluster_collection(self.client)
-        async with clusters_collection.response_lock:
-            clusters_collection.responses = {}
-            await clusters_collection.send_eval_message(self.body)
-            await clusters_collection.wait_and_publish_responses(self)
+        await self.defer()
+        request = await clusters_collection.send_eval_message(self.body)
+        await clusters_collection.publish_responses(self, request)
 
 
 class ClustersStatusCommand(
@@ -307,7 +466,7 @@ class ClustersStatusCommand(
         embed = discord.Embed()
         embed.set_footer(text=f"Local IPC ping: {'%.0f' % self.client.ipc_ping}ms")
 
-        for cluster in self.client.cluster_data:
+        for cluster in await get_cluster_collection(self.client).cluster_registry.get_all():
             fmt = ""
             for id, ping in cluster.latencies:
                 fmt += f"> **#{id} - {'%.0f' % (ping * 1000)}ms**\n"
@@ -318,6 +477,55 @@ class ClustersStatusCommand(
         await self.reply(embed=embed)
 
 
+class ClustersLatencyCommand(
+    ClustersCommand,
+    name="latency",
+    description="\N{SATELLITE} [Developer only] Shows the command latencies of all clusters",
+    parent=ClustersCommand
+):
+    """
+    Without a command, lists the slowest commands by their callback duration.
+    With a command, lists all of its measured stages.
+    """
+    command: Optional[str] = discord.app.Option(
+        description="Full name of the command to show all stages for",
+        default=None
+    )
+
+    @staticmethod
+    def _format_row(name: str, histogram) -> str:
+        p50, p95, p99 = (histogram.percentile(x) * 1000 for x in (50, 95, 99))
+        return (
+            f"{name[:24]:<24} {histogram.count:>7} {p50:>7.0f} {p95:>7.0f} "
+            f"{p99:>7.0f} {histogram.errors:>6}\n"
+        )
+
+    async def callback(self) -> None:
+        await self.defer()
+        request = await get_cluster_collection(self.client).send_get_command_stats_message()
+        if request.missing:
+            return await self.edit(content="\N{CROSS MARK} IPC did not reply")
+
+        stats = request.responses["IPC"]
+        fmt = f"{'name':<24} {'count':>7} {'p50ms':>7} {'p95ms':>7} {'p99ms':>7} {'errors':>6}\n"
+
+        if self.command:
+            stages = stats.commands.get(self.command.lower())
+            if not stages:
+                return await self.edit(content="\N{CROSS MARK} No data for this command yet")
+
+            for stage, histogram in sorted(stages.items()):
+                fmt += self._format_row(stage, histogram)
+        else:
+            callbacks = [(x, y['callback']) for x, y in stats.commands.items() if 'callback' in y]
+            callbacks.sort(key=lambda x: x[1].percentile(95), reverse=True)
+
+            for name, histogram in callbacks[:25]:
+                fmt += self._format_row(name, histogram)
+
+        await self.edit(content=f"```{fmt}```")
+
+
 class ClustersLogoutCommand(
     ClustersCommand,
     name="logout",
@@ -338,6 +546,63 @@ class ClustersLogoutCommand(
             await get_cluster_collection(self.client).send_shutdown_message()
 
 
+class ClustersRollingRestartCommand(
+    ClustersCommand,
+    name="rolling_restart",
+    parent=ClustersCommand
+):
+    pass
+
+
+class ClustersRollingRestartStartCommand(
+    ClustersRollingRestartCommand,
+    name="start",
+    description="\N{SATELLITE} [Developer only] Restarts all clusters without a full downtime",
+    parent=ClustersRollingRestartCommand
+):
+
+    async def callback(self) -> None:
+        try:
+            self.client.request_rolling_restart()
+        except OSError:
+            return await self.reply("\N{CROSS MARK} This cluster can't reach the launcher")
+
+        await self.reply(
+            "\N{WHITE HEAVY CHECK MARK} Requested a rolling restart from the launcher. "
+            "Use **/clusters rolling_restart status** to follow the progress."
+        )
+
+
+class ClustersRollingRestartStatusCommand(
+    ClustersRollingRestartCommand,
+    name="status",
+    description="\N{SATELLITE} [Developer only] Shows the progress of the last rolling restart",
+    parent=ClustersRollingRestartCommand
+):
+
+    async def callback(self) -> None:
+        status = await self.redis.execute_command("GET", static.ROLLING_RESTART_STATUS_KEY)
+        if not status:
+            return await self.reply("\N{CROSS MARK} No rolling restarts in the last day")
+
+        status = jsonpickle.decode(status)
+        done = len(status.restarted) + len(status.failed)
+
+        embed = discord.Embed(title="Rolling restart")
+        embed.add_field(name="Progress", value=f"{done}/{status.total} clusters")
+        embed.add_field(name="Restarting now", value=", ".join(status.current) or "-")
+        embed.add_field(name="Failed", value=", ".join(status.failed) or "-")
+
+        if status.finished:
+            duration = (status.finished - status.started).total_seconds()
+            embed.set_footer(text=f"Finished in {time_util.seconds_to_time(duration)}")
+        else:
+            duration = (datetime.datetime.now() - status.started).total_seconds()
+            embed.set_footer(text=f"Running for {time_util.seconds_to_time(duration)}")
+
+        await self.reply(embed=embed)
+
+
 class ClustersGameMasterCommand(ClustersCommand, name="game_master", parent=ClustersCommand):
     pass
 
@@ -350,8 +615,13 @@ class ClustersGameMasterReloadItemsCommand(
 ):
 
     async def callback(self) -> None:
-        await get_cluster_collection(self.client).send_set_items_message()
-        await self.reply("\N{WHITE HEAVY CHECK MARK} Sent reload items request to IPC")
+        await self.defer()
+        request = await get_cluster_collection(self.client).send_set_items_message()
+
+        if request.missing:
+            await self.edit(content="\N{CROSS MARK} IPC did not confirm the items reload")
+        else:
+            await self.edit(content="\N{WHITE HEAVY CHECK MARK} Game items reloaded by IPC")
 
 
 class ClustersGameMasterEditNewsCommand(
@@ -364,10 +634,9 @@ class ClustersGameMasterEditNewsCommand(
     news: str = discord.app.Option(description="The news text to set")
 
     async def callback(self) -> None:
-        await get_cluster_collection(self.client).send_set_game_news_message(self.news)
-        # Wait for the news to arrive to self
         await self.defer()
-        await asyncio.sleep(2)
+        # Waits for the news to arrive to self
+        await get_cluster_collection(self.client).send_set_game_news_message(self.news)
         await self.edit(content=self.client.game_news)
 
 
@@ -381,10 +650,9 @@ class ClustersGameMasterEditMaintenanceCommand(
 
     async def callback(self) -> None:
         cluster_collection = get_cluster_collection(self.client)
-        async with cluster_collection.response_lock:
-            cluster_collection.responses = {}
-            await cluster_collection.send_set_maintenance_message(self.enabled)
-            await cluster_collection.wait_and_publish_responses(self)
+        await self.defer()
+        request = await cluster_collection.send_set_maintenance_message(self.enabled)
+        await cluster_collection.publish_responses(self, request)
 
 
 class ClustersGameMasterFarmGuardCommand(
@@ -397,10 +665,9 @@ class ClustersGameMasterFarmGuardCommand(
 
     async def callback(self) -> None:
         cluster_collection = get_cluster_collection(self.client)
-        async with cluster_collection.response_lock:
-            cluster_collection.responses = {}
-            await cluster_collection.send_set_farm_guard_message(self.duration)
-            await cluster_collection.wait_and_publish_responses(self)
+        await self.defer()
+        request = await cluster_collection.send_set_farm_guard_message(self.duration)
+        await cluster_collection.publish_responses(self, request)
 
 
 def setup(client) -> list:
@@ -3,6 +3,7 @@ import datetime
 from enum import Enum
 from typing import Optional
 
+from core import queries
 from core.game_items import Product
 from .util import views
 from .util import time as time_util
@@ -37,20 +38,23 @@ class ProductState(Enum):
 
 
 class FactoryItem:
+    """Consecutive units of a factory batch, that are in the same state"""
 
-    __slots__ = ("id", "user_id", "item", "starts", "ends")
+    __slots__ = ("id", "user_id", "item", "amount", "starts", "ends")
 
     def __init__(
         self,
         id: int,
         user_id: int,
         item: Product,
+        amount: int,
         starts: datetime.datetime,
         ends: datetime.datetime
     ) -> None:
         self.id = id
         self.user_id = user_id
         self.item = item
+        self.amount = amount
         self.starts = starts
         self.ends = ends
 
@@ -67,17 +71,30 @@ class FactoryItem:
 
 
 def _parse_db_rows_to_factory_data_objects(client, rows: list) -> list:
-    parsed = []
+    """Splits the batches into the finished units, the unit in production and the queued units"""
+    parsed, now = [], datetime.datetime.now()
 
     for row in rows:
         item = client.item_pool.find_item_by_id(row['item_id'])
-        parsed.append(FactoryItem(
-            id=row['id'],
-            user_id=row['user_id'],
-            item=item,
-            starts=row['starts'],
-            ends=row['ends']
-        ))
+        unit = datetime.timedelta(seconds=row['unit_seconds'])
+        starts, amount = row['starts'], row['amount']
+
+        finished = min(amount, max(0, (now - starts) // unit))
+        producing = min(1, amount - finished)
+        for part in (finished, producing, amount - finished - producing):
+            if not part:
+                continue
+
+            ends = starts + unit * part
+            parsed.append(FactoryItem(
+                id=row['id'],
+                user_id=row['user_id'],
+                item=item,
+                amount=part,
+                starts=starts,
+                ends=ends
+            ))
+            starts = ends
 
     return parsed
 
@@ -110,6 +127,9 @@ class FactorySource(views.AbstractPaginatorSource):
         else:
             state = "Ready to be collected"
 
+        if factory_item.amount > 1:
+            return f"**{factory_item.amount}x {factory_item.item.full_name}** - {state}"
+
         return f"**{factory_item.item.full_name}** - {state}"
 
     async def format_page(self, page, view):
@@ -209,7 +229,7 @@ class FactoryQueueCommand(
                 target_user=target_user,
                 total_workers=user.factory_level,
                 total_slots=user.factory_slots,
-                used_slots=len(factory_parsed),
+                used_slots=sum(x.amount for x in factory_parsed),
                 has_slots_boost=await user.is_boost_active(self, "factory_slots"),
                 last_item_timestamp=factory_fully_ready_in
             )
@@ -274,8 +294,8 @@ class FactoryMakeCommand(
             total_factory_slots += 2
 
         conn = await self.acquire()
-        query = "SELECT COUNT(*) FROM factory WHERE user_id = $1;"
-        used_slots = await conn.fetchval(query, self.author.id)
+        factory_queue = await queries.fetchrow(conn, queries.GET_FACTORY_QUEUE, self.author.id)
+        used_slots = factory_queue['factory_queue_size'] if factory_queue else 0
 
         if (used_slots + self.amount) > total_factory_slots:
             await self.release()
@@ -324,22 +344,17 @@ class FactoryMakeCommand(
             to_remove = [(iaa[0], iaa[1] * self.amount) for iaa in item.made_from]
             await self.user_data.remove_items(to_remove, conn)
 
-            query = "SELECT ends FROM factory WHERE user_id = $1 ORDER BY ends DESC LIMIT 1;"
-            last_ends_in_queue = await conn.fetchval(query, self.author.id)
-
-            now = datetime.datetime.now()
-            if not last_ends_in_queue or last_ends_in_queue < now:
-                last_ends_in_queue = now
-
-            to_insert = []
-            craft_seconds = item.craft_time_by_factory_level(self.user_data.factory_level)
-            for _ in range(self.amount):
-                ends = last_ends_in_queue + datetime.timedelta(seconds=craft_seconds)
-                to_insert.append((self.author.id, item.id, last_ends_in_queue, ends))
-                last_ends_in_queue = ends
-
-            query = "INSERT INTO factory (user_id, item_id, starts, ends) VALUES ($1, $2, $3, $4);"
-            await conn.executemany(query, to_insert)
+            # One batch row for all of the units, queued after the last batch
+            craft_seconds = max(1, item.craft_time_by_factory_level(self.user_data.factory_level))
+            await queries.execute(
+                conn,
+                queries.ENQUEUE_FACTORY_BATCH,
+                self.author.id,
+                item.id,
+                self.amount,
+                craft_seconds,
+                datetime.datetime.now()
+            )
         await self.release()
 
         embed = embed_util.success_embed(
@@ -370,37 +385,39 @@ class FactoryCollectCommand(
 
     async def callback(self):
         conn = await self.acquire()
-        factory_data = await self.user_data.get_factory(conn)
-
-        if not factory_data:
-            await self.release()
-            embed = embed_util.error_embed(
-                title="You are not manufacturing anything in your factory!",
-                text=(
-                    "There is nothing to collect from the factory, because you are not even "
-                    "manufacturing anything. \N{THINKING FACE}\nProduce product items with the "
-                    "**/factory make** command \N{PACKAGE}"
-                ),
-                cmd=self
+        async with conn.transaction():
+            # Removes the finished units in the same statement
+            collected = await queries.fetch(
+                conn, queries.COLLECT_FACTORY, self.author.id, datetime.datetime.now()
             )
-            return await self.reply(embed=embed)
 
-        parsed_factory = _parse_db_rows_to_factory_data_objects(self.client, factory_data)
+            to_award, xp_gain = [], 0
+            for row in collected:
+                item = self.client.item_pool.find_item_by_id(row['item_id'])
+                to_award.append((item, row['amount']))
+                xp_gain += item.xp * row['amount']
 
-        to_delete, to_award, xp_gain = [], {}, 0
-        for product in parsed_factory:
-            if product.state == ProductState.READY:
-                to_delete.append((product.id, ))
+            if to_award:
+                await self.user_data.give_items(to_award, conn)
+                self.user_data.give_xp_and_level_up(self, xp_gain)
+                await self.users.update_user(self.user_data, conn=conn)
 
-                try:
-                    to_award[product.item] += 1
-                except KeyError:
-                    to_award[product.item] = 1
+        if not to_award:
+            factory_queue = await queries.fetchrow(conn, queries.GET_FACTORY_QUEUE, self.author.id)
+            await self.release()
 
-                xp_gain += product.item.xp
+            if not factory_queue or not factory_queue['factory_queue_size']:
+                embed = embed_util.error_embed(
+                    title="You are not manufacturing anything in your factory!",
+                    text=(
+                        "There is nothing to collect from the factory, because you are not even "
+                        "manufacturing anything. \N{THINKING FACE}\nProduce product items with "
+                        "the **/factory make** command \N{PACKAGE}"
+                    ),
+                    cmd=self
+                )
+                return await self.reply(embed=embed)
 
-        if not to_delete:
-            await self.release()
             embed = embed_util.error_embed(
                 title="Your items are still being manufactured! \N{PACKAGE}",
                 text=(
@@ -413,13 +430,6 @@ class FactoryCollectCommand(
             )
             return await self.reply(embed=embed)
 
-        to_award = list(to_award.items())
-        async with conn.transaction():
-            query = "DELETE FROM factory WHERE id = $1;"
-            await conn.executemany(query, to_delete)
-            await self.user_data.give_items(to_award, conn)
-            self.user_data.give_xp_and_level_up(self, xp_gain)
-            await self.users.update_user(self.user_data, conn=conn)
         await self.release()
 
         fmt = ", ".join(f"{amount}x {item.full_name}" for item, amount in to_award)
@@ -8,6 +8,7 @@ from contextlib import suppress
 from core import game_items
 from core import ipc_classes
 from core import modifications
+from core import queries
 from core.game_user import UserNotifications
 from .clusters import get_cluster_collection
 from .util import views
@@ -423,8 +424,7 @@ class FarmPlantCommand(
             await self.release()
             return await self.edit(embed=embed_util.no_money_embed(self, total_cost), view=None)
 
-        query = "SELECT sum(fields_used) FROM farm WHERE user_id = $1;"
-        used_fields = await conn.fetchval(query, self.author.id) or 0
+        used_fields = await queries.fetchval(conn, queries.GET_FARM_SLOTS_USED, self.author.id) or 0
 
         total_slots = self.user_data.farm_slots
         if has_slots_boost:
@@ -3,6 +3,7 @@ from typing import Optional
 
 from core import game_items
 from core import modifications
+from core import queries
 from .util import views
 from .util import time as time_util
 from .util import embeds as embeds_util
@@ -195,13 +196,9 @@ class LaboratoryResearchCommand(
             self.user_data.gold -= gold_cost
             await self.users.update_user(self.user_data, conn=conn)
 
-            query = f"""
-                    INSERT INTO modifications (user_id, item_id, {upgrade_type})
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (user_id, item_id)
-                    DO UPDATE SET {upgrade_type} = modifications.{upgrade_type} + $3;
-                    """
-            await conn.execute(query, self.user_data.user_id, item.id, 1)
+            await queries.execute(
+                conn, queries.UPGRADE_MODIFICATION[upgrade_type], self.user_data.user_id, item.id, 1
+            )
         await self.release()
 
         cooldown = self.calculate_modification_cooldown(current_level + 1)
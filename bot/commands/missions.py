@@ -3,6 +3,7 @@ import datetime
 import jsonpickle
 
 from core import game_missions
+from core import queries
 from .util import views
 from .util import time as time_util
 from .util import embeds as embed_util
@@ -31,16 +32,6 @@ async def complete_business_mission(
     mission_id: int
 ) -> None:
     conn = await cmd.acquire()
-    # mission_id -1 means that the mission is not in the Postgres database
-    if mission_id != -1:
-        query = "SELECT payload FROM missions WHERE id = $1;"
-        payload = await conn.fetchval(query, mission_id)
-
-        # If user tries to complete already completed mission, after the long prompt.
-        if not payload:
-            await cmd.release()
-            return await cmd.edit(content="Already completed!", view=None)
-
     user_items = await cmd.user_data.get_all_items(conn)
     user_items_by_id = {item['item_id']: item for item in user_items}
 
@@ -69,22 +60,30 @@ async def complete_business_mission(
         )
         return await cmd.edit(embed=embed, view=None)
 
+    completed = True
     async with conn.transaction():
+        # mission_id -1 means that the mission is not in the Postgres database.
+        # The deletion guards against completing the same mission twice, after the long prompt.
         if mission_id != -1:
-            query = "DELETE FROM missions WHERE id = $1;"
-            await conn.execute(query, mission_id)
+            completed = await queries.fetchval(
+                conn, queries.DELETE_MISSION, mission_id, cmd.author.id
+            )
 
-        to_remove = [(item, amount) for item, amount in mission.requests]
-        await cmd.user_data.remove_items(to_remove, conn)
+        if completed:
+            to_remove = [(item, amount) for item, amount in mission.requests]
+            await cmd.user_data.remove_items(to_remove, conn)
 
-        if mission.chest:
-            await cmd.user_data.give_item(mission.chest.id, 1, conn)
+            if mission.chest:
+                await cmd.user_data.give_item(mission.chest.id, 1, conn)
 
-        cmd.user_data.gold += mission.gold_reward
-        cmd.user_data.give_xp_and_level_up(cmd, mission.xp_reward)
-        await cmd.users.update_user(cmd.user_data, conn=conn)
+            cmd.user_data.gold += mission.gold_reward
+            cmd.user_data.give_xp_and_level_up(cmd, mission.xp_reward)
+            await cmd.users.update_user(cmd.user_data, conn=conn)
     await cmd.release()
 
+    if not completed:
+        return await cmd.edit(content="Already completed!", view=None)
+
     fmt = ""
     if mission.gold_reward:
         fmt += f"{mission.gold_reward} {cmd.client.gold_emoji} "
@@ -139,26 +138,30 @@ class MissionsOrdersViewCommand(
             return 6
 
     async def callback(self):
-        mission_count, missions, new_missions = self.get_mission_count(), [], []
+        mission_count = self.get_mission_count()
 
         async with self.acquire() as conn:
-            query = "SELECT id, payload FROM missions WHERE user_id = $1;"
-            existing_missions = await conn.fetch(query, self.author.id)
-
-            for _ in range(mission_count - len(existing_missions)):
-                new_mission = game_missions.BusinessMission.generate(self)
-                encoded = jsonpickle.encode(new_mission)
-
-                query = "INSERT INTO missions (user_id, payload) VALUES ($1, $2) RETURNING id;"
-                new_mission_id = await conn.fetchval(query, self.author.id, encoded)
-                new_missions.append((new_mission_id, new_mission))
-
-        for existing in existing_missions:
-            decoded = jsonpickle.decode(existing['payload'])
-            missions.append((existing['id'], decoded))
-        # Just to keep the right order...
-        for new_mission in new_missions:
-            missions.append(new_mission)
+            existing_missions = await queries.fetch(conn, queries.GET_MISSIONS, self.author.id)
+            missions = [
+                (x['id'], game_missions.BusinessMission.from_record(x)) for x in existing_missions
+            ]
+
+            new_missions = [
+                game_missions.BusinessMission.generate(self)
+                for _ in range(mission_count - len(existing_missions))
+            ]
+            if new_missions:
+                inserted_missions = await queries.fetch(
+                    conn,
+                    queries.ADD_MISSIONS,
+                    self.author.id,
+                    [x.to_record() for x in new_missions]
+                )
+                # Rebuilt from the inserted rows, so every ID belongs to its own mission
+                missions.extend(
+                    (x['id'], game_missions.BusinessMission.from_record(x))
+                    for x in sorted(inserted_missions, key=lambda x: x['id'])
+                )
 
         embed = discord.Embed(
             title="\N{MEMO} Your order missions",
@@ -5,6 +5,7 @@ from typing import Optional
 
 from core import game_items
 from core import modifications
+from core import queries
 from .util import views
 from .util import exceptions
 from .util import embeds as embed_util
@@ -115,11 +116,9 @@ class ProfileCommand(
                 target_user = self.player
                 mention = target_user.mention
 
-            # See schema.sql for this function
-            query = "SELECT get_profile_stats($1, $2);"
-            profile_stats = await conn.fetchrow(query, user.user_id, self.guild.id)
-        # Function returns a nested record
-        profile_stats = profile_stats[0]
+            profile_stats = await queries.fetchrow(
+                conn, queries.GET_PROFILE_COUNTERS, user.user_id, self.guild.id
+            ) or {}
 
         total_farm_slots = user.farm_slots
         has_boosters_unlocked: bool = user.level > 6
@@ -588,18 +587,25 @@ class ChestsOpenCommand(
     amount: Optional[int] = discord.app.Option(
         description="How many chests to open",
         min=1,
-        max=100,
+        max=1000,
         default=1
     )
 
-    def ladder_random(self, min: int, max: int, continue_chance: int) -> int:
-        """Randint with a chance of summing up with another randint."""
-        result = random.randint(min, max)
+    def chance_count(self, count: int, chance: int) -> int:
+        """How many of the count random.randint(0, chance) draws are zero."""
+        return sum(1 for _ in range(count) if not random.randint(0, chance))
 
-        while not random.randint(0, continue_chance):
-            result += random.randint(min, max)
+    def ladder_random(self, min: int, max: int, continue_chance: int, count: int = 1) -> int:
+        """
+        Sum of count randints, each with a chance of summing up with another randint.
+        The continuations are drawn in rounds for all of the chests at once.
+        """
+        draws = continuations = count
+        while continuations:
+            continuations = self.chance_count(continuations, continue_chance)
+            draws += continuations
 
-        return result
+        return sum(random.randint(min, max) for _ in range(draws))
 
     async def autocomplete(self, options, focused):
         return discord.AutoCompleteResponse(self.chests_autocomplete(options[focused]))
@@ -623,94 +629,79 @@ class ChestsOpenCommand(
             )
             return await self.reply(embed=embed)
 
-        user_level, items_won = self.user_data.level, []
-        gold_reward = gems_reward = 0
+        # The rewards of all of the chests are drawn at once: the draw counts are summed
+        # first, then the items are drawn with a single weighted choice
+        user_level, count = self.user_data.level, self.amount
+        items_won, gold_reward, gems_reward = {}, 0, 0
         base_growables_multiplier = int(self.user_data.level / 4) + 1
 
         if chest.id == 1000:  # Gold chest
             min_gold = user_level * 20
             max_gold = user_level * 45
 
-            for _ in range(self.amount):
-                gold_reward += self.ladder_random(min_gold, max_gold, 3)
+            gold_reward = self.ladder_random(min_gold, max_gold, 3, count)
         elif chest.id == 1001:  # Common chest
             min_gold = user_level * 2
             max_gold = user_level * 5
             multiplier = int(base_growables_multiplier / 2) or 1
 
-            for _ in range(self.amount):
-                if bool(random.getrandbits(1)):
-                    items: dict = self.items.get_random_items(
-                        user_level,
-                        growables_multiplier=multiplier,
-                        products=False
-                    )
-                    items_won.extend(items.items())
-                else:
-                    gold_reward += self.ladder_random(min_gold, max_gold, 10)
+            # Half of the chests contain an item, the other half gold
+            item_chests = bin(random.getrandbits(count)).count("1")
+            items_won = self.items.get_random_items(
+                user_level,
+                growables_multiplier=multiplier,
+                products=False,
+                total_draws=item_chests
+            )
+            gold_reward = self.ladder_random(min_gold, max_gold, 10, count - item_chests)
         elif chest.id == 1002:  # Uncommon chest
             min_gold = user_level * 3
             max_gold = user_level * 4
 
-            for _ in range(self.amount):
-                items: dict = self.items.get_random_items(
-                    user_level,
-                    extra_luck=0.055,
-                    growables_multiplier=base_growables_multiplier,
-                    products=False,
-                    total_draws=self.ladder_random(1, 2, 15)
-                )
-                items_won.extend(items.items())
-
-                if not random.randint(0, 6):
-                    gold_reward += self.ladder_random(min_gold, max_gold, 8)
+            items_won = self.items.get_random_items(
+                user_level,
+                extra_luck=0.055,
+                growables_multiplier=base_growables_multiplier,
+                products=False,
+                total_draws=self.ladder_random(1, 2, 15, count)
+            )
+            gold_reward = self.ladder_random(min_gold, max_gold, 8, self.chance_count(count, 6))
         elif chest.id == 1003:  # Rare chest
             min_gold = user_level * 6
             max_gold = user_level * 7
 
-            for _ in range(self.amount):
-                items: dict = self.items.get_random_items(
-                    user_level,
-                    extra_luck=0.15,
-                    growables_multiplier=base_growables_multiplier + 4,
-                    products=False,
-                    total_draws=self.ladder_random(1, 3, 12)
-                )
-                items_won.extend(items.items())
-
-                if not random.randint(0, 4):
-                    gold_reward += self.ladder_random(min_gold, max_gold, 6)
+            items_won = self.items.get_random_items(
+                user_level,
+                extra_luck=0.15,
+                growables_multiplier=base_growables_multiplier + 4,
+                products=False,
+                total_draws=self.ladder_random(1, 3, 12, count)
+            )
+            gold_reward = self.ladder_random(min_gold, max_gold, 6, self.chance_count(count, 4))
         elif chest.id == 1004:  # Epic chest
             min_gold = user_level * 15
             max_gold = user_level * 25
 
-            for _ in range(self.amount):
-                items: dict = self.items.get_random_items(
-                    user_level,
-                    extra_luck=0.35,
-                    growables_multiplier=base_growables_multiplier + 7,
-                    total_draws=self.ladder_random(3, 4, 9)
-                )
-                items_won.extend(items.items())
-
-                gold_reward += self.ladder_random(min_gold, max_gold, 5)
+            items_won = self.items.get_random_items(
+                user_level,
+                extra_luck=0.35,
+                growables_multiplier=base_growables_multiplier + 7,
+                total_draws=self.ladder_random(3, 4, 9, count)
+            )
+            gold_reward = self.ladder_random(min_gold, max_gold, 5, count)
         elif chest.id == 1005:  # Legendary chest
             min_gold = user_level * 20
             max_gold = user_level * 50
 
-            for _ in range(self.amount):
-                items: dict = self.items.get_random_items(
-                    user_level,
-                    extra_luck=0.85,
-                    growables_multiplier=base_growables_multiplier + 12,
-                    products_multiplier=2,
-                    total_draws=self.ladder_random(4, 5, 6)
-                )
-                items_won.extend(items.items())
-
-                gold_reward += self.ladder_random(min_gold, max_gold, 3)
-                if not random.randint(0, 14):
-                    gems_reward += 1
+            items_won = self.items.get_random_items(
+                user_level,
+                extra_luck=0.85,
+                growables_multiplier=base_growables_multiplier + 12,
+                products_multiplier=2,
+                total_draws=self.ladder_random(4, 5, 6, count)
+            )
+            gold_reward = self.ladder_random(min_gold, max_gold, 3, count)
+            gems_reward = self.chance_count(count, 14)
 
         self.user_data.gold += gold_reward
         self.user_data.gems += gems_reward
@@ -722,16 +713,9 @@ class ChestsOpenCommand(
                 if gold_reward or gems_reward:
                     await self.users.update_user(self.user_data, conn=conn)
                 if items_won:
-                    await self.user_data.give_items(items_won, conn)
-
-        rewards, grouped = "", {}
-        for item, amt in items_won:
-            try:
-                grouped[item] += amt
-            except KeyError:
-                grouped[item] = amt
+                    await self.user_data.give_items(list(items_won.items()), conn)
 
-        rewards += "".join(f"**{item.full_name}**: {amt} " for item, amt in grouped.items())
+        rewards = "".join(f"**{item.full_name}**: {amt} " for item, amt in items_won.items())
         if gold_reward:
             rewards += f"**{self.client.gold_emoji} {gold_reward} gold** "
         if gems_reward:
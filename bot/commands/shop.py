@@ -1,11 +1,15 @@
 import discord
 import datetime
+import json
 from contextlib import suppress
 from typing import Optional, Literal
 
 from core import game_items
+from core import static
+from core import queries
 from core.game_user import UserNotifications
 from .util import views
+from .util import exceptions
 from .util import embeds as embed_util
 from .util.commands import FarmSlashCommand, FarmCommandCollection
 
@@ -89,12 +93,50 @@ class MarketSource(views.AbstractPaginatorSource):
         )
 
 
-class TradesSource(views.AbstractPaginatorSource):
-    def __init__(self, entries, server_name: str, own_trades: bool = False):
-        super().__init__(entries, per_page=6)
-        self.server_name = discord.utils.escape_markdown(server_name)
+class TradesSource(views.KeysetPaginatorSource):
+    # Upper bound of the trade IDs, for reading the last page
+    max_trade_id = 2147483647  # PostgreSQL's max int value
+
+    def __init__(self, command, total: int, own_trades: bool = False):
+        super().__init__(total, per_page=6)
+        self.command = command
+        self.guild_id = command.guild.id
+        self.server_name = discord.utils.escape_markdown(command.guild.name)
         self.own_trades = own_trades
 
+    async def fetch_trades(self, statement: str, key: int, limit: int) -> list:
+        async with self.command.acquire() as conn:
+            if self.own_trades:
+                trades = await queries.fetch(
+                    conn, statement, self.guild_id, self.command.author.id, key, limit
+                )
+            else:
+                trades = await queries.fetch(conn, statement, self.guild_id, key, limit)
+
+        return [dict(trade) for trade in trades]
+
+    async def fetch_after(self, key, limit):
+        key = key or 0
+        if self.own_trades:
+            return await self.fetch_trades(queries.GET_OWN_TRADES_AFTER, key, limit)
+
+        return await self.command.cached_listing(
+            f"after:{key}:{limit}",
+            lambda: self.fetch_trades(queries.GET_TRADES_AFTER, key, limit)
+        )
+
+    async def fetch_before(self, key, limit):
+        key = key or self.max_trade_id
+        if self.own_trades:
+            trades = await self.fetch_trades(queries.GET_OWN_TRADES_BEFORE, key, limit)
+        else:
+            trades = await self.command.cached_listing(
+                f"before:{key}:{limit}",
+                lambda: self.fetch_trades(queries.GET_TRADES_BEFORE, key, limit)
+            )
+
+        return trades[::-1]
+
     async def format_page(self, page, view):
         who = "All" if not self.own_trades else "Your"
         title = f"\N{HANDSHAKE} {who} trade offers in \"{self.server_name}\""
@@ -705,8 +747,208 @@ class MarketSellCommand(
         await self.edit(embed=embed, view=None)
 
 
+class MarketSellAllCommand(
+    MarketCommand,
+    name="sellall",
+    description="\N{MONEY WITH WINGS} Sells all of your items of a category to the market",
+    parent=MarketCommand
+):
+    """
+    Sells all of your items of the chosen category to the market at once, at the current market
+    prices. You can keep some of each item, for example, to have some seeds left for planting,
+    or to only sell some of the items by listing their names.<br>
+    \N{ELECTRIC LIGHT BULB} To sell a single item, see the **/market sell** command.
+    """
+    category: Literal[
+        "all items",
+        "crops",
+        "trees and bushes",
+        "animal products",
+        "factory products",
+        "other items"
+    ] = discord.app.Option(description="The category of items to sell")
+    keep: Optional[int] = discord.app.Option(
+        description="How many of each item to keep",
+        min=0,
+        max=100_000,
+        default=0
+    )
+    only: Optional[str] = discord.app.Option(
+        description="Comma separated names of the only items to sell from the category"
+    )
+
+    def get_items_to_sell(self, inventory: list) -> list:
+        class_per_category = {
+            "all items": game_items.SellableItem,
+            "crops": game_items.Crop,
+            "trees and bushes": game_items.Tree,
+            "animal products": game_items.Animal,
+            "factory products": game_items.Product,
+            "other items": game_items.Special
+        }
+        item_class = class_per_category[self.category]
+
+        only_ids = None
+        if self.only:
+            only_ids = {self.lookup_item(x.strip()).id for x in self.only.split(",") if x.strip()}
+
+        to_sell = []
+        for data in inventory:
+            try:
+                item = self.items.find_item_by_id(data['item_id'])
+            except exceptions.ItemNotFoundException:
+                # Could be a chest, we exclude those here
+                continue
+
+            if not isinstance(item, item_class):
+                continue
+            if only_ids is not None and item.id not in only_ids:
+                continue
+
+            amount = data['amount'] - self.keep
+            if amount > 0:
+                to_sell.append((item, amount))
+
+        return to_sell
+
+    async def callback(self):
+        # Validated against this single inventory fetch, the removal guards against changes
+        async with self.acquire() as conn:
+            inventory = await self.user_data.get_all_items(conn)
+
+        to_sell = self.get_items_to_sell(inventory)
+        if not to_sell:
+            embed = embed_util.error_embed(
+                title="You don't have anything to sell!",
+                text=(
+                    f"{self.client.warehouse_emoji} There are no items to sell from the "
+                    f"**{self.category}** category in your warehouse, while keeping "
+                    f"**{self.keep}** of each item."
+                ),
+                footer="Check your warehouse with the /inventory command",
+                cmd=self
+            )
+            return await self.reply(embed=embed)
+
+        price_epoch = self.client.price_epoch
+        prices = {item.id: item.gold_reward for item, _ in to_sell}
+        total_reward = sum(prices[item.id] * amount for item, amount in to_sell)
+
+        max_lines = 15
+        fmt = "\n".join(
+            f"**{item.full_name} x{amount}** - {prices[item.id] * amount} "
+            f"{self.client.gold_emoji}"
+            for item, amount in to_sell[:max_lines]
+        )
+        if len(to_sell) > max_lines:
+            fmt += f"\n... and {len(to_sell) - max_lines} more items"
+
+        embed = embed_util.prompt_embed(
+            title="Please confirm market deal details",
+            text=f"So do you really want to sell all of these? Let me know if you approve\n\n{fmt}",
+            cmd=self
+        )
+        embed.add_field(
+            name="\N{MONEY BAG} Total earnings",
+            value=f"**{total_reward}** {self.client.gold_emoji}"
+        )
+
+        confirm = await views.ConfirmPromptView(
+            self,
+            initial_embed=embed,
+            emoji=self.client.gold_emoji,
+            label="Sell items to the market"
+        ).prompt()
+
+        if not confirm:
+            return
+
+        # The confirmed prices must still be the current ones
+        self.client.read_shared_prices(self.client.item_pool)
+        if self.client.price_epoch != price_epoch:
+            embed = embed_util.error_embed(
+                title="The market prices have just changed!",
+                text=(
+                    "Sorry, the market has just updated the prices, while you were deciding. "
+                    "\N{CHART WITH DOWNWARDS TREND} Please check the new prices and try again!"
+                ),
+                cmd=self
+            )
+            return await self.edit(embed=embed, view=None)
+
+        conn = await self.acquire()
+        try:
+            async with conn.transaction():
+                removed = await queries.fetchval(
+                    conn,
+                    queries.REMOVE_OWNED_ITEMS,
+                    self.author.id,
+                    [item.id for item, _ in to_sell],
+                    [amount for _, amount in to_sell]
+                )
+                if removed != len(to_sell):
+                    # Some of the items were used after the prompt, rolls back the removal
+                    raise exceptions.FarmException(embed=embed_util.error_embed(
+                        title="Your warehouse has changed!",
+                        text=(
+                            f"{self.client.warehouse_emoji} Some of these items are not in your "
+                            "warehouse anymore, so nothing was sold. Please try again!"
+                        ),
+                        cmd=self
+                    ))
+
+                self.user_data.gold += total_reward
+                await self.users.update_user(self.user_data, conn=conn)
+        finally:
+            await self.release()
+
+        embed = embed_util.success_embed(
+            title="Your items have been sold to the market! \N{SCALES}",
+            text=(
+                "Thank you for selling these items to the market! "
+                "\N{SMILING FACE WITH SMILING EYES} We will be looking forward to working with "
+                f"you again! You sold **{sum(x[1] for x in to_sell)} items** for "
+                f"**{total_reward} {self.client.gold_emoji}**"
+            ),
+            footer=f"You now have {self.user_data.gold} gold coins!",
+            cmd=self
+        )
+        await self.edit(embed=embed, view=None)
+
+
 class TradesCommand(FarmSlashCommand, name="trades"):
     _required_level: int = 5
+    # Seconds to cache the server trade listing pages and the seller membership checks
+    _listing_cache_ttl: int = 300
+    _member_cache_ttl: int = 60
+
+    async def cached_listing(self, name: str, fetch):
+        """
+        Returns the cached part of this server's trade listing, or caches the result of fetch.
+        The cache keys include the listing version, so changed trades outdate all of the pages.
+        """
+        version = await self.redis.execute_command(
+            "HGET", static.TRADES_CACHE_VERSION_KEY, self.guild.id
+        )
+        key = f"trades_cache:{self.guild.id}:{int(version or 0)}:{name}"
+
+        cached = await self.redis.execute_command("GET", key)
+        if cached is not None:
+            return json.loads(cached)
+
+        result = await fetch()
+        await self.redis.execute_command(
+            "SET", key, json.dumps(result), "EX", self._listing_cache_ttl
+        )
+        return result
+
+    async def invalidate_trades_cache(self, guild_id: int) -> None:
+        """Outdates the cached trade listing, must be called after the trades have changed"""
+        await self.redis.execute_command("HINCRBY", static.TRADES_CACHE_VERSION_KEY, guild_id, 1)
+
+    async def count_trades(self) -> int:
+        async with self.acquire() as conn:
+            return await queries.fetchval(conn, queries.COUNT_TRADES, self.guild.id)
 
 
 class TradesListCommand(
@@ -727,21 +969,17 @@ class TradesListCommand(
     )
 
     async def callback(self):
-        async with self.acquire() as conn:
-            if not self.owned:
-                query = "SELECT * FROM store WHERE guild_id = $1;"
-                trades_data = await conn.fetch(query, self.guild.id)
-            else:
-                query = "SELECT * FROM store WHERE guild_id = $1 AND user_id = $2;"
-                trades_data = await conn.fetch(query, self.guild.id, self.author.id)
+        if not self.owned:
+            total = await self.cached_listing("count", self.count_trades)
+        else:
+            async with self.acquire() as conn:
+                total = await queries.fetchval(
+                    conn, queries.GET_STORE_SLOTS_USED, self.author.id, self.guild.id
+                ) or 0
 
         await views.ButtonPaginatorView(
             self,
-            source=TradesSource(
-                entries=trades_data,
-                server_name=self.guild.name,
-                own_trades=self.owned
-            )
+            source=TradesSource(self, total=total, own_trades=self.owned)
         ).start()
 
 
@@ -793,8 +1031,9 @@ class TradesCreateCommand(
         }
         total_price = prices_map[self.price]()
 
-        query = "SELECT COUNT(*) FROM store WHERE user_id = $1 AND guild_id = $2;"
-        used_slots = await conn.fetchval(query, self.author.id, self.guild.id)
+        used_slots = await queries.fetchval(
+            conn, queries.GET_STORE_SLOTS_USED, self.author.id, self.guild.id
+        ) or 0
         if used_slots >= self.user_data.store_slots:
             await self.release()
             embed = embed_util.error_embed(
@@ -833,6 +1072,7 @@ class TradesCreateCommand(
                 total_price
             )
         await self.release()
+        await self.invalidate_trades_cache(self.guild.id)
 
         embed = embed_util.success_embed(
             title="Trade offer is successfully created!",
@@ -885,6 +1125,29 @@ class TradesAcceptCommand(
         else:
             await self.edit(embed=embed, view=None)
 
+    async def seller_is_member(self, user_id: int) -> bool:
+        """
+        Checks if the seller is still in this server. The members are not cached by the bot,
+        so the found members are remembered for a short while, to spare the API requests.
+        """
+        if self.guild.get_member(user_id) is not None:
+            return True
+
+        key = f"trades_member:{self.guild.id}:{user_id}"
+        if await self.redis.execute_command("EXISTS", key):
+            return True
+
+        try:
+            await self.guild.fetch_member(user_id)
+        except discord.HTTPException as e:
+            if e.status != 404:
+                raise e
+
+            return False
+
+        await self.redis.execute_command("SET", key, 1, "EX", self._member_cache_ttl)
+        return True
+
     async def callback(self):
         async with self.acquire() as conn:
             query = "SELECT * FROM store WHERE id = $1 AND guild_id = $2;"
@@ -920,15 +1183,12 @@ class TradesAcceptCommand(
             )
             return await self.reply(embed=embed)
 
-        try:
-            seller_member = await self.guild.fetch_member(trade_data['user_id'])
-        except discord.HTTPException as e:
-            if e.status != 404:
-                raise e
-
+        seller_id = trade_data['user_id']
+        if not await self.seller_is_member(seller_id):
             async with self.acquire() as conn:
                 query = "DELETE FROM store WHERE id = $1;"
                 await conn.execute(query, self.id)
+            await self.invalidate_trades_cache(self.guild.id)
 
             embed = embed_util.error_embed(
                 title="Oops, the trader has vanished!",
@@ -948,7 +1208,7 @@ class TradesAcceptCommand(
         )
         embed.add_field(
             name="\N{MAN}\N{ZERO WIDTH JOINER}\N{EAR OF RICE} Seller",
-            value=seller_member.mention
+            value=f"<@{seller_id}>"
         )
         embed.add_field(name="\N{LABEL} Item", value=f"{amount}x {item.full_name}")
         embed.add_field(name="\N{MONEY BAG} Total price", value=f"{price} {self.client.gold_emoji}")
@@ -989,11 +1249,12 @@ class TradesAcceptCommand(
             await self.users.update_user(user_data, conn=conn)
             await self.users.update_user(trade_user_data, conn=conn)
         await self.release()
+        await self.invalidate_trades_cache(self.guild.id)
 
         embed = embed_util.success_embed(
             title="Successfully bought items!",
             text=(
-                f"You bought **{amount}x {item.full_name}** from {seller_member.mention} for "
+                f"You bought **{amount}x {item.full_name}** from <@{seller_id}> for "
                 f"**{price}** {self.client.gold_emoji}\n"
                 "What a great trade you both just made! \N{HANDSHAKE}"
             ),
@@ -1016,7 +1277,8 @@ class TradesAcceptCommand(
         )
         # User might have direct messages disabled
         with suppress(discord.HTTPException):
-            await seller_member.send(embed=embed)
+            seller = self.client.get_user(seller_id) or await self.client.fetch_user(seller_id)
+            await seller.send(embed=embed)
 
 
 class TradesDeleteCommand(
@@ -1060,6 +1322,7 @@ class TradesDeleteCommand(
             item_id, amount = trade_data['item_id'], trade_data['amount']
             await self.user_data.give_item(item_id, amount, conn)
         await self.release()
+        await self.invalidate_trades_cache(trade_data['guild_id'])
 
         item = self.items.find_item_by_id(trade_data['item_id'])
         embed = embed_util.success_embed(
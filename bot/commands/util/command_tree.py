@@ -0,0 +1,108 @@
+"""
+Canonical form of the loaded application command tree.
+The tree is hashed and stored in Redis after every upload, so that the cluster with shard
+zero only uploads the commands to Discord when they have actually changed.
+"""
+import json
+import hashlib
+
+from core import static
+
+
+SCOPES = ("global", "guild")
+
+
+def _serialize_option(option) -> dict:
+    return {
+        "name": option.name,
+        "description": option.description,
+        "type": repr(option.type),
+        "default": repr(option.default),
+        "choices": repr(getattr(option, "choices", None)),
+        "autocomplete": bool(getattr(option, "autocomplete", False))
+    }
+
+
+def _serialize_command(command) -> dict:
+    children = command._children_ or {}
+
+    return {
+        "name": command._name_,
+        "description": command._description_,
+        "guilds": sorted(command._guilds_ or []),
+        # The option order is shown to the users, so it is kept as is
+        "options": [_serialize_option(x) for x in getattr(command, "_arguments_", None) or []],
+        "children": {c._name_: _serialize_command(c) for c in children.values()}
+    }
+
+
+def serialize_command_tree(collections) -> dict:
+    """Serializes the top level commands of the collections into scope -> name -> command"""
+    tree = {scope: {} for scope in SCOPES}
+
+    for collection in collections:
+        for command in collection.commands:
+            scope = "guild" if command._guilds_ else "global"
+            tree[scope][command._name_] = _serialize_command(command)
+
+    return tree
+
+
+def dump_commands(commands: dict) -> str:
+    # Sorted keys and no whitespace make the dump stable between processes
+    return json.dumps(commands, sort_keys=True, separators=(",", ":"))
+
+
+def hash_commands(commands: dict) -> str:
+    return hashlib.sha256(dump_commands(commands).encode("utf-8")).hexdigest()
+
+
+async def get_stored_commands(redis) -> dict:
+    """Fetches scope -> (hash, commands) of the last upload"""
+    entries = await redis.execute_command("HGETALL", static.COMMAND_TREE_KEY)
+    entries = {k.decode("utf-8"): v.decode("utf-8") for k, v in entries.items()}
+
+    stored = {}
+    for scope in SCOPES:
+        digest = entries.get(f"{scope}:hash")
+        commands = entries.get(f"{scope}:tree")
+        stored[scope] = (digest, json.loads(commands) if commands else {})
+
+    return stored
+
+
+async def store_commands(redis, scope: str, commands: dict) -> None:
+    await redis.execute_command(
+        "HSET", static.COMMAND_TREE_KEY,
+        f"{scope}:hash", hash_commands(commands),
+        f"{scope}:tree", dump_commands(commands)
+    )
+
+
+def _flatten(commands: dict, prefix: str = "") -> dict:
+    """Flattens the commands into full name -> command without its children"""
+    results = {}
+
+    for name, command in commands.items():
+        full_name = f"{prefix}{name}"
+        results[full_name] = {k: v for k, v in command.items() if k != "children"}
+        results.update(_flatten(command['children'], prefix=f"{full_name} "))
+
+    return results
+
+
+def diff_commands(old: dict, new: dict) -> list:
+    """Lists the commands that an upload would add (+), remove (-) or change (~)"""
+    old, new = _flatten(old), _flatten(new)
+    lines = []
+
+    for name in sorted(old.keys() | new.keys()):
+        if name not in old:
+            lines.append(f"+ /{name}")
+        elif name not in new:
+            lines.append(f"- /{name}")
+        elif old[name] != new[name]:
+            changed = sorted(k for k in new[name] if old[name].get(k) != new[name][k])
+            lines.append(f"~ /{name} ({', '.join(changed)})")
+
+    return lines
@@ -1,7 +1,10 @@
 import discord
 import difflib
+import functools
 import traceback
 import itertools
+import contextlib
+from time import perf_counter
 from discord.ext import modules
 
 from . import time
@@ -84,6 +87,51 @@ class _DBContextAcquire:
         await self.command.release()
 
 
+class _MeasuredProxy:
+    """Records the duration of the awaited calls of a Redis client or a Postgres pool/connection"""
+
+    __slots__ = ("_target", "_command", "_stage", "_methods")
+
+    def __init__(self, target, command, stage: str, methods: tuple) -> None:
+        self._target = target
+        self._command = command
+        self._stage = stage
+        self._methods = methods
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if name not in self._methods:
+            return attribute
+
+        @functools.wraps(attribute)
+        async def measured(*args, **kwargs):
+            with self._command.measure(self._stage):
+                return await attribute(*args, **kwargs)
+
+        return measured
+
+    def measure_stage(self):
+        """Measures the calls, that go around this proxy, like the prepared statements"""
+        return self._command.measure(self._stage)
+
+
+REDIS_MEASURED_METHODS = ("execute_command", )
+POSTGRES_MEASURED_METHODS = ("fetch", "fetchrow", "fetchval", "execute", "executemany")
+
+
+def _wrap_callback(callback):
+    @functools.wraps(callback)
+    async def wrapped(self, *args, **kwargs):
+        try:
+            with self.measure("callback"):
+                return await callback(self, *args, **kwargs)
+        finally:
+            # The interaction is over, nothing may keep the connection after this
+            await self._release_leaked_lease()
+
+    return wrapped
+
+
 class FarmSlashCommand(discord.app.SlashCommand):
     """Base class for all slash commands."""
     _avoid_maintenance: bool = True
@@ -96,6 +144,12 @@ class FarmSlashCommand(discord.app.SlashCommand):
     _db = None
     _level_up: bool = False
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # Measure every command's own callback and clean up after it
+        if "callback" in cls.__dict__:
+            cls.callback = _wrap_callback(cls.__dict__['callback'])
+
     @property
     def author(self) -> discord.User:
         return self.interaction.user
@@ -122,14 +176,17 @@ class FarmSlashCommand(discord.app.SlashCommand):
 
     @property
     def redis(self):
-        return self.client.redis
+        return _MeasuredProxy(self.client.redis, self, "redis", REDIS_MEASURED_METHODS)
 
     @property
     def db(self):
-        return self._db if self._db else self.client.db_pool
+        db = self._db if self._db else self.client.db_pool
+        return _MeasuredProxy(db, self, "postgres", POSTGRES_MEASURED_METHODS)
 
     @property
     def items(self):
+        # Cheap, unless the host's shared market prices have changed since the last time
+        self.client.read_shared_prices(self.client.item_pool)
         return self.client.item_pool
 
     @property
@@ -151,13 +208,31 @@ class FarmSlashCommand(discord.app.SlashCommand):
         self._level_up = False
         return kwargs
 
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        """Records the duration of a stage of this command into the cluster's command stats"""
+        start, error = perf_counter(), False
+        try:
+            yield
+        except exceptions.FarmException:
+            raise  # Expected, reported to the user
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.client.command_stats.record(
+                self.get_full_name(), stage, perf_counter() - start, error
+            )
+
     async def reply(self, *args, **kwargs) -> None:
         kwargs = self._inject_level_up_embed(**kwargs)
-        return await self.interaction.response.send_message(*args, **kwargs)
+        with self.measure("reply"):
+            return await self.interaction.response.send_message(*args, **kwargs)
 
     async def edit(self, *args, **kwargs) -> None:
         kwargs = self._inject_level_up_embed(**kwargs)
-        return await self.interaction.edit_original_message(*args, **kwargs)
+        with self.measure("edit"):
+            return await self.interaction.edit_original_message(*args, **kwargs)
 
     def get_full_name(self) -> str:
         """Concats the full name of the command"""
@@ -181,6 +256,10 @@ class FarmSlashCommand(discord.app.SlashCommand):
         return results
 
     async def pre_check(self) -> bool:
+        with self.measure("pre_check"):
+            return await self._pre_check()
+
+    async def _pre_check(self) -> bool:
         if self._avoid_maintenance and self.client.maintenance_mode:
             if not await self.client.is_owner(self.author):
                 raise exceptions.GameIsInMaintenanceException()
@@ -363,9 +442,13 @@ class FarmSlashCommand(discord.app.SlashCommand):
 
     async def _acquire(self, timeout: float):
         if self._db is None:
-            self._db = await self.client.db_pool.acquire(timeout=timeout)
+            start = perf_counter()
+            with self.measure("acquire"):
+                self._db = await self.client.db_pool.acquire(timeout=timeout)
+            self.client.db_acquire_wait.record(perf_counter() - start)
+            self.client.lease_tracker.open(self)
 
-        return self._db
+        return self.db
 
     def acquire(self, *, timeout: float = 300.0) -> _DBContextAcquire:
         """Acquires database pool connection"""
@@ -374,9 +457,34 @@ class FarmSlashCommand(discord.app.SlashCommand):
     async def release(self) -> None:
         """Releases database pool connection, if acquired"""
         if self._db is not None:
-            await self.client.db_pool.release(self._db)
+            with self.measure("release"):
+                await self.client.db_pool.release(self._db)
             self._db = None
 
+            lease = self.client.lease_tracker.close(self)
+            if lease is not None:
+                self.client.command_stats.record(self.get_full_name(), "lease", lease.held_for)
+
+    async def _release_leaked_lease(self) -> None:
+        if self._db is None:
+            return
+
+        lease = self.client.lease_tracker.get(self)
+        self.client.lease_tracker.force_released += 1
+        self.client.log.warning(
+            "Force releasing a connection lease at the end of the interaction",
+            extra={
+                "fields": {
+                    "command": self.get_full_name(),
+                    "held_for": f"{lease.held_for:.2f}s" if lease else "unknown"
+                }
+            }
+        )
+        if lease is not None:
+            self.client.log.debug(f"Lease acquired at:\n{lease.format_stack()}")
+
+        await self.release()
+
 
 def format_docstring_help(doc: str) -> str:
     """
@@ -0,0 +1,71 @@
+"""
+Tracking of the pooled Postgres connections held by the commands.
+The pool is small, so every lease is recorded with its owner and acquisition stack,
+to find the commands that hold a connection for too long or never release it.
+"""
+import time
+import traceback
+
+
+class ConnectionLease:
+
+    __slots__ = ("owner_id", "command", "acquired_at", "stack")
+
+    def __init__(self, owner_id: int, command: str, stack: list) -> None:
+        self.owner_id = owner_id
+        self.command = command
+        self.acquired_at = time.monotonic()
+        self.stack = stack
+
+    @property
+    def held_for(self) -> float:
+        return time.monotonic() - self.acquired_at
+
+    def format_stack(self) -> str:
+        return "".join(traceback.format_list(self.stack)) if self.stack else "Stack not captured"
+
+
+class LeaseTracker:
+
+    __slots__ = ("log", "capture_stacks", "leases", "force_released", "held_across_prompts")
+
+    def __init__(self, log, capture_stacks: bool = True) -> None:
+        self.log = log
+        self.capture_stacks = capture_stacks
+        # Command instance ID -> ConnectionLease
+        self.leases = {}
+        self.force_released = 0
+        self.held_across_prompts = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.leases)
+
+    def open(self, command) -> ConnectionLease:
+        # Skip this frame and the acquire layer frames
+        stack = traceback.extract_stack(limit=8)[:-3] if self.capture_stacks else None
+        lease = ConnectionLease(command.author.id, command.get_full_name(), stack)
+        self.leases[id(command)] = lease
+        return lease
+
+    def close(self, command) -> ConnectionLease:
+        """Forgets the lease of the command, returns None if it had none"""
+        return self.leases.pop(id(command), None)
+
+    def get(self, command) -> ConnectionLease:
+        return self.leases.get(id(command))
+
+    def warn_held_across_prompt(self, command) -> None:
+        lease = self.get(command)
+        if lease is None:
+            return
+
+        self.held_across_prompts += 1
+        self.log.warning(
+            "Connection lease held across a prompt",
+            extra={"fields": {"command": lease.command, "owner": lease.owner_id}}
+        )
+        self.log.debug(f"Lease acquired at:\n{lease.format_stack()}")
+
+    def oldest(self, limit: int = 10) -> list:
+        return sorted(self.leases.values(), key=lambda x: x.acquired_at)[:limit]
@@ -0,0 +1,107 @@
+"""
+Batching sink for the Discord log webhook.
+Log lines are queued and sent as a single webhook message every few seconds through one
+pooled session, so bursts of guild joins or reconnects do not hit the webhook rate limit.
+"""
+import asyncio
+import aiohttp
+import discord
+import collections
+
+
+class WebhookLogSink:
+    max_content_length = 2000
+    max_embeds = 10
+    max_close_batches = 5
+
+    def __init__(self, url: str, prefix: str, flush_delay: float, max_pending: int, log) -> None:
+        self.url = url
+        self.prefix = prefix
+        self.flush_delay = flush_delay
+        self.max_pending = max_pending
+        self.log = log
+        self.username = None
+        # (content, embed) waiting for the next flush
+        self.pending = collections.deque()
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.session = None
+        self.webhook = None
+        self._task = None
+
+    def start(self, loop) -> None:
+        self.session = aiohttp.ClientSession()
+        self.webhook = discord.Webhook.from_url(self.url, session=self.session)
+        self._task = loop.create_task(self._flush_task())
+
+    def send(self, content: str, embed: discord.Embed = None) -> None:
+        """Queues a log line, dropping it if too many are already waiting"""
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        self.pending.append((content, embed))
+
+    def _next_batch(self) -> tuple:
+        max_line_length = self.max_content_length - len(self.prefix) - 1
+        lines, embeds = [], []
+
+        if self.dropped:
+            lines.append(f"\N{WARNING SIGN} Dropped {self.dropped} log messages")
+            self.dropped = 0
+
+        length = len(self.prefix) + sum(len(x) + 1 for x in lines)
+        while self.pending:
+            content, embed = self.pending[0]
+            content = content[:max_line_length]
+
+            if lines and length + len(content) + 1 > self.max_content_length:
+                break
+            if embed is not None and len(embeds) >= self.max_embeds:
+                break
+
+            self.pending.popleft()
+            lines.append(content)
+            length += len(content) + 1
+            if embed is not None:
+                embeds.append(embed)
+
+        return f"{self.prefix} " + "\n".join(lines), embeds
+
+    async def flush(self) -> bool:
+        """Sends one batch of the queued lines, returns False if there was nothing to send"""
+        if self.webhook is None or (not self.pending and not self.dropped):
+            return False
+
+        content, embeds = self._next_batch()
+        kwargs = {"embeds": embeds} if embeds else {}
+        try:
+            # The webhook adapter waits out the rate limits by itself
+            await self.webhook.send(content, username=self.username, **kwargs)
+            self.sent += 1
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+            self.failed += 1
+            self.log.exception("Failed to send logs to the webhook")
+
+        return True
+
+    async def _flush_task(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_delay)
+
+            try:
+                await self.flush()
+            except Exception:
+                self.log.exception("Webhook log sink flush failed")
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+        for _ in range(self.max_close_batches):
+            if not await self.flush():
+                break
+
+        if self.session:
+            await self.session.close()
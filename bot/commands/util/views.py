@@ -30,6 +30,59 @@ class AbstractPaginatorSource:
         raise NotImplementedError("Page format not implemented")
 
 
+class KeysetPaginatorSource(AbstractPaginatorSource):
+    """
+    Paginator source, that fetches only the displayed page instead of holding all entries.
+    The pages are fetched after the last or before the first key of the current page,
+    which covers all of the moves of the ButtonPaginatorView buttons.
+    """
+
+    def __init__(self, total: int, per_page: int = 10, key: str = "id") -> None:
+        super().__init__([], per_page)
+        self.total = total
+        self.key = key
+
+        pages, left_over = divmod(total, per_page)
+        if left_over:
+            pages += 1
+
+        self.max_pages = pages
+        self.page_number = None
+        self.page = []
+
+    def should_paginate(self) -> bool:
+        return self.total > self.per_page
+
+    async def fetch_after(self, key, limit: int) -> list:
+        """The first entries after the key, or from the start, if the key is None"""
+        raise NotImplementedError("Page fetching not implemented")
+
+    async def fetch_before(self, key, limit: int) -> list:
+        """The last entries before the key in ascending order, or from the end, if None"""
+        raise NotImplementedError("Page fetching not implemented")
+
+    async def get_page_contents(self, page_number: int) -> list:
+        if page_number == self.page_number:
+            return self.page
+
+        if page_number == 0:
+            page = await self.fetch_after(None, self.per_page)
+        elif self.page and page_number == self.page_number + 1:
+            page = await self.fetch_after(self.page[-1][self.key], self.per_page)
+        elif self.page and page_number == self.page_number - 1:
+            page = await self.fetch_before(self.page[0][self.key], self.per_page)
+        elif page_number == self.max_pages - 1:
+            # A full page, because the total might be outdated by now. The previous pages
+            # are then fetched before this one, so no entries are skipped on the way back.
+            page = await self.fetch_before(None, self.per_page)
+        else:
+            # The entries of the current page are gone, so going back from the end
+            page = await self.fetch_before(None, self.per_page)
+
+        self.page_number, self.page = page_number, page
+        return page
+
+
 class ButtonPaginatorView(discord.ui.View):
 
     def __init__(self, command, source: AbstractPaginatorSource) -> None:
@@ -68,7 +121,9 @@ class ButtonPaginatorView(discord.ui.View):
         self.counter.label = f"Page {self.current_page + 1}/{self.source.max_pages}"
 
     async def current_page_embed(self) -> discord.Embed:
-        page_contents = self.source.get_page_contents(self.current_page)
+        page_contents = await discord.utils.maybe_coroutine(
+            self.source.get_page_contents, self.current_page
+        )
         return await discord.utils.maybe_coroutine(self.source.format_page, page_contents, self)
 
     def update_button_states(self) -> None:
@@ -298,6 +353,8 @@ class AbstractOptionPromptView(discord.ui.View):
             await self.command.edit(content=self.initial_msg, embed=self.initial_embed, view=self)
 
     async def prompt(self):
+        # The connection is idle for as long as the user takes to answer
+        self.command.client.lease_tracker.warn_held_across_prompt(self.command)
         await self.send_initial_message()
         # Wait until the view times out or user clicks a button
         await self.wait()
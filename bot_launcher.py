@@ -1,24 +1,30 @@
 import os
+import math
 import time
 import json
+import psutil
 import aiohttp
 import asyncio
 import logging
+import datetime
+import aioredis
+import jsonpickle
+import contextlib
 import multiprocessing
 import signal
+import socket
 
 from bot.bot import BotClient
+from core import ipc_classes
+from core import revision
 from core import static
+from core import async_logging
+from core.ipc_transport import create_transport
+from core.shared_prices import SharedPriceTable
 
 
-LOG_FORMATTER = logging.Formatter("[%(asctime)s %(name)s/%(levelname)s] %(message)s")
 log = logging.getLogger("Launcher")
 log.setLevel(logging.DEBUG)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(LOG_FORMATTER)
-file_handler = logging.FileHandler("./logs/launcher.log", encoding="utf-8")
-file_handler.setFormatter(LOG_FORMATTER)
-log.handlers = [stream_handler, file_handler]
 
 
 CLUSTER_NAMES = (
@@ -29,13 +35,44 @@ CLUSTER_NAMES = (
     "Indigo", "Jasmine", "Lettuce", "Lime",
     "Mango", "Mushroom", "Nectarine", "Olive"
 )
-NAMES = iter(CLUSTER_NAMES)
+
+
+def generate_cluster_names():
+    """Yields cluster names endlessly: Apple, ..., Olive, Apple2, ..., Olive2, Apple3..."""
+    cycle = 1
+    while True:
+        suffix = str(cycle) if cycle > 1 else ""
+        for name in CLUSTER_NAMES:
+            yield name + suffix
+        cycle += 1
+
+
+NAMES = generate_cluster_names()
 
 
 class Launcher:
     def __init__(self, loop) -> None:
-        log.info("Launching...")
         self.config = self._load_config()
+        self.launcher_config = self.config['launcher']
+
+        log.handlers = [
+            async_logging.create_queue_handler(
+                [
+                    logging.StreamHandler(),
+                    logging.FileHandler("./logs/launcher.log", encoding="utf-8")
+                ],
+                self.config.get("logging")
+            )
+        ]
+        # Shared by the launcher side loggers of all clusters
+        self.cluster_log_handler = async_logging.create_queue_handler(
+            [
+                logging.StreamHandler(),
+                logging.FileHandler("./logs/cluster-Launcher.log", encoding="utf-8")
+            ],
+            self.config.get("logging")
+        )
+        log.info("Launching...")
 
         self.cluster_queue = []
         self.clusters = []
@@ -46,12 +83,54 @@ class Launcher:
 
         self.keep_alive = None
         self.init_time = time.perf_counter()
+        # Shards with the same "shard_id % max_concurrency" share an identify bucket
+        self.max_concurrency = 1
+        self.identify_buckets = []
+
+        self.redis = aioredis.from_url(
+            self.config['redis']['host'],
+            password=self.config['redis']['password'],
+            db=self.config['redis']['db-index']
+        )
+        self.rolling_restart_task = None
+        self.mp_context = self._create_mp_context()
+
+        # Created before any cluster starts, so that they can map it
+        self.shared_prices = SharedPriceTable(
+            self.launcher_config['shared-prices-path'], writable=True
+        )
+        self.shared_prices_task = None
+
+    def _create_mp_context(self):
+        start_method = self.launcher_config['start-method']
+        if start_method not in multiprocessing.get_all_start_methods():
+            log.warning(f"Start method {start_method} is not available, using the default one")
+            return multiprocessing.get_context()
+
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # Clusters are forked from a template that has already imported the heavy third
+            # party packages, the memory pages are shared copy-on-write. The server lives as
+            # long as the launcher, so this repository's modules are never preloaded,
+            # otherwise restarted clusters would keep running the code and the items
+            # from when the launcher started.
+            preload = []
+            for module in self.launcher_config['forkserver-preload']:
+                if module.split(".")[0] in ("bot", "core"):
+                    log.warning(f"Not preloading {module}, as it would be stale after updates")
+                else:
+                    preload.append(module)
+
+            context.set_forkserver_preload(preload)
+
+        return context
 
     def _load_config(self) -> dict:
         with open(static.CONFIG_PATH, "r") as file:
             return json.load(file)
 
-    async def get_shard_count(self) -> int:
+    async def get_gateway_info(self) -> tuple:
+        """Returns the recommended shard count and the identify max concurrency"""
         headers = {
             "Authorization": "Bot " + self.config['bot']['discord-token'],
             "User-Agent": f"Discord Farm Bot {self.config['bot']['version']} ({static.GIT_REPO})"
@@ -65,11 +144,13 @@ class Launcher:
             log.critical(f"Discord returned: {resp.status}")
             self.loop.stop()
 
+        shard_count = json_body['shards']
+        max_concurrency = json_body['session_start_limit']['max_concurrency']
         log.info(
-            f"Successfully got shard count of {json_body['shards']} "
-            f"({resp.status}, {resp.reason})"
+            f"Successfully got shard count of {shard_count} and "
+            f"max concurrency of {max_concurrency} ({resp.status}, {resp.reason})"
         )
-        return json_body['shards']
+        return shard_count, max_concurrency
 
     def start(self) -> None:
         self.fut = asyncio.ensure_future(self.startup(), loop=self.loop)
@@ -90,15 +171,84 @@ class Launcher:
             self.keep_alive = self.loop.create_task(self.rebooter())
             self.keep_alive.add_done_callback(self.task_complete)
 
+    def plan_shards_per_cluster(self, shard_count: int) -> int:
+        """
+        Picks the amount of shards per cluster process from the CPU core count,
+        the target guild count per process and the memory budget of this host.
+        """
+        override = self.launcher_config['shards-per-cluster']
+        if override:
+            log.info(f"Using host override of {override} shards per cluster")
+            return override
+
+        cores = os.cpu_count() or 1
+        guilds_per_shard = self.launcher_config['estimated-guilds-per-shard']
+        shards_per_cluster = max(1, self.launcher_config['guilds-per-cluster'] // guilds_per_shard)
+        # Enough clusters to stay below the guild target, but also use all of the cores
+        clusters = max(math.ceil(shard_count / shards_per_cluster), cores)
+
+        memory_budget = self.launcher_config['memory-budget']
+        if not memory_budget:
+            memory_budget = psutil.virtual_memory().available // (1024 * 1024)
+        max_clusters = max(1, memory_budget // self.launcher_config['memory-per-cluster'])
+        if clusters > max_clusters:
+            log.warning(f"Memory budget allows only {max_clusters} of {clusters} clusters")
+            clusters = max_clusters
+
+        clusters = min(clusters, shard_count)
+        shards_per_cluster = math.ceil(shard_count / clusters)
+        log.info(
+            f"Planned {shards_per_cluster} shards per cluster "
+            f"(cores: {cores}, memory budget: {memory_budget}MB)"
+        )
+        return shards_per_cluster
+
+    def _write_shared_prices(self, market_prices: ipc_classes.MarketPrices) -> None:
+        self.shared_prices.write(market_prices.epoch, market_prices.prices)
+        log.info(f"Published market prices epoch {market_prices.epoch} to the clusters")
+
+    async def shared_prices_updater(self) -> None:
+        """Publishes the market prices broadcasted by IPC once for all clusters on this host"""
+        transport = create_transport(
+            self.redis, f"launcher-{socket.gethostname()}", self.config['ipc']
+        )
+        await transport.subscribe(["global"])
+
+        # The current prices, for the clusters that are starting now
+        market_prices = await self.redis.execute_command("GET", static.MARKET_PRICES_KEY)
+        if market_prices:
+            self._write_shared_prices(jsonpickle.decode(market_prices))
+
+        try:
+            async for data in transport.listen():
+                try:
+                    message = jsonpickle.decode(data)
+                except Exception:
+                    continue
+
+                if message.action == "get_prices":
+                    self._write_shared_prices(message.data)
+        finally:
+            await transport.close()
+
     async def startup(self) -> None:
-        shards = list(range(await self.get_shard_count()))
-        size = [shards[x:x + 4] for x in range(0, len(shards), 4)]
+        self.shared_prices_task = self.loop.create_task(self.shared_prices_updater())
+        shard_count, self.max_concurrency = await self.get_gateway_info()
+        self.identify_buckets = [asyncio.Lock() for _ in range(self.max_concurrency)]
+
+        shards = list(range(shard_count))
+        per_cluster = self.plan_shards_per_cluster(shard_count)
+        size = [shards[x:x + per_cluster] for x in range(0, len(shards), per_cluster)]
         log.info(f"Preparing {len(size)} clusters")
 
         for shard_ids in size:
             self.cluster_queue.append(Cluster(self, next(NAMES), shard_ids, len(shards)))
 
-        await self.start_cluster()
+        # Clusters split the global Postgres connection budget by the total cluster count
+        await self.redis.execute_command(
+            "HSET", static.DB_POOL_CLUSTERS_KEY, socket.gethostname(), len(size)
+        )
+        await self.start_clusters()
 
         self.keep_alive = self.loop.create_task(self.rebooter())
         self.keep_alive.add_done_callback(self.task_complete)
@@ -111,12 +261,41 @@ class Launcher:
         if self.keep_alive:
             self.keep_alive.cancel()
 
+        if self.rolling_restart_task:
+            self.rolling_restart_task.cancel()
+        if self.shared_prices_task:
+            self.shared_prices_task.cancel()
+
         for cluster in self.clusters:
             cluster.stop()
 
+        await self.redis.execute_command("HDEL", static.DB_POOL_CLUSTERS_KEY, socket.gethostname())
+        await self.redis.close()
         self.cleanup()
 
+    async def wait_for_cluster_exit(self, timeout: float) -> None:
+        """Waits until any of the cluster processes exits or the timeout passes"""
+        exited = self.loop.create_future()
+
+        def on_exit() -> None:
+            if not exited.done():
+                exited.set_result(None)
+
+        sentinels = [c.process.sentinel for c in self.clusters if c.process.is_alive()]
+        for sentinel in sentinels:
+            self.loop.add_reader(sentinel, on_exit)
+
+        try:
+            await asyncio.wait_for(exited, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for sentinel in sentinels:
+                self.loop.remove_reader(sentinel)
+
     async def rebooter(self) -> None:
+        watchdog_delay = self.launcher_config['watchdog-delay']
+
         while self.alive:
             if not self.clusters:
                 log.warning("All clusters appear to be dead")
@@ -124,6 +303,9 @@ class Launcher:
 
             to_remove = []
             for cluster in self.clusters:
+                if cluster.restarting:
+                    continue  # Managed by the rolling restart
+
                 if not cluster.process.is_alive():
                     if cluster.process.exitcode != 0:
                         # ignore safe exits
@@ -133,28 +315,163 @@ class Launcher:
                         )
                         log.info(f"Restarting cluster#{cluster.name}")
 
-                        await cluster.start()
+                        await self.start_cluster(cluster)
                     else:
                         log.info(f"Cluster#{cluster.name} found dead")
                         to_remove.append(cluster)
                         cluster.stop()  # ensure stopped
 
+                    continue
+
+                unhealthy_reason = cluster.check_health()
+                if unhealthy_reason:
+                    log.warning(f"Cluster#{cluster.name} is unresponsive: {unhealthy_reason}")
+                    log.info(f"Restarting cluster#{cluster.name}")
+
+                    await self.start_cluster(cluster, force=True)
+
             for rem in to_remove:
                 self.clusters.remove(rem)
 
-            await asyncio.sleep(5)
+            await self.wait_for_cluster_exit(watchdog_delay)
+
+    @contextlib.asynccontextmanager
+    async def identify_buckets_locked(self, cluster):
+        """Holds the identify buckets of all of the cluster's shards"""
+        async with contextlib.AsyncExitStack() as stack:
+            # Always locked in the same order, to avoid deadlocks
+            for bucket in sorted(cluster.get_identify_buckets(self.max_concurrency)):
+                await stack.enter_async_context(self.identify_buckets[bucket])
 
-    async def start_cluster(self) -> None:
-        if self.cluster_queue:
-            cluster = self.cluster_queue.pop(0)
+            yield
+
+    async def start_cluster(self, cluster, *, force: bool = False) -> bool:
+        """Starts the cluster, once the identify buckets of all of its shards are free"""
+        async with self.identify_buckets_locked(cluster):
             log.info(f"Starting Cluster#{cluster.name}")
-            await cluster.start()
-            self.clusters.append(cluster)
+            return await cluster.start(force=force)
+
+    def start_rolling_restart(self) -> None:
+        if self.rolling_restart_task and not self.rolling_restart_task.done():
+            log.warning("Rolling restart requested, while one is already in progress")
+            return
+
+        self.rolling_restart_task = self.loop.create_task(self.rolling_restart())
+
+    def _group_by_identify_buckets(self) -> list:
+        """Groups clusters into batches, where shards of a batch don't share identify buckets"""
+        batches = []
+
+        for cluster in self.clusters:
+            buckets = cluster.get_identify_buckets(self.max_concurrency)
+
+            for batch_buckets, batch in batches:
+                if batch_buckets.isdisjoint(buckets):
+                    batch_buckets.update(buckets)
+                    batch.append(cluster)
+                    break
+            else:
+                batches.append((set(buckets), [cluster]))
+
+        return [batch for _, batch in batches]
+
+    async def _publish_rolling_restart_status(self, status: ipc_classes.RollingRestartStatus):
+        try:
+            await self.redis.execute_command(
+                "SET", static.ROLLING_RESTART_STATUS_KEY, jsonpickle.encode(status), "EX", 86400
+            )
+        except Exception:
+            log.exception("Failed to publish the rolling restart status")
+
+    async def _restart_cluster_gracefully(self, cluster) -> bool:
+        async with self.identify_buckets_locked(cluster):
+            log.info(f"Rolling restart of Cluster#{cluster.name}")
+            await cluster.stop_gracefully()
+            # Only this cluster's shards were down, so the guard can be shorter
+            return await cluster.start(
+                force=True,
+                farm_guard_duration=self.launcher_config['rolling-restart-farm-guard-duration']
+            )
+
+    async def rolling_restart(self) -> None:
+        """
+        Restarts the clusters batch by batch, while the other ones keep serving.
+        The clusters start with config.json read again and the code on disk, the rollout
+        stops if a restarted cluster does not report the code revision on disk.
+        """
+        self.config = self._load_config()
+        self.launcher_config = self.config['launcher']
+        for cluster in self.clusters:
+            cluster.kwargs['config'] = self.config
+
+        expected_revision = await self.loop.run_in_executor(None, revision.get_code_revision)
+        log.info(f"Deploying code revision {expected_revision}")
+
+        batches = self._group_by_identify_buckets()
+        status = ipc_classes.RollingRestartStatus(
+            started=datetime.datetime.now(),
+            finished=None,
+            total=len(self.clusters),
+            current=[],
+            restarted=[],
+            failed=[]
+        )
+        log.info(f"Starting a rolling restart of {status.total} clusters in {len(batches)} batches")
+
+        for batch in batches:
+            status.current = [c.name for c in batch]
+            await self._publish_rolling_restart_status(status)
+
+            for cluster in batch:
+                cluster.restarting = True
+            try:
+                results = await asyncio.gather(
+                    *[self._restart_cluster_gracefully(c) for c in batch]
+                )
+            finally:
+                for cluster in batch:
+                    cluster.restarting = False
+
+            outdated = False
+            for cluster, success in zip(batch, results):
+                if success and expected_revision and cluster.revision != expected_revision:
+                    cluster.log.error(
+                        f"Restarted with code revision {cluster.revision}, "
+                        f"instead of {expected_revision}"
+                    )
+                    success = False
+                    outdated = True
+
+                if success:
+                    status.restarted.append(cluster.name)
+                else:
+                    status.failed.append(cluster.name)
+
+            if outdated:
+                log.error("Stopping the rolling restart, the clusters don't run the deployed code")
+                break
+
+        status.current = []
+        status.finished = datetime.datetime.now()
+        await self._publish_rolling_restart_status(status)
+        log.info(
+            f"Rolling restart finished in {status.finished - status.started}, "
+            f"failed clusters: {status.failed}"
+        )
 
-            log.info("Done!")
-            await self.start_cluster()
-        else:
-            log.info("All clusters launched")
+    async def start_clusters(self) -> None:
+        """Starts all of the queued clusters concurrently"""
+        start_time = time.perf_counter()
+        clusters, self.cluster_queue = self.cluster_queue, []
+
+        await asyncio.gather(*[self.start_cluster(cluster) for cluster in clusters])
+        self.clusters.extend(clusters)
+
+        timings = ", ".join(f"{c.name}: {c.ready_time:.2f}s" for c in clusters)
+        log.info(
+            f"All clusters launched in {time.perf_counter() - start_time:.2f}s "
+            f"(ready times - {timings})"
+        )
 
 
 class Cluster:
@@ -168,20 +485,35 @@ class Cluster:
             config=launcher.config
         )
         self.name = name
+        self.shard_ids = shard_ids
+        self.ready_time = 0.0
+        self.restarting = False
+        # Code revision reported by the current process
+        self.revision = None
+
+        watchdog_config = launcher.config['launcher']
+        self.heartbeat_timeout = watchdog_config['heartbeat-timeout']
+        self.max_loop_lag = watchdog_config['max-loop-lag']
+        self.max_loop_lag_duration = watchdog_config['max-loop-lag-duration']
+        self.pipe = None
+        self.ready_future = None
+        self.last_heartbeat = None
+        self.loop_lag = 0.0
+        self.loop_lag_exceeded_since = None
+        self.last_interaction = None
 
         self.log = logging.getLogger(f"Cluster#{name}")
         self.log.setLevel(logging.DEBUG)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(LOG_FORMATTER)
-        file_handler = logging.FileHandler("./logs/cluster-Launcher.log", encoding="utf-8")
-        file_handler.setFormatter(LOG_FORMATTER)
-        self.log.handlers = [stream_handler, file_handler]
+        self.log.handlers = [launcher.cluster_log_handler]
         self.log.info(f"Initialized with shard ids {shard_ids}, total shards {max_shards}")
 
     def wait_close(self) -> None:
         self.process.join()
 
-    async def start(self, *, force=False) -> bool:
+    def get_identify_buckets(self, max_concurrency: int) -> set:
+        return {x % max_concurrency for x in self.shard_ids}
+
+    async def start(self, *, force=False, farm_guard_duration: int = None) -> bool:
         if self.process and self.process.is_alive():
             if not force:
                 self.log.warning(
@@ -190,23 +522,118 @@ class Cluster:
                 return False
 
             self.log.info("Terminating existing process")
-            self.process.terminate()
-            self.process.close()
+            await self._terminate()
 
-        stdout, stdin = multiprocessing.Pipe()
+        self._close_pipe()
+        self.ready_future = self.launcher.loop.create_future()
+        self.last_heartbeat = None
+        self.loop_lag_exceeded_since = None
+        self.revision = None
+
+        start_time = time.perf_counter()
+        stdout, stdin = self.launcher.mp_context.Pipe()
         kwargs = self.kwargs
         kwargs['pipe'] = stdin
+        kwargs['farm_guard_duration'] = farm_guard_duration
 
-        self.process = multiprocessing.Process(target=BotClient, kwargs=kwargs, daemon=True)
+        self.process = self.launcher.mp_context.Process(
+            target=BotClient, kwargs=kwargs, daemon=True
+        )
         self.process.start()
+        # Only the child needs this end, so that we get EOF if it dies
+        stdin.close()
         self.log.info(f"Process started with PID {self.process.pid}")
 
-        if await self.launcher.loop.run_in_executor(None, stdout.recv) == 1:
-            stdout.close()
-            self.log.info("Process started successfully")
+        self._listen_pipe(stdout)
+        if not await self.ready_future:
+            self.log.error("Process exited before becoming ready")
+            return False
 
+        self.ready_time = time.perf_counter() - start_time
+        # The watchdog starts watching only from now on
+        self.last_heartbeat = time.monotonic()
+        self.log.info(f"Process started successfully in {self.ready_time:.2f}s")
         return True
 
+    async def _terminate(self) -> None:
+        self.process.terminate()
+        await self.launcher.loop.run_in_executor(None, self.process.join, 10)
+
+        if self.process.is_alive():
+            self.log.warning("Process did not terminate, killing it")
+            self.process.kill()
+            await self.launcher.loop.run_in_executor(None, self.process.join)
+
+        self.process.close()
+
+    async def stop_gracefully(self, timeout: float = 60) -> None:
+        if not self.process or not self.process.is_alive():
+            return
+
+        self.stop()
+        await self.launcher.loop.run_in_executor(None, self.process.join, timeout)
+
+    def _listen_pipe(self, pipe) -> None:
+        """Reads the ready and heartbeat messages, without blocking a thread for it"""
+        self.pipe = pipe
+        self.launcher.loop.add_reader(pipe.fileno(), self._on_pipe_readable)
+
+    def _close_pipe(self) -> None:
+        if self.pipe is None:
+            return
+
+        self.launcher.loop.remove_reader(self.pipe.fileno())
+        self.pipe.close()
+        self.pipe = None
+
+    def _on_pipe_readable(self) -> None:
+        try:
+            message = self.pipe.recv()
+        except (EOFError, OSError):
+            # The process has exited
+            self._close_pipe()
+            if not self.ready_future.done():
+                self.ready_future.set_result(False)
+            return
+
+        if isinstance(message, tuple) and message[0] == "revision":
+            self.revision = message[1]
+        elif message == 1:
+            if not self.ready_future.done():
+                self.ready_future.set_result(True)
+        elif isinstance(message, ipc_classes.ClusterHeartbeat):
+            self._handle_heartbeat(message)
+        elif message == "rolling_restart":
+            self.log.info("Requested a rolling restart")
+            self.launcher.start_rolling_restart()
+
+    def _handle_heartbeat(self, heartbeat: ipc_classes.ClusterHeartbeat) -> None:
+        now = time.monotonic()
+        self.last_heartbeat = now
+        self.loop_lag = heartbeat.loop_lag
+        self.last_interaction = heartbeat.last_interaction
+
+        if self.loop_lag <= self.max_loop_lag:
+            self.loop_lag_exceeded_since = None
+        elif self.loop_lag_exceeded_since is None:
+            self.loop_lag_exceeded_since = now
+            self.log.warning(f"Event loop lag of {self.loop_lag:.2f}s")
+
+    def check_health(self) -> str:
+        """Returns the reason, why this cluster should be restarted, if it is unhealthy"""
+        if self.last_heartbeat is None:
+            return None  # Still starting up
+
+        now = time.monotonic()
+        if now - self.last_heartbeat > self.heartbeat_timeout:
+            return f"no heartbeat for {now - self.last_heartbeat:.0f}s"
+
+        if self.loop_lag_exceeded_since is not None \
+                and now - self.loop_lag_exceeded_since > self.max_loop_lag_duration:
+            return f"event loop lag above {self.max_loop_lag}s for {self.max_loop_lag_duration}s"
+
+        return None
+
     def stop(self, sign=signal.SIGINT) -> None:
         self.log.info(f"Shutting down with signal {sign!r}")
         try:
@@ -0,0 +1,124 @@
+"""
+Non-blocking logging for the launcher, IPC and cluster processes.
+Records are put on a queue by the logging call and written to the file and the
+stream by a background listener thread, so a slow disk never blocks the event loop.
+
+Structured fields can be attached with: log.info("Message", extra={"fields": {"key": value}})
+High frequency records can be marked with extra={"sample": True}, those are then sampled
+with the rate configured for their logger in the "logging" config section.
+"""
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+
+LOG_FORMAT = "[%(asctime)s %(name)s/%(levelname)s] %(message)s"
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Appends the structured fields of the record as key=value pairs"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+
+        if fields:
+            pairs = " ".join(f"{key}={value}" for key, value in fields.items())
+            # Keep the traceback, if any, at the end
+            first_line, newline, rest = message.partition("\n")
+            message = f"{first_line} {pairs}{newline}{rest}"
+
+        return message
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through only every n-th record marked for sampling, per logger"""
+
+    def __init__(self, sample_rates: dict) -> None:
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.counters = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False) or record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.sample_rates.get(record.name, 1)
+        if rate <= 1:
+            return True
+
+        count = self.counters.get(record.name, 0)
+        self.counters[record.name] = count + 1
+        return count % rate == 0
+
+
+class DuplicateFilter(logging.Filter):
+    """
+    Suppresses identical records repeated within the window.
+    The first record after the window carries the count of the suppressed ones.
+    """
+    max_tracked = 1024
+
+    def __init__(self, window: float) -> None:
+        super().__init__()
+        self.window = window
+        # (logger, level, message, fields) -> [window start, suppressed count]
+        self.seen = {}
+
+    def _prune(self, now: float) -> None:
+        self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.window}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.window <= 0:
+            return True
+
+        now = time.monotonic()
+        fields = getattr(record, "fields", None)
+        key = (record.name, record.levelno, record.getMessage(), repr(fields))
+        entry = self.seen.get(key)
+
+        if entry is not None and now - entry[0] < self.window:
+            entry[1] += 1
+            return False
+
+        if entry is not None and entry[1]:
+            record.fields = {**(fields or {}), "suppressed": entry[1]}
+
+        if len(self.seen) >= self.max_tracked:
+            self._prune(now)
+        self.seen[key] = [now, 0]
+        return True
+
+
+def create_queue_handler(handlers: list, config: dict = None) -> QueueHandler:
+    """
+    Creates a queue handler, that passes the records to the handlers from a listener thread.
+    The listener is flushed and stopped at exit, or with stop_queue_handler.
+    """
+    config = config or {}
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    # Merges the message and the fields before the record gets queued,
+    # the handlers then only add the prefix
+    queue_handler.setFormatter(KeyValueFormatter("%(message)s"))
+    queue_handler.addFilter(SamplingFilter(config.get("sample-rates", {})))
+    queue_handler.addFilter(DuplicateFilter(config.get("duplicate-window", 0)))
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    queue_handler.listener = listener
+    atexit.register(stop_queue_handler, queue_handler)
+
+    return queue_handler
+
+
+def stop_queue_handler(queue_handler: QueueHandler) -> None:
+    """Writes out the queued records and stops the listener thread"""
+    listener = queue_handler.listener
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,71 @@
+"""
+Registry of the active clusters, kept in a Redis hash of cluster name -> cluster status.
+Every cluster writes its own entry when pinging and any process can read the entries on demand.
+Entries expire when a cluster has not pinged for the inactive timeout.
+"""
+import datetime
+import jsonpickle
+
+from core import ipc_classes
+
+
+class ClusterRegistry:
+
+    __slots__ = ("redis", "inactive_timeout")
+
+    key = "cluster_registry"
+
+    def __init__(self, redis, inactive_timeout: int) -> None:
+        self.redis = redis
+        self.inactive_timeout = inactive_timeout
+
+    def _is_expired(self, cluster: ipc_classes.Cluster) -> bool:
+        delta_time = datetime.datetime.now() - cluster.last_ping
+        return delta_time.total_seconds() >= self.inactive_timeout
+
+    async def update(self, cluster: ipc_classes.Cluster) -> None:
+        await self.redis.execute_command(
+            "HSET", self.key, cluster.name, jsonpickle.encode(cluster)
+        )
+        # If every cluster is gone, the whole registry goes too
+        await self.redis.execute_command("EXPIRE", self.key, self.inactive_timeout)
+
+    async def remove(self, name: str) -> None:
+        await self.redis.execute_command("HDEL", self.key, name)
+
+    async def get(self, name: str) -> ipc_classes.Cluster:
+        data = await self.redis.execute_command("HGET", self.key, name)
+        if not data:
+            return None
+
+        cluster = jsonpickle.decode(data)
+        return cluster if not self._is_expired(cluster) else None
+
+    async def get_all(self) -> list:
+        """Fetches all active clusters, removing the expired entries"""
+        entries = await self.redis.execute_command("HGETALL", self.key)
+
+        clusters, expired = [], []
+        for name, data in entries.items():
+            cluster = jsonpickle.decode(data)
+
+            if self._is_expired(cluster):
+                expired.append(name)
+            else:
+                clusters.append(cluster)
+
+        if expired:
+            await self.redis.execute_command("HDEL", self.key, *expired)
+
+        return sorted(clusters, key=lambda c: c.name)
+
+    async def get_totals(self) -> ipc_classes.ClusterTotals:
+        return self.count_totals(await self.get_all())
+
+    @staticmethod
+    def count_totals(clusters: list) -> ipc_classes.ClusterTotals:
+        return ipc_classes.ClusterTotals(
+            cluster_count=len(clusters),
+            guild_count=sum(c.guild_count for c in clusters),
+            shard_count=sum(len(c.latencies) for c in clusters)
+        )
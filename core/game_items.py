@@ -467,6 +467,26 @@ class ItemPool:
             if isinstance(item, MarketItem):
                 item.generate_new_price()
 
+    def get_market_prices(self) -> list:
+        """Current market prices as a list of tuples with item IDs and prices"""
+        return [(x.id, x.gold_reward) for x in self.all_items if isinstance(x, MarketItem)]
+
+    def set_market_prices(self, prices: list) -> bool:
+        """
+        Applies market prices from get_market_prices of another pool.
+        Returns False without changing anything, if the market items of the pools differ.
+        """
+        prices = dict(prices)
+        market_items = [x for x in self.all_items if isinstance(x, MarketItem)]
+
+        if len(market_items) != len(prices) or any(x.id not in prices for x in market_items):
+            return False
+
+        for item in market_items:
+            item.gold_reward = prices[item.id]
+
+        return True
+
     def get_random_items(
         self,
         user_level: int,
@@ -500,6 +520,11 @@ class ItemPool:
             # If extra luck is 1 (max), then all items have equal weights
             new_weights[i] = (max_weight + 1.0) - (weights[i] - (weights[i] * extra_luck))
 
+        # If multiplier, lower the chance to get more items
+        product_amounts = []
+        for i in range(products_multiplier):
+            product_amounts.extend([i + 1] * (products_multiplier - i) * 2)
+
         rewards = {}
         for item in random.choices(population, weights=new_weights, k=total_draws):
             # Generate amounts
@@ -519,12 +544,7 @@ class ItemPool:
                 max_amount *= growables_multiplier
                 amount = random.randint(min_amount, max_amount)
             else:
-                # If multiplier, lower the chance to get more items
-                population = []
-                for i in range(products_multiplier):
-                    population.extend([i + 1] * (products_multiplier - i) * 2)
-
-                amount = random.choice(population)
+                amount = random.choice(product_amounts)
 
             try:
                 rewards[item] += amount
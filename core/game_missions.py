@@ -121,6 +121,21 @@ class BusinessMission:
             chest=chest_id
         )
 
+    @classmethod
+    def from_record(cls, record):
+        """Partial mission from a missions table row"""
+        return cls(
+            requests=[tuple(x) for x in record['requests']],
+            gold_reward=record['gold_reward'],
+            xp_reward=record['xp_reward'],
+            name=record['name'],
+            chest=record['chest']
+        )
+
+    def to_record(self) -> tuple:
+        """Partial mission as the business_mission database type"""
+        return (self.name, self.requests, self.gold_reward, self.xp_reward, self.chest)
+
     def initialize_from_partial_data(self, cmd) -> None:
         self.requests = [
             (cmd.items.find_item_by_id(request[0]), request[1])
@@ -3,6 +3,7 @@ import datetime
 import jsonpickle
 
 from bot.commands.util import exceptions
+from core import queries
 from core.game_items import GameItem
 
 
@@ -160,47 +161,35 @@ class User:
 
     async def get_all_items(self, conn) -> list:
         """Fetches all items currently in inventory"""
-        query = "SELECT * FROM inventory WHERE user_id = $1 ORDER BY item_id;"
-        return await conn.fetch(query, self.user_id)
+        return await queries.fetch(conn, queries.GET_ALL_ITEMS, self.user_id)
 
     async def get_item(self, item_id: int, conn) -> asyncpg.Record:
         """Fetches a single item currently in inventory"""
-        query = "SELECT * FROM inventory WHERE user_id = $1 AND item_id = $2;"
-        return await conn.fetchrow(query, self.user_id, item_id)
+        return await queries.fetchrow(conn, queries.GET_ITEM, self.user_id, item_id)
 
     async def give_item(self, item_id: int, amount: int, conn) -> None:
         """Adds a single type of items to inventory"""
-        query = """
-                INSERT INTO inventory(user_id, item_id, amount)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (user_id, item_id)
-                DO UPDATE
-                SET amount = inventory.amount + $3;
-                """
-        await conn.execute(query, self.user_id, item_id, amount)
+        await queries.execute(conn, queries.GIVE_ITEM, self.user_id, item_id, amount)
 
     async def give_items(self, items_and_amounts: list, conn) -> None:
         """Adds items to user. Accepts a list of tuples with items IDs and amounts"""
-        items_with_user_id = []
+        amounts_by_id = {}
         for item, amount in items_and_amounts:
             if isinstance(item, GameItem):
                 item = item.id
-            items_with_user_id.append((self.user_id, item, amount))
-
-        query = """
-                INSERT INTO inventory(user_id, item_id, amount)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (user_id, item_id)
-                DO UPDATE
-                SET amount = inventory.amount + $3;
-                """
-        await conn.executemany(query, items_with_user_id)
+            amounts_by_id[item] = amounts_by_id.get(item, 0) + amount
+
+        await queries.execute(
+            conn,
+            queries.GIVE_ITEMS,
+            self.user_id,
+            list(amounts_by_id.keys()),
+            list(amounts_by_id.values())
+        )
 
     async def remove_item(self, item_id: int, amount: int, conn) -> None:
         """Removes a single type of items from inventory"""
-        # See schema.sql for the procedure
-        query = "CALL remove_item($1, $2, $3);"
-        await conn.execute(query, self.user_id, item_id, amount)
+        await queries.execute(conn, queries.REMOVE_ITEM, self.user_id, item_id, amount)
 
     async def remove_items(self, items_and_amounts: list, conn) -> None:
         """Removes multiple type of items from inventory"""
@@ -210,24 +199,19 @@ class User:
                 item = item.id
             items_with_user_id.append((self.user_id, item, amount))
 
-        # See schema.sql for the procedure
-        query = "CALL remove_item($1, $2, $3);"
-        await conn.executemany(query, items_with_user_id)
+        await queries.executemany(conn, queries.REMOVE_ITEM, items_with_user_id)
 
     async def get_item_modification(self, item_id: int, conn) -> asyncpg.Record:
         """Fetches item modifications data for a single item"""
-        query = "SELECT * FROM modifications WHERE user_id = $1 AND item_id = $2;"
-        return await conn.fetchrow(query, self.user_id, item_id)
+        return await queries.fetchrow(conn, queries.GET_ITEM_MODIFICATION, self.user_id, item_id)
 
     async def get_farm_field(self, conn) -> list:
         """Fetches all items currently in farm"""
-        query = "SELECT * FROM farm WHERE user_id = $1 ORDER BY item_id;"
-        return await conn.fetch(query, self.user_id)
+        return await queries.fetch(conn, queries.GET_FARM_FIELD, self.user_id)
 
     async def get_factory(self, conn) -> list:
         """Fetches all items currently in factory"""
-        query = "SELECT * from factory WHERE user_id = $1 ORDER by starts;"
-        return await conn.fetch(query, self.user_id)
+        return await queries.fetch(conn, queries.GET_FACTORY, self.user_id)
 
 
 class UserManager:
@@ -250,8 +234,7 @@ class UserManager:
         else:
             release_required = False
 
-        query = "SELECT * FROM profile WHERE user_id = $1;"
-        user_data = await conn.fetchrow(query, user_id)
+        user_data = await queries.fetchrow(conn, queries.GET_PROFILE, user_id)
 
         if release_required:
             await self.db_pool.release(conn)
@@ -303,20 +286,9 @@ class UserManager:
         else:
             release_required = False
 
-        query = """
-                UPDATE profile SET
-                xp = $1,
-                gold = $2,
-                gems = $3,
-                farm_slots = $4,
-                factory_slots = $5,
-                factory_level = $6,
-                store_slots = $7,
-                notifications = $8
-                WHERE user_id = $9
-                """
-        await conn.execute(
-            query,
+        await queries.execute(
+            conn,
+            queries.UPDATE_PROFILE,
             user.xp,
             user.gold,
             user.gems,
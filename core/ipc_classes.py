@@ -1,6 +1,16 @@
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 
+# Actions, that change a persistent state and must be delivered even after a long IPC outage.
+# The other actions are requests, replies and admin broadcasts, that are pointless to replay.
+DURABLE_ACTIONS = (
+    "add_reminder",
+    "stop_reminders",
+    "start_reminders",
+    "del_reminders",
+    "enable_guard"
+)
+
 
 @dataclass
 class IPCMessage:
@@ -10,12 +20,23 @@ class IPCMessage:
         "action",
         "reply_global",
         "data",
+        "correlation_id"
     )
 
     author: str
     action: str
     reply_global: bool
     data: dict
+    # Set for request/response style messages, replies carry the same ID
+    correlation_id: str
+
+    def __getattr__(self, name: str):
+        # Messages pickled by the processes, that predate the correlation IDs, don't have
+        # the slot set. A slot can't have a class level default, so it is resolved here.
+        if name == "correlation_id":
+            return None
+
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
 
 
 @dataclass
@@ -54,3 +75,111 @@ class Reminder:
     item_id: int
     amount: int
     time: datetime
+
+
+@dataclass
+class ClusterTotals:
+
+    __slots__ = (
+        "cluster_count",
+        "guild_count",
+        "shard_count"
+    )
+
+    cluster_count: int
+    guild_count: int
+    shard_count: int
+
+
+@dataclass
+class ClusterHeartbeat:
+
+    __slots__ = (
+        "loop_lag",
+        "last_interaction",
+        "sent_at"
+    )
+
+    loop_lag: float
+    last_interaction: float
+    sent_at: float
+
+
+@dataclass
+class RollingRestartStatus:
+
+    __slots__ = (
+        "started",
+        "finished",
+        "total",
+        "current",
+        "restarted",
+        "failed"
+    )
+
+    started: datetime
+    finished: datetime
+    total: int
+    current: list
+    restarted: list
+    failed: list
+
+
+@dataclass
+class MarketPrices:
+
+    __slots__ = (
+        "epoch",
+        "prices"
+    )
+
+    epoch: int
+    prices: list
+
+
+@dataclass
+class StartupReport:
+
+    __slots__ = (
+        "cluster_name",
+        "phases",
+        "lazy_extensions",
+        "total"
+    )
+
+    cluster_name: str
+    # Phase name -> duration in seconds, in the order they were run
+    phases: dict
+    lazy_extensions: list
+    total: float
+
+
+@dataclass
+class ClusterMetrics:
+
+    __slots__ = (
+        "loop_lag",
+        "db_pool_size",
+        "db_pool_max_size",
+        "db_pool_idle",
+        "db_acquire_wait",
+        "db_leases",
+        "db_leases_force_released",
+        "redis_latency",
+        "statement_stats",
+        "command_stats"
+    )
+
+    loop_lag: float
+    db_pool_size: int
+    db_pool_max_size: int
+    db_pool_idle: int
+    # LatencyHistogram of the pool acquire waits
+    db_acquire_wait: object
+    db_leases: int
+    db_leases_force_released: int
+    # Duration of the last cluster registry update, in seconds
+    redis_latency: float
+    # Statement name -> LatencyHistogram
+    statement_stats: dict
+    command_stats: object
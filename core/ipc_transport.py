@@ -0,0 +1,263 @@
+"""
+Transports used to deliver IPC messages between the IPC process and the clusters.
+The transport is selected with the "transport" key in the "ipc" config section.
+"""
+import os
+import time
+import socket
+import fnmatch
+import aioredis
+
+
+class PubSubTransport:
+    """Fire-and-forget Redis pub/sub. Messages published while nobody is listening are lost."""
+
+    def __init__(self, redis, reader_name: str) -> None:
+        self.redis = redis
+        self.reader_name = reader_name
+        self.pubsub = redis.pubsub()
+        self.channels = []
+        self.patterns = []
+
+    async def subscribe(self, channels: list, patterns: list = None) -> None:
+        self.channels = list(channels)
+        self.patterns = list(patterns or [])
+
+        if self.channels:
+            await self.pubsub.subscribe(*self.channels)
+        if self.patterns:
+            await self.pubsub.psubscribe(*self.patterns)
+
+    async def unsubscribe(self) -> None:
+        if self.channels:
+            await self.pubsub.unsubscribe(*self.channels)
+        if self.patterns:
+            await self.pubsub.punsubscribe(*self.patterns)
+
+    async def publish(self, channel: str, payload: str, durable: bool = False) -> None:
+        # Nothing is stored, so durable messages are as lossy as the rest
+        await self.redis.publish(channel, payload)
+
+    async def listen(self):
+        """Yields the raw payloads of the received messages"""
+        async for message in self.pubsub.listen():
+            if message['type'] != "message" and message['type'] != "pmessage":
+                continue
+
+            yield message['data']
+
+    async def close(self) -> None:
+        await self.pubsub.close()
+
+
+class StreamsTransport:
+    """
+    Redis Streams with a consumer group per reader. Every channel is a capped stream, read by
+    the groups of all of its readers, so every reader gets all of the messages. The processes
+    of a reader are separate consumers of its group, so a restarted process reclaims the
+    entries left pending by its dead predecessor. Groups of readers, that have not been seen
+    for group_max_idle seconds, are destroyed by the other readers of the stream.
+
+    Durable messages are acknowledged after they have been handled and are always delivered,
+    also after a long outage. The other messages are acknowledged before they are handled,
+    so these are never replayed after a crash, and are dropped if older than max_age.
+    """
+    stream_prefix = "ipc:"
+    # Set of all of the stream keys, for finding the streams of the channel patterns
+    streams_key = "ipc:streams"
+    # Reader group name -> consumer name of its latest process, expires if the reader is gone
+    reader_key_prefix = "ipc:reader:"
+    # Seconds between the reclaims of the pending entries and the pruning of dead consumers
+    maintenance_delay = 10
+    # Miliseconds to wait for new entries, the pattern streams are discovered in between
+    block_ms = 1000
+
+    def __init__(
+        self,
+        redis,
+        reader_name: str,
+        max_length: int,
+        max_age: int,
+        reclaim_idle: int,
+        group_max_idle: int
+    ) -> None:
+        self.redis = redis
+        self.reader_name = reader_name
+        self.group = reader_name
+        self.consumer = f"{reader_name}:{socket.gethostname()}:{os.getpid()}"
+        self.max_length = max_length
+        self.max_age_ms = max_age * 1000
+        self.reclaim_idle_ms = reclaim_idle * 1000
+        self.group_max_idle = group_max_idle
+        self.channels = []
+        self.patterns = []
+        # Stream key -> last seen ID, ">" for new messages
+        self.streams = {}
+        # Stream keys, that this process has already registered for the discovery
+        self.published = set()
+        self.last_maintenance = 0
+        self.closed = False
+
+    def _stream_key(self, channel: str) -> str:
+        return self.stream_prefix + channel
+
+    async def _create_group(self, stream: str, start_id: str) -> None:
+        try:
+            await self.redis.xgroup_create(stream, self.group, id=start_id, mkstream=True)
+        except aioredis.ResponseError as e:
+            # The group already exists, we continue from where we left off
+            if "BUSYGROUP" not in str(e):
+                raise e
+
+    async def _add_stream(self, stream: str, start_id: str) -> None:
+        await self._create_group(stream, start_id)
+        self.streams[stream] = ">"
+
+    async def _discover_pattern_streams(self) -> None:
+        if not self.patterns:
+            return
+
+        for key in await self.redis.smembers(self.streams_key):
+            key = key.decode("utf-8")
+            if key in self.streams:
+                continue
+
+            channel = key[len(self.stream_prefix):]
+            if any(fnmatch.fnmatchcase(channel, x) for x in self.patterns):
+                # Newly discovered streams have to be read from the beginning
+                await self._add_stream(key, "0")
+
+    async def _mark_alive(self) -> None:
+        await self.redis.set(
+            self.reader_key_prefix + self.group, self.consumer, ex=self.group_max_idle
+        )
+
+    async def _reclaim_pending(self, stream: str) -> None:
+        """Claims the entries left behind by the dead consumers of our group"""
+        claimed = False
+        cursor = "0-0"
+        while True:
+            cursor, entries, *_ = await self.redis.execute_command(
+                "XAUTOCLAIM", stream, self.group, self.consumer,
+                self.reclaim_idle_ms, cursor, "JUSTID"
+            )
+            claimed = claimed or bool(entries)
+
+            if cursor in (b"0-0", "0-0"):
+                break
+
+        if claimed:
+            # The claimed entries are then read as our own pending entries
+            self.streams[stream] = "0"
+
+    async def _prune_dead_consumers(self, stream: str) -> None:
+        for consumer in await self.redis.xinfo_consumers(stream, self.group):
+            name = consumer['name'].decode("utf-8")
+            # Their pending entries have already been reclaimed by now
+            if name != self.consumer and consumer['pending'] == 0 \
+                    and consumer['idle'] > self.reclaim_idle_ms:
+                await self.redis.xgroup_delconsumer(stream, self.group, name)
+
+    async def _prune_dead_groups(self, stream: str) -> None:
+        for group in await self.redis.xinfo_groups(stream):
+            name = group['name'].decode("utf-8")
+            if name != self.group and not await self.redis.exists(self.reader_key_prefix + name):
+                await self.redis.xgroup_destroy(stream, name)
+
+    async def _maintenance(self) -> None:
+        self.last_maintenance = time.monotonic()
+        await self._mark_alive()
+
+        for stream in list(self.streams):
+            await self._reclaim_pending(stream)
+            await self._prune_dead_consumers(stream)
+            await self._prune_dead_groups(stream)
+
+    async def subscribe(self, channels: list, patterns: list = None) -> None:
+        self.channels = list(channels)
+        self.patterns = list(patterns or [])
+        # Before creating the groups, so that other readers don't prune them
+        await self._mark_alive()
+
+        for channel in self.channels:
+            # Only new messages, if this reader has never been here
+            await self._add_stream(self._stream_key(channel), "$")
+
+        await self._discover_pattern_streams()
+        await self._maintenance()
+
+    async def unsubscribe(self) -> None:
+        self.closed = True
+
+    async def publish(self, channel: str, payload: str, durable: bool = False) -> None:
+        stream = self._stream_key(channel)
+        if stream not in self.published:
+            await self.redis.sadd(self.streams_key, stream)
+            self.published.add(stream)
+
+        fields = {"data": payload}
+        if durable:
+            fields['durable'] = 1
+
+        await self.redis.xadd(stream, fields, maxlen=self.max_length, approximate=True)
+
+    def _is_expired(self, entry_id: bytes) -> bool:
+        # Stream entry IDs start with the milisecond timestamp of their creation
+        created_ms = int(entry_id.split(b"-")[0])
+        return time.time() * 1000 - created_ms > self.max_age_ms
+
+    async def listen(self):
+        """Yields the raw payloads of the received messages"""
+        while not self.closed:
+            await self._discover_pattern_streams()
+            if time.monotonic() - self.last_maintenance > self.maintenance_delay:
+                await self._maintenance()
+
+            results = await self.redis.xreadgroup(
+                self.group, self.consumer, self.streams, count=100, block=self.block_ms
+            )
+
+            for stream, entries in results or []:
+                stream = stream.decode("utf-8")
+
+                if self.streams[stream] != ">" and not entries:
+                    # All of the pending entries have been processed
+                    self.streams[stream] = ">"
+                    continue
+
+                for entry_id, fields in entries:
+                    if self.streams[stream] != ">":
+                        self.streams[stream] = entry_id
+
+                    # Entries trimmed from the stream while pending have no fields
+                    if not fields:
+                        await self.redis.xack(stream, self.group, entry_id)
+                    elif fields.get(b"durable"):
+                        yield fields[b"data"]
+                        await self.redis.xack(stream, self.group, entry_id)
+                    else:
+                        await self.redis.xack(stream, self.group, entry_id)
+                        if not self._is_expired(entry_id):
+                            yield fields[b"data"]
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def create_transport(redis, reader_name: str, ipc_config: dict):
+    """Creates the IPC transport configured in the "ipc" config section"""
+    transport = ipc_config.get("transport", "pubsub")
+
+    if transport == "pubsub":
+        return PubSubTransport(redis, reader_name)
+    elif transport == "streams":
+        return StreamsTransport(
+            redis,
+            reader_name,
+            max_length=ipc_config['stream-max-length'],
+            max_age=ipc_config['stream-max-age'],
+            reclaim_idle=ipc_config['stream-reclaim-idle'],
+            group_max_idle=ipc_config['stream-group-max-idle']
+        )
+
+    raise ValueError(f"Unknown IPC transport: {transport}")
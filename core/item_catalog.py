@@ -0,0 +1,10 @@
+"""
+Game item catalog, loaded once on import.
+The launcher preloads this module in its forkserver, so that cluster processes are forked
+with the catalog already in memory and share it copy-on-write.
+Market prices here are only placeholders - the current ones are always received from IPC.
+"""
+from core.game_items import load_all_items
+
+
+item_pool = load_all_items()
@@ -0,0 +1,104 @@
+"""
+Mergeable latency histograms of the command stages, recorded by the clusters
+and shipped to IPC with the cluster pings.
+The buckets grow exponentially, so the percentiles are accurate to the bucket growth.
+"""
+import math
+
+
+class LatencyHistogram:
+
+    __slots__ = ("buckets", "count", "errors", "total")
+
+    # Upper bound of the bucket N is: BUCKET_GROWTH ** N miliseconds
+    BUCKET_GROWTH = 1.2
+
+    def __init__(self) -> None:
+        # Keys are strings, to survive the JSON round trip
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def __getstate__(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __setstate__(self, state: dict) -> None:
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def _bucket_index(cls, seconds: float) -> int:
+        ms = seconds * 1000
+        if ms <= 1:
+            return 0
+
+        return math.ceil(math.log(ms, cls.BUCKET_GROWTH))
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        index = str(self._bucket_index(seconds))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket, that contains the percentile, in seconds"""
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+        for index in sorted(self.buckets, key=int):
+            seen += self.buckets[index]
+            if seen >= target:
+                return self.BUCKET_GROWTH ** int(index) / 1000
+
+        return self.BUCKET_GROWTH ** max(int(x) for x in self.buckets) / 1000
+
+
+class CommandStats:
+    """Command full name -> stage -> LatencyHistogram"""
+
+    __slots__ = ("commands", )
+
+    def __init__(self) -> None:
+        self.commands = {}
+
+    def __getstate__(self) -> dict:
+        return {"commands": self.commands}
+
+    def __setstate__(self, state: dict) -> None:
+        self.commands = state['commands']
+
+    def record(self, command: str, stage: str, seconds: float, error: bool = False) -> None:
+        stages = self.commands.setdefault(command, {})
+        try:
+            histogram = stages[stage]
+        except KeyError:
+            histogram = stages[stage] = LatencyHistogram()
+
+        histogram.record(seconds, error)
+
+    def merge(self, other: "CommandStats") -> None:
+        for command, stages in other.commands.items():
+            own_stages = self.commands.setdefault(command, {})
+
+            for stage, histogram in stages.items():
+                own_stages.setdefault(stage, LatencyHistogram()).merge(histogram)
+
+    @classmethod
+    def merged(cls, all_stats) -> "CommandStats":
+        result = cls()
+        for stats in all_stats:
+            result.merge(stats)
+
+        return result
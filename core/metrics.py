@@ -0,0 +1,37 @@
+"""
+Formatting of metrics in the Prometheus text exposition format.
+"""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric(name: str, metric_type: str, help_text: str, samples: list) -> str:
+    """
+    Formats a metric family. Samples are (labels dict, value) tuples,
+    or (suffix, labels dict, value) tuples for the series like "_count" and "_sum".
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+
+        if labels:
+            fmt = ",".join(f"{key}=\"{_escape(val)}\"" for key, val in labels.items())
+            lines.append(f"{name}{suffix}{{{fmt}}} {float(value)}")
+        else:
+            lines.append(f"{name}{suffix} {float(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def summary_samples(labels: dict, histogram) -> list:
+    """Samples of a summary metric from a LatencyHistogram"""
+    samples = [
+        ("", {**labels, "quantile": quantile / 100}, histogram.percentile(quantile))
+        for quantile in (50, 95, 99)
+    ]
+    samples.append(("_count", labels, histogram.count))
+    samples.append(("_sum", labels, histogram.total))
+    return samples
@@ -0,0 +1,78 @@
+"""
+Versioned schema changes on top of schema.sql.
+The migrations are the numbered .sql files in the migrations directory, the applied
+versions are recorded in the schema_migrations table.
+A file starting with the "-- migrate: no-transaction" line is run statement by statement
+outside of a transaction (needed for CREATE INDEX CONCURRENTLY), others as one transaction.
+"""
+import os
+import re
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations")
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+_FILE_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def list_migrations(directory: str = MIGRATIONS_DIR) -> list:
+    """Sorted list of (version, name, path)"""
+    migrations = []
+    for file_name in os.listdir(directory):
+        match = _FILE_NAME.match(file_name)
+        if match:
+            migrations.append(
+                (int(match.group(1)), match.group(2), os.path.join(directory, file_name))
+            )
+
+    return sorted(migrations)
+
+
+def _split_statements(sql: str) -> list:
+    # Only for the no-transaction files, those must not contain function bodies
+    return [x.strip() for x in re.split(r";\s*$", sql, flags=re.MULTILINE) if x.strip()]
+
+
+async def applied_versions(conn) -> set:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.schema_migrations(
+            version integer NOT NULL,
+            name text NOT NULL,
+            applied_at timestamp NOT NULL DEFAULT now(),
+            CONSTRAINT schema_migrations_pkey PRIMARY KEY (version)
+        );
+        """
+    )
+    rows = await conn.fetch("SELECT version FROM schema_migrations;")
+    return {x['version'] for x in rows}
+
+
+async def migrate(conn, directory: str = MIGRATIONS_DIR, log=print) -> list:
+    """Applies the pending migrations in order, returns the applied versions"""
+    applied = await applied_versions(conn)
+    done = []
+
+    for version, name, path in list_migrations(directory):
+        if version in applied:
+            continue
+
+        with open(path, "r", encoding="utf-8") as file:
+            sql = file.read()
+
+        log(f"Applying migration {version:04d}_{name}")
+        query = "INSERT INTO schema_migrations (version, name) VALUES ($1, $2);"
+
+        if sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+            # The statements are idempotent, so a failed migration can be simply rerun
+            for statement in _split_statements(sql):
+                await conn.execute(statement)
+            await conn.execute(query, version, name)
+        else:
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(query, version, name)
+
+        done.append(version)
+
+    return done
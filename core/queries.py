@@ -0,0 +1,371 @@
+"""
+Registry of the hot queries.
+Every pooled connection prepares them in the pool's init hook, so the first command on a
+fresh connection does not pay for the planning. Connections without the prepared statements
+(the pool itself or the PgBouncer mode) run the same SQL as text.
+"""
+import asyncpg
+import contextlib
+from time import perf_counter
+
+from core.latency_stats import LatencyHistogram
+
+
+# Statement name -> SQL
+STATEMENTS = {}
+# Statement name -> LatencyHistogram of the executions in this process
+statement_stats = {}
+
+
+def statement(name: str, sql: str) -> str:
+    STATEMENTS[name] = sql
+    return name
+
+
+GET_PROFILE = statement(
+    "get_profile",
+    """
+    SELECT
+        user_id, xp, gold, gems, farm_slots, factory_slots, factory_level, store_slots,
+        notifications, registration_date
+    FROM profile
+    WHERE user_id = $1;
+    """
+)
+UPDATE_PROFILE = statement(
+    "update_profile",
+    """
+    UPDATE profile SET
+    xp = $1,
+    gold = $2,
+    gems = $3,
+    farm_slots = $4,
+    factory_slots = $5,
+    factory_level = $6,
+    store_slots = $7,
+    notifications = $8
+    WHERE user_id = $9;
+    """
+)
+# The counters are maintained by triggers, see migrations/0002_profile_counters.sql
+GET_PROFILE_COUNTERS = statement(
+    "get_profile_counters",
+    """
+    SELECT
+        profile_counters.user_id,
+        profile_counters.inventory_size,
+        profile_counters.farm_slots_used,
+        profile_counters.nearest_harvest,
+        profile_counters.factory_queue_size,
+        profile_counters.nearest_factory_production,
+        profile_counters.factory_queue_ends,
+        coalesce(store_counters.trades, 0) AS store_slots_used
+    FROM profile_counters
+    LEFT JOIN store_counters
+    ON store_counters.user_id = profile_counters.user_id AND store_counters.guild_id = $2
+    WHERE profile_counters.user_id = $1;
+    """
+)
+GET_FARM_SLOTS_USED = statement(
+    "get_farm_slots_used", "SELECT farm_slots_used FROM profile_counters WHERE user_id = $1;"
+)
+GET_FACTORY_QUEUE = statement(
+    "get_factory_queue",
+    "SELECT factory_queue_size, factory_queue_ends FROM profile_counters WHERE user_id = $1;"
+)
+GET_STORE_SLOTS_USED = statement(
+    "get_store_slots_used",
+    "SELECT trades FROM store_counters WHERE user_id = $1 AND guild_id = $2;"
+)
+# Keyset pages of the trade listings, see migrations/0005_store_keyset_index.sql.
+# The "before" pages are in the descending order, the callers reverse them.
+TRADE_COLUMNS = "id, guild_id, user_id, username, item_id, amount, price"
+COUNT_TRADES = statement("count_trades", "SELECT count(*) FROM store WHERE guild_id = $1;")
+GET_TRADES_AFTER = statement(
+    "get_trades_after",
+    f"SELECT {TRADE_COLUMNS} FROM store WHERE guild_id = $1 AND id > $2 ORDER BY id LIMIT $3;"
+)
+GET_TRADES_BEFORE = statement(
+    "get_trades_before",
+    f"SELECT {TRADE_COLUMNS} FROM store WHERE guild_id = $1 AND id < $2 ORDER BY id DESC LIMIT $3;"
+)
+GET_OWN_TRADES_AFTER = statement(
+    "get_own_trades_after",
+    f"""
+    SELECT {TRADE_COLUMNS} FROM store
+    WHERE guild_id = $1 AND user_id = $2 AND id > $3
+    ORDER BY id LIMIT $4;
+    """
+)
+GET_OWN_TRADES_BEFORE = statement(
+    "get_own_trades_before",
+    f"""
+    SELECT {TRADE_COLUMNS} FROM store
+    WHERE guild_id = $1 AND user_id = $2 AND id < $3
+    ORDER BY id DESC LIMIT $4;
+    """
+)
+GET_ALL_ITEMS = statement(
+    "get_all_items",
+    "SELECT id, user_id, item_id, amount FROM inventory WHERE user_id = $1 ORDER BY item_id;"
+)
+GET_ITEM = statement(
+    "get_item",
+    "SELECT id, user_id, item_id, amount FROM inventory WHERE user_id = $1 AND item_id = $2;"
+)
+GIVE_ITEM = statement(
+    "give_item",
+    """
+    INSERT INTO inventory(user_id, item_id, amount)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (user_id, item_id)
+    DO UPDATE
+    SET amount = inventory.amount + $3;
+    """
+)
+# Single upsert of many items, the item IDs must be unique
+GIVE_ITEMS = statement(
+    "give_items",
+    """
+    INSERT INTO inventory(user_id, item_id, amount)
+    SELECT $1, item.id, item.amount
+    FROM unnest($2::smallint[], $3::integer[]) AS item(id, amount)
+    ON CONFLICT (user_id, item_id)
+    DO UPDATE
+    SET amount = inventory.amount + excluded.amount;
+    """
+)
+# Removes many items at once, only if the user owns at least the requested amounts.
+# Returns how many of the items were removed, so the caller can roll back on a partial removal.
+REMOVE_OWNED_ITEMS = statement(
+    "remove_owned_items",
+    """
+    WITH requested AS (
+        SELECT * FROM unnest($2::smallint[], $3::integer[]) AS requested(item_id, amount)
+    ), emptied AS (
+        DELETE FROM inventory
+        USING requested
+        WHERE inventory.user_id = $1
+        AND inventory.item_id = requested.item_id
+        AND inventory.amount = requested.amount
+        RETURNING inventory.item_id
+    ), reduced AS (
+        UPDATE inventory SET amount = inventory.amount - requested.amount
+        FROM requested
+        WHERE inventory.user_id = $1
+        AND inventory.item_id = requested.item_id
+        AND inventory.amount > requested.amount
+        RETURNING inventory.item_id
+    )
+    SELECT (SELECT count(*) FROM emptied) + (SELECT count(*) FROM reduced);
+    """
+)
+# See schema.sql for the procedure
+REMOVE_ITEM = statement("remove_item", "CALL remove_item($1, $2, $3);")
+GET_ITEM_MODIFICATION = statement(
+    "get_item_modification",
+    """
+    SELECT id, item_id, user_id, time1, time2, volume
+    FROM modifications
+    WHERE user_id = $1 AND item_id = $2;
+    """
+)
+GET_FARM_FIELD = statement(
+    "get_farm_field",
+    """
+    SELECT
+        id, item_id, user_id, amount, iterations, fields_used, ends, dies,
+        robbed_fields, cat_boost
+    FROM farm
+    WHERE user_id = $1
+    ORDER BY item_id;
+    """
+)
+GET_FACTORY = statement(
+    "get_factory",
+    """
+    SELECT id, user_id, item_id, amount, unit_seconds, starts, ends
+    FROM factory
+    WHERE user_id = $1
+    ORDER BY starts;
+    """
+)
+# Queues a batch after the last batch of the user, or now if the queue is empty or finished
+ENQUEUE_FACTORY_BATCH = statement(
+    "enqueue_factory_batch",
+    """
+    INSERT INTO factory (user_id, item_id, amount, unit_seconds, starts, ends)
+    SELECT
+        $1::bigint,
+        $2::smallint,
+        $3::integer,
+        $4::integer,
+        queue.tail,
+        queue.tail + make_interval(secs => $3 * $4)
+    FROM (
+        SELECT greatest(max(ends), $5::timestamp) AS tail FROM factory WHERE user_id = $1
+    ) queue
+    RETURNING ends;
+    """
+)
+# Removes the finished batches and the finished units of the partially finished batches,
+# returns the collected amounts per item
+COLLECT_FACTORY = statement(
+    "collect_factory",
+    """
+    WITH finished AS (
+        SELECT
+            id,
+            least(amount, floor(extract(epoch FROM $2 - starts) / unit_seconds))::integer AS units
+        FROM factory
+        WHERE user_id = $1 AND starts + make_interval(secs => unit_seconds) <= $2
+        FOR UPDATE
+    ), collected AS (
+        DELETE FROM factory
+        USING finished
+        WHERE factory.id = finished.id AND finished.units = factory.amount
+        RETURNING factory.item_id, factory.amount
+    ), split AS (
+        UPDATE factory SET
+        amount = factory.amount - finished.units,
+        starts = factory.starts + make_interval(secs => finished.units * factory.unit_seconds)
+        FROM finished
+        WHERE factory.id = finished.id AND finished.units < factory.amount
+        RETURNING factory.item_id, finished.units AS amount
+    )
+    SELECT item_id, sum(amount)::integer AS amount
+    FROM (SELECT * FROM collected UNION ALL SELECT * FROM split) AS products
+    GROUP BY item_id;
+    """
+)
+GET_MISSIONS = statement(
+    "get_missions",
+    """
+    SELECT id, name, requests, gold_reward, xp_reward, chest
+    FROM missions
+    WHERE user_id = $1
+    ORDER BY id;
+    """
+)
+# Inserts the whole board at once, from a list of business_mission tuples.
+# The RETURNING order is not guaranteed, so the whole rows are returned for the callers.
+ADD_MISSIONS = statement(
+    "add_missions",
+    """
+    INSERT INTO missions (user_id, name, requests, gold_reward, xp_reward, chest)
+    SELECT $1, mission.name, mission.requests, mission.gold_reward, mission.xp_reward, mission.chest
+    FROM unnest($2::business_mission[]) AS mission
+    RETURNING id, name, requests, gold_reward, xp_reward, chest;
+    """
+)
+# Returns None if the mission was already completed
+DELETE_MISSION = statement(
+    "delete_mission", "DELETE FROM missions WHERE id = $1 AND user_id = $2 RETURNING id;"
+)
+
+# Upgrade type (modifications column) -> statement name
+UPGRADE_MODIFICATION = {
+    column: statement(
+        f"upgrade_{column}",
+        f"""
+        INSERT INTO modifications (user_id, item_id, {column})
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id, item_id)
+        DO UPDATE SET {column} = modifications.{column} + $3;
+        """
+    )
+    for column in ("time1", "time2", "volume")
+}
+
+
+class FarmConnection(asyncpg.Connection):
+    """Connection, that keeps the prepared statements of the registry"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+async def prepare_statements(conn) -> None:
+    """
+    Pool init hook, prepares all of the registered statements.
+    Statements, that can't be prepared yet (the migrations are not applied), are left
+    for the first use, so the connections still open.
+    """
+    for name, sql in STATEMENTS.items():
+        try:
+            conn.prepared[name] = await conn.prepare(sql)
+        except asyncpg.PostgresError:
+            conn.prepared[name] = None
+
+
+async def _run_prepared(prepared, method: str, args: tuple):
+    if method == "execute":
+        return await prepared.fetch(*args)
+    elif method == "executemany":
+        return await prepared.executemany(*args)
+
+    return await getattr(prepared, method)(*args)
+
+
+async def _run_registered(conn, prepared_statements: dict, name: str, method: str, args: tuple):
+    prepared = prepared_statements[name]
+    if prepared is None:
+        prepared = prepared_statements[name] = await conn.prepare(STATEMENTS[name])
+
+    try:
+        return await _run_prepared(prepared, method, args)
+    except (
+        asyncpg.exceptions.InvalidCachedStatementError,
+        asyncpg.exceptions.OutdatedSchemaCacheError
+    ) as e:
+        # A migration has altered the tables or types since the statement was prepared
+        prepared_statements[name] = None
+        if isinstance(e, asyncpg.exceptions.OutdatedSchemaCacheError):
+            await conn.reload_schema_state()
+        if conn.is_in_transaction():
+            raise e  # The transaction is aborted, it is prepared again on the next use
+
+        prepared = prepared_statements[name] = await conn.prepare(STATEMENTS[name])
+        return await _run_prepared(prepared, method, args)
+
+
+async def _run(conn, method: str, name: str, args: tuple):
+    start = perf_counter()
+    try:
+        # Statement name -> prepared statement, None if it has to be prepared again
+        prepared_statements = getattr(conn, "prepared", {})
+        if name not in prepared_statements:
+            return await getattr(conn, method)(STATEMENTS[name], *args)
+
+        # The prepared statements are called around the measuring connection proxy
+        # of the commands, so their time is recorded to the command's stage here
+        with getattr(conn, "measure_stage", contextlib.nullcontext)():
+            return await _run_registered(conn, prepared_statements, name, method, args)
+    finally:
+        try:
+            histogram = statement_stats[name]
+        except KeyError:
+            histogram = statement_stats[name] = LatencyHistogram()
+
+        histogram.record(perf_counter() - start)
+
+
+async def fetch(conn, name: str, *args) -> list:
+    return await _run(conn, "fetch", name, args)
+
+
+async def fetchrow(conn, name: str, *args) -> asyncpg.Record:
+    return await _run(conn, "fetchrow", name, args)
+
+
+async def fetchval(conn, name: str, *args):
+    return await _run(conn, "fetchval", name, args)
+
+
+async def execute(conn, name: str, *args) -> None:
+    await _run(conn, "execute", name, args)
+
+
+async def executemany(conn, name: str, args: list) -> None:
+    await _run(conn, "executemany", name, (args, ))
@@ -0,0 +1,25 @@
+"""
+Revision of the code on disk, so the launcher can check, that the restarted clusters
+are running the deployed code.
+"""
+import os
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_code_revision() -> str:
+    """Git commit of the checkout, None if it is not a git checkout"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    return result.stdout.strip()
@@ -0,0 +1,77 @@
+"""
+Market price table shared by the processes of a host through a memory mapped file.
+The launcher writes it and clusters map it read-only.
+Writes are guarded with a sequence counter: it is odd while a write is in progress,
+readers retry until they see the same even value before and after copying the prices.
+"""
+import os
+import mmap
+import struct
+
+
+HEADER = struct.Struct("<QQI")  # Sequence, price epoch, item count
+ENTRY = struct.Struct("<ii")  # Item ID, price
+MAX_ENTRIES = 4096
+SIZE = HEADER.size + ENTRY.size * MAX_ENTRIES
+READ_ATTEMPTS = 1000
+
+
+class SharedPriceTable:
+
+    __slots__ = ("map", )
+
+    def __init__(self, path: str, writable: bool = False) -> None:
+        if writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            os.ftruncate(fd, SIZE)
+            access = mmap.ACCESS_WRITE
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            access = mmap.ACCESS_READ
+
+        try:
+            self.map = mmap.mmap(fd, SIZE, access=access)
+        finally:
+            os.close(fd)
+
+    @property
+    def sequence(self) -> int:
+        return HEADER.unpack_from(self.map, 0)[0]
+
+    def write(self, epoch: int, prices: list) -> None:
+        """Writes a list of tuples with item IDs and prices as the new price epoch"""
+        if len(prices) > MAX_ENTRIES:
+            raise ValueError(f"Too many prices: {len(prices)}")
+
+        sequence = self.sequence
+        if sequence % 2:
+            sequence += 1  # A previous writer died while writing
+
+        struct.pack_into("<Q", self.map, 0, sequence + 1)
+        for index, (item_id, price) in enumerate(prices):
+            ENTRY.pack_into(self.map, HEADER.size + index * ENTRY.size, item_id, price)
+        HEADER.pack_into(self.map, 0, sequence + 2, epoch, len(prices))
+
+    def read(self) -> tuple:
+        """
+        Returns the sequence, epoch and list of tuples with item IDs and prices.
+        Returns None if nothing has been written yet or the writer is stuck.
+        """
+        for _ in range(READ_ATTEMPTS):
+            sequence, epoch, count = HEADER.unpack_from(self.map, 0)
+            if sequence == 0:
+                return None
+            if sequence % 2:
+                continue
+
+            prices = [
+                ENTRY.unpack_from(self.map, HEADER.size + index * ENTRY.size)
+                for index in range(count)
+            ]
+            if self.sequence == sequence:
+                return sequence, epoch, prices
+
+        return None
+
+    def close(self) -> None:
+        self.map.close()
@@ -4,3 +4,12 @@ DISCORD_COMMUNITY_INVITE = "https://discord.gg/MwpxKjF"
 
 CONFIG_PATH = "config.json"
 GAME_NEWS_PATH = "data/news.txt"
+
+ROLLING_RESTART_STATUS_KEY = "rolling_restart_status"
+MARKET_PRICES_KEY = "market_prices"
+MARKET_PRICES_EPOCH_KEY = "market_prices_epoch"
+COMMAND_TREE_KEY = "application_command_tree"
+# Host name -> number of clusters planned by the host's launcher
+DB_POOL_CLUSTERS_KEY = "db_pool_clusters"
+# Guild ID -> version of the cached trade listings, bumped when the guild's trades change
+TRADES_CACHE_VERSION_KEY = "trades_cache_version"
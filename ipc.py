@@ -7,11 +7,17 @@ import aiohttp
 import asyncpg
 import aioredis
 import jsonpickle
+from aiohttp import web
 from logging.handlers import TimedRotatingFileHandler
 from datetime import datetime, timedelta
 
 from core import ipc_classes
 from core import static
+from core import async_logging
+from core.cluster_registry import ClusterRegistry
+from core.latency_stats import CommandStats
+from core.metrics import format_metric, summary_samples
+from core.ipc_transport import create_transport
 from core.game_items import load_all_items
 
 
@@ -36,12 +42,12 @@ class IPC:
         else:
             log.setLevel(logging.INFO)
 
-        log_formatter = logging.Formatter("[%(asctime)s %(name)s/%(levelname)s] %(message)s")
         file_handler = TimedRotatingFileHandler("./logs/ipc.log", encoding="utf-8", when="W0")
-        file_handler.setFormatter(log_formatter)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(log_formatter)
-        log.handlers = [file_handler, stream_handler]
+        log.handlers = [
+            async_logging.create_queue_handler(
+                [file_handler, logging.StreamHandler()], self.config.get("logging")
+            )
+        ]
         self.log = log
 
         self.is_beta = self.ipc_config['beta']
@@ -51,9 +57,12 @@ class IPC:
         self.cluster_inactive_timeout = self.ipc_config['cluster-inactive-timeout']
         self.cluster_check_delay = self.ipc_config['cluster-check-delay']
 
-        self.active_clusters = []
-        self.total_guild_count = 0
-        self.total_shard_count = 0
+        self.cluster_totals = ipc_classes.ClusterTotals(0, 0, 0)
+        # Cluster name -> last startup report
+        self.startup_reports = {}
+        # Cluster channel -> last metrics, shipped with the pings
+        self.cluster_metrics = {}
+        self.clusters = []
         self.eval_responses = {}
 
         self.ignore_actions = (
@@ -70,10 +79,12 @@ class IPC:
             password=self.config['redis']['password'],
             db=self.config['redis']['db-index']
         )
-        self.redis_pubsub = self.redis.pubsub()
+        self.transport = create_transport(self.redis, self.ipc_name, self.ipc_config)
+        self.cluster_registry = ClusterRegistry(self.redis, self.cluster_inactive_timeout)
 
         log.debug("Loading game items")
         self.item_pool = load_all_items()
+        self.market_prices = ipc_classes.MarketPrices(0, self.item_pool.get_market_prices())
 
         log.debug("Launching tasks and services")
         self.redis_listener = self.loop.create_task(self.redis_event_handler())
@@ -81,6 +92,8 @@ class IPC:
         self.notifications_service = NotificationsService(self)
         self.items_update_service = GameItemsUpdateService(self)
         self.farm_guard_service = FarmGuardService(self)
+        self.metrics_service = MetricsService(self)
+        self.counters_check_service = CountersCheckService(self)
 
         if not self.is_beta:
             self.backup_service = BackupService(self)
@@ -107,33 +120,32 @@ class IPC:
         self.notifications_service.stop()
         self.items_update_service.stop()
         self.farm_guard_service.stop()
+        self.counters_check_service.stop()
+        await self.metrics_service.stop_server()
         # Shutdown non beta services
         if not self.is_beta:
             self.backup_service.stop()
             self.topgg_service.stop()
 
         self.log.info("All tasks should be canceled. Exiting...")
-        await self.redis_pubsub.close()
+        await self.transport.close()
         await self.redis.close()
         self.loop.stop()
 
     async def _register_redis_channels(self) -> None:
-        await self.redis_pubsub.subscribe(self.global_channel)
-        await self.redis_pubsub.psubscribe(self.cluster_channel_prefix + "*")
+        await self.transport.subscribe(
+            [self.global_channel], patterns=[self.cluster_channel_prefix + "*"]
+        )
 
     async def _unregister_redis_channels(self) -> None:
-        await self.redis_pubsub.unsubscribe(self.global_channel)
-        await self.redis_pubsub.punsubscribe(self.cluster_channel_prefix + "*")
+        await self.transport.unsubscribe()
 
     async def redis_event_handler(self) -> None:
         await self._register_redis_channels()
 
-        async for message in self.redis_pubsub.listen():
-            if message['type'] != "message" and message['type'] != "pmessage":
-                continue
-
+        async for data in self.transport.listen():
             try:
-                ipc_message = jsonpickle.decode(message['data'])
+                ipc_message = jsonpickle.decode(data)
             except Exception:
                 continue
 
@@ -141,9 +153,15 @@ class IPC:
                 continue
 
             self.log.info(
-                f"Received message from: {ipc_message.author} "
-                f"Action: {ipc_message.action} "
-                f"Reply global: {ipc_message.reply_global}"
+                "Received message",
+                extra={
+                    "sample": True,
+                    "fields": {
+                        "author": ipc_message.author,
+                        "action": ipc_message.action,
+                        "reply_global": ipc_message.reply_global
+                    }
+                }
             )
 
             if ipc_message.reply_global:
@@ -151,16 +169,21 @@ class IPC:
             else:
                 reply_channel = ipc_message.author
 
+            correlation_id = ipc_message.correlation_id
+
             if ipc_message.action == "ping":
-                await self._handle_update_cluster_status(ipc_message.data, reply_channel)
+                self._handle_ping(ipc_message)
+                await self.send_ping_message(reply_channel, correlation_id)
             elif ipc_message.action == "add_reminder":
                 await self._handle_add_reminder(ipc_message.data)
             elif ipc_message.action == "get_items":
-                await self.send_update_items_message(reply_channel)
+                await self.send_update_items_message(reply_channel, correlation_id)
+            elif ipc_message.action == "get_prices":
+                await self.send_item_prices_message(reply_channel, correlation_id)
             elif ipc_message.action == "get_game_news":
-                await self.send_update_game_news_message(reply_channel)
+                await self.send_update_game_news_message(reply_channel, correlation_id)
             elif ipc_message.action == "set_items":
-                await self._handle_set_items()
+                await self._handle_set_items(correlation_id)
             elif ipc_message.action == "set_game_news":
                 await self._handle_set_news(ipc_message)
             elif ipc_message.action == "stop_reminders":
@@ -169,6 +192,10 @@ class IPC:
                 self._handle_enable_reminders(ipc_message.data)
             elif ipc_message.action == "del_reminders":
                 await self._handle_delete_reminders(ipc_message.data)
+            elif ipc_message.action == "get_command_stats":
+                await self.send_command_stats_message(reply_channel, correlation_id)
+            elif ipc_message.action == "startup_report":
+                self._handle_startup_report(ipc_message.data)
             elif ipc_message.action in self.ignore_actions:
                 continue
             else:
@@ -178,33 +205,19 @@ class IPC:
         while not self.loop.is_closed():
             await asyncio.sleep(self.cluster_check_delay)
 
-            guild_count, shard_count = 0, 0
-            for cluster in self.active_clusters:
-                delta_time = datetime.now() - cluster.last_ping
-
-                if delta_time.total_seconds() >= self.cluster_inactive_timeout:
-                    self.active_clusters.remove(cluster)
-                    continue
-
-                guild_count += cluster.guild_count
-                shard_count += len(cluster.latencies)
-
-            self.total_guild_count = guild_count
-            self.total_shard_count = shard_count
+            try:
+                # This also removes the inactive clusters from the registry
+                clusters = await self.cluster_registry.get_all()
+            except Exception:
+                self.log.exception("Failed to fetch the cluster registry")
+                continue
 
-    async def _handle_update_cluster_status(
-        self,
-        cluster: ipc_classes.Cluster,
-        reply_channel: str
-    ) -> None:
-        try:
-            to_remove = next(x for x in self.active_clusters if x.name == cluster.name)
-            self.active_clusters.remove(to_remove)
-        except StopIteration:
-            pass
+            self.clusters = clusters
+            self.cluster_totals = self.cluster_registry.count_totals(clusters)
 
-        self.active_clusters.append(cluster)
-        await self.send_ping_message(reply_channel)
+            active = {self.cluster_channel_prefix + c.name for c in clusters}
+            for channel in self.cluster_metrics.keys() - active:
+                del self.cluster_metrics[channel]
 
     async def _handle_add_reminder(self, reminder: ipc_classes.Reminder) -> None:
         await self.notifications_service.add_reminder(reminder)
@@ -218,46 +231,90 @@ class IPC:
     async def _handle_delete_reminders(self, user_id: int) -> None:
         await self.notifications_service.delete_reminders(user_id)
 
+    def _handle_ping(self, message: ipc_classes.IPCMessage) -> None:
+        if message.data is not None:
+            self.cluster_metrics[message.author] = message.data
+
+    def _handle_startup_report(self, report: ipc_classes.StartupReport) -> None:
+        self.startup_reports[report.cluster_name] = report
+
+        slowest = sorted(report.phases.items(), key=lambda x: x[1], reverse=True)[:3]
+        slowest = ", ".join(f"{name}: {duration:.2f}s" for name, duration in slowest)
+        self.log.info(
+            f"Cluster {report.cluster_name} started in {report.total:.2f}s "
+            f"Slowest phases: {slowest}"
+        )
+
     async def _handle_set_news(self, message: ipc_classes.IPCMessage) -> None:
         self.game_news = message.data
 
         with open(static.GAME_NEWS_PATH, "w") as file:
             file.write(self.game_news)
 
-        await self.send_update_game_news_message(self.global_channel)
+        await self.send_update_game_news_message(self.global_channel, message.correlation_id)
 
-    async def _handle_set_items(self) -> None:
+    async def _handle_set_items(self, correlation_id: str = None) -> None:
         self.item_pool = load_all_items()
+        await self.update_market_prices()
+        await self.send_update_items_message(self.global_channel, correlation_id)
+        await self.send_item_prices_message(self.global_channel)
+
+    async def update_market_prices(self) -> None:
+        """Generates new market prices as a new epoch and stores them for the launchers"""
         self.item_pool.update_market_prices()
-        await self.send_update_items_message(self.global_channel)
+        epoch = await self.redis.execute_command("INCR", static.MARKET_PRICES_EPOCH_KEY)
+        self.market_prices = ipc_classes.MarketPrices(epoch, self.item_pool.get_market_prices())
+
+        await self.redis.execute_command(
+            "SET", static.MARKET_PRICES_KEY, jsonpickle.encode(self.market_prices)
+        )
 
     async def _send_ipc_message(
         self,
         channel: str,
         action: str,
         reply_global: bool,
-        data
+        data,
+        correlation_id: str = None
     ) -> None:
         message = ipc_classes.IPCMessage(
             author=self.ipc_name,
             action=action,
             reply_global=reply_global,
-            data=data
+            data=data,
+            correlation_id=correlation_id
         )
 
-        await self.redis.publish(channel, jsonpickle.encode(message))
+        await self.transport.publish(
+            channel, jsonpickle.encode(message), durable=action in ipc_classes.DURABLE_ACTIONS
+        )
 
-    async def send_ping_message(self, channel: str) -> None:
-        await self._send_ipc_message(channel, "ping", False, self.active_clusters)
+    async def send_ping_message(self, channel: str, correlation_id: str = None) -> None:
+        await self._send_ipc_message(
+            channel, "ping", False, self.cluster_totals, correlation_id
+        )
 
-    async def send_update_game_news_message(self, channel: str) -> None:
-        await self._send_ipc_message(channel, "get_game_news", False, self.game_news)
+    async def send_update_game_news_message(self, channel: str, correlation_id: str = None) -> None:
+        await self._send_ipc_message(
+            channel, "get_game_news", False, self.game_news, correlation_id
+        )
 
     async def send_set_game_guard_message(self, channel: str, duration: int) -> None:
         await self._send_ipc_message(channel, "enable_guard", False, duration)
 
-    async def send_update_items_message(self, channel: str) -> None:
-        await self._send_ipc_message(channel, "get_items", False, self.item_pool)
+    async def send_update_items_message(self, channel: str, correlation_id: str = None) -> None:
+        await self._send_ipc_message(
+            channel, "get_items", False, self.item_pool, correlation_id
+        )
+
+    async def send_command_stats_message(self, channel: str, correlation_id: str = None) -> None:
+        stats = CommandStats.merged(x.command_stats for x in self.cluster_metrics.values())
+        await self._send_ipc_message(channel, "get_command_stats", False, stats, correlation_id)
+
+    async def send_item_prices_message(self, channel: str, correlation_id: str = None) -> None:
+        await self._send_ipc_message(
+            channel, "get_prices", False, self.market_prices, correlation_id
+        )
 
 
 class IPCService:
@@ -281,6 +338,9 @@ class NotificationsService(IPCService):
         self.next_reminder = None
         self.next_reminder_key = None
         self.reminder_scheduler_sleeping = False
+        self.reminders_posted = 0
+        self.reminders_failed = 0
+        self.reminders_ratelimited = 0
 
         self.log.debug("Fetching reminder data")
         self.loop.run_until_complete(self.fetch_reminder_ignore_ids())
@@ -424,16 +484,20 @@ class NotificationsService(IPCService):
             async with aiohttp.ClientSession() as session:
                 async with session.post(url, headers=headers, json=body) as r:
                     if r.status == 200:
+                        self.reminders_posted += 1
                         self.log.info(
-                            f"Published reminder message to channel: {reminder.channel_id}"
+                            "Published reminder message",
+                            extra={"sample": True, "fields": {"channel": reminder.channel_id}}
                         )
                         return
 
                     try:
                         r.raise_for_status()
                     except aiohttp.ClientResponseError as e:
+                        self.reminders_failed += 1
                         # Don't want to get banned. TODO: Better rate limit handling with bucketting
                         if e.status == 429:
+                            self.reminders_ratelimited += 1
                             retry_after = e.headers.get("X-RateLimit-Reset-After") or 0
                             retry_after = int(float(retry_after)) + 1
 
@@ -446,6 +510,7 @@ class NotificationsService(IPCService):
                         else:
                             self.log.exception(f"Failed to post reminder message: {e.status}")
         except Exception:
+            self.reminders_failed += 1
             self.log.exception("Failed to post reminder message")
 
     async def dispatch_reminders(self) -> None:
@@ -492,12 +557,162 @@ class NotificationsService(IPCService):
                 continue
 
             if self.next_reminder.channel_id not in self.reminder_ignore_ids:
-                self.log.info(f"Reminder {self.next_reminder_key} done, posting...")
+                self.log.info(
+                    "Reminder done, posting",
+                    extra={"sample": True, "fields": {"key": self.next_reminder_key}}
+                )
                 await self._post_reminder_message(self.next_reminder)
 
             self.next_reminder = None
 
 
+class MetricsService(IPCService):
+    """Serves the metrics of IPC and of all clusters in the Prometheus text format"""
+
+    def __init__(self, ipc: IPC) -> None:
+        super().__init__(ipc)
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(
+            self.runner, self.ipc.ipc_config['metrics-host'], self.ipc.ipc_config['metrics-port']
+        )
+        self.loop.run_until_complete(site.start())
+
+    async def stop_server(self) -> None:
+        self.stop()
+        await self.runner.cleanup()
+
+    def _cluster_metrics(self) -> str:
+        clusters = self.ipc.clusters
+        metrics = {
+            x[len(self.ipc.cluster_channel_prefix):]: y
+            for x, y in self.ipc.cluster_metrics.items()
+        }
+
+        fmt = format_metric(
+            "farm_clusters", "gauge", "Active clusters",
+            [({}, len(clusters))]
+        )
+        fmt += format_metric(
+            "farm_cluster_guilds", "gauge", "Guilds per cluster",
+            [({"cluster": c.name}, c.guild_count) for c in clusters]
+        )
+        fmt += format_metric(
+            "farm_shard_latency_seconds", "gauge", "Gateway latency per shard",
+            [({"cluster": c.name, "shard": id}, ping) for c in clusters for id, ping in c.latencies]
+        )
+        fmt += format_metric(
+            "farm_cluster_ipc_latency_seconds", "gauge", "IPC round trip per cluster",
+            [({"cluster": c.name}, c.ipc_latency / 1000) for c in clusters]
+        )
+        fmt += format_metric(
+            "farm_cluster_loop_lag_seconds", "gauge", "Event loop lag per cluster",
+            [({"cluster": x}, y.loop_lag) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_pool_connections", "gauge", "Postgres pool connections per cluster",
+            [({"cluster": x}, y.db_pool_size) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_pool_max_connections", "gauge", "Postgres pool size limit per cluster",
+            [({"cluster": x}, y.db_pool_max_size) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_acquire_wait_seconds", "summary", "Postgres pool acquire waits",
+            [
+                sample for x, y in metrics.items()
+                for sample in summary_samples({"cluster": x}, y.db_acquire_wait)
+            ]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_pool_idle_connections", "gauge", "Idle Postgres pool connections",
+            [({"cluster": x}, y.db_pool_idle) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_leases", "gauge", "Connections held by commands",
+            [({"cluster": x}, y.db_leases) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_db_leases_force_released_total", "counter",
+            "Connections released only at the end of the interaction",
+            [({"cluster": x}, y.db_leases_force_released) for x, y in metrics.items()]
+        )
+        fmt += format_metric(
+            "farm_cluster_redis_latency_seconds", "gauge", "Last Redis write duration per cluster",
+            [({"cluster": x}, y.redis_latency) for x, y in metrics.items()]
+        )
+
+        commands, errors, durations = [], [], []
+        for cluster, cluster_metrics in metrics.items():
+            for command, stages in cluster_metrics.command_stats.commands.items():
+                for stage, histogram in stages.items():
+                    labels = {"cluster": cluster, "command": command, "stage": stage}
+
+                    if stage == "callback":
+                        commands.append((labels, histogram.count))
+                        errors.append((labels, histogram.errors))
+
+                    durations.extend(summary_samples(labels, histogram))
+
+        statements = []
+        for cluster, cluster_metrics in metrics.items():
+            for name, histogram in cluster_metrics.statement_stats.items():
+                labels = {"cluster": cluster, "statement": name}
+                statements.extend(summary_samples(labels, histogram))
+        fmt += format_metric(
+            "farm_db_statement_duration_seconds", "summary", "Registered statement executions",
+            statements
+        )
+
+        fmt += format_metric(
+            "farm_commands_total", "counter", "Command invocations since the cluster start",
+            commands
+        )
+        fmt += format_metric(
+            "farm_command_errors_total", "counter", "Unexpected command errors", errors
+        )
+        fmt += format_metric(
+            "farm_command_duration_seconds", "summary", "Command stage durations", durations
+        )
+        return fmt
+
+    def _ipc_metrics(self) -> str:
+        notifications = self.ipc.notifications_service
+
+        fmt = format_metric(
+            "farm_item_price_epoch", "gauge", "Current market price epoch",
+            [({}, self.ipc.market_prices.epoch)]
+        )
+        fmt += format_metric(
+            "farm_reminder_queue_depth", "gauge", "Reminders waiting to be posted",
+            [({}, notifications.reminder_queue.qsize())]
+        )
+        fmt += format_metric(
+            "farm_reminders_posted_total", "counter", "Posted reminder messages",
+            [({}, notifications.reminders_posted)]
+        )
+        fmt += format_metric(
+            "farm_reminders_failed_total", "counter", "Failed reminder messages",
+            [({}, notifications.reminders_failed)]
+        )
+        fmt += format_metric(
+            "farm_reminders_ratelimited_total", "counter", "Reminder messages rate limited (429)",
+            [({}, notifications.reminders_ratelimited)]
+        )
+        fmt += format_metric(
+            "farm_profile_counters_drifted_total", "counter", "Repaired drifted profile counters",
+            [({}, self.ipc.counters_check_service.drifted_users)]
+        )
+        return fmt
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        body = self._ipc_metrics() + self._cluster_metrics()
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+
 class GameItemsUpdateService(IPCService):
     def __init__(self, ipc: IPC) -> None:
         super().__init__(ipc)
@@ -509,9 +724,9 @@ class GameItemsUpdateService(IPCService):
 
     async def update_game_items(self) -> None:
         while not self.loop.is_closed():
-            self.ipc.item_pool.update_market_prices()
-            self.log.info("Publishing global update items message")
-            await self.ipc.send_update_items_message(self.ipc.global_channel)
+            await self.ipc.update_market_prices()
+            self.log.info(f"Publishing global market prices, epoch {self.ipc.market_prices.epoch}")
+            await self.ipc.send_item_prices_message(self.ipc.global_channel)
 
             # Update every hour, exactly at minute 0
             next_refresh = datetime.now().replace(
@@ -607,6 +822,53 @@ class BackupService(IPCService):
             self.log.info(f"Backup script exited with code: {process.returncode}")
 
 
+class CountersCheckService(IPCService):
+    """Repairs the trigger maintained profile counters, that drifted from the game tables"""
+
+    def __init__(self, ipc: IPC) -> None:
+        super().__init__(ipc)
+        self.check_delay = ipc.ipc_config['counters-check-delay']
+        self.drifted_users = 0
+
+        self.task = self.loop.create_task(self.check_counters())
+
+    def stop(self) -> None:
+        super().stop()
+        self.task.cancel()
+
+    async def check_counters(self) -> None:
+        connect_args = {
+            "user": self.ipc.config['postgres']['user'],
+            "password": self.ipc.config['postgres']['password'],
+            "database": self.ipc.config['postgres']['database'],
+            "host": self.ipc.config['postgres']['host']
+        }
+
+        while not self.loop.is_closed():
+            await asyncio.sleep(self.check_delay)
+
+            try:
+                conn = await asyncpg.connect(**connect_args)
+                try:
+                    # See migrations/0002_profile_counters.sql
+                    drifted = await conn.fetch("SELECT check_profile_counters(true);")
+                finally:
+                    await conn.close()
+            except (OSError, asyncpg.PostgresError):
+                self.log.exception("Profile counters check failed")
+                continue
+
+            self.drifted_users += len(drifted)
+            if drifted:
+                self.log.warning(
+                    "Repaired drifted profile counters",
+                    extra={"fields": {"users": len(drifted)}}
+                )
+                self.log.debug(f"Drifted users: {[x[0] for x in drifted]}")
+            else:
+                self.log.info("Profile counters are consistent")
+
+
 class TopGGService(IPCService):
     def __init__(self, ipc: IPC) -> None:
         super().__init__(ipc)
@@ -623,7 +885,8 @@ class TopGGService(IPCService):
         while not self.loop.is_closed():
             await asyncio.sleep(self.post_stats_delay)
 
-            if not self.ipc.total_shard_count or not self.ipc.total_guild_count:
+            totals = self.ipc.cluster_totals
+            if not totals.shard_count or not totals.guild_count:
                 # Avoid posting when data is not gathered yet
                 continue
 
@@ -632,8 +895,8 @@ class TopGGService(IPCService):
                 "Authorization": self.ipc.config['topgg']['auth_token']
             }
             body = {
-                "server_count": self.ipc.total_guild_count,
-                "shard_count": self.ipc.total_shard_count
+                "server_count": totals.guild_count,
+                "shard_count": totals.shard_count
             }
 
             try:
@@ -642,8 +905,8 @@ class TopGGService(IPCService):
                         if resp.status == 200:
                             self.log.info(
                                 "Published stats to top.gg: "
-                                f"Guild count: {self.ipc.total_guild_count} "
-                                f"Shard count: {self.ipc.total_shard_count}"
+                                f"Guild count: {totals.guild_count} "
+                                f"Shard count: {totals.shard_count}"
                             )
                             continue
 
@@ -0,0 +1,36 @@
+-- migrate: no-transaction
+-- Secondary indexes for the per user and per guild lookups of the hot tables.
+-- Built concurrently, so the bot can keep running while these are created.
+
+-- get_farm_field, the fields sum of the planting, harvest and the profile's nearest harvest
+CREATE INDEX CONCURRENTLY IF NOT EXISTS farm_user_id_ends_idx
+ON public.farm (user_id, ends);
+
+-- Steal: grown fields, that still have something left to steal
+CREATE INDEX CONCURRENTLY IF NOT EXISTS farm_stealable_ends_idx
+ON public.farm (user_id, ends, dies)
+WHERE robbed_fields < fields_used;
+
+-- Steal: rotten fields, that the cat still guards
+CREATE INDEX CONCURRENTLY IF NOT EXISTS farm_stealable_cat_boost_idx
+ON public.farm (user_id, dies)
+WHERE cat_boost AND robbed_fields < fields_used;
+
+-- get_factory and the used factory slots
+CREATE INDEX CONCURRENTLY IF NOT EXISTS factory_user_id_starts_idx
+ON public.factory (user_id, starts);
+
+-- The last queued product and the nearest produced product
+CREATE INDEX CONCURRENTLY IF NOT EXISTS factory_user_id_ends_idx
+ON public.factory (user_id, ends);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS missions_user_id_idx
+ON public.missions (user_id);
+
+-- Trades list, the used trade slots and on_guild_remove
+CREATE INDEX CONCURRENTLY IF NOT EXISTS store_guild_id_user_id_idx
+ON public.store (guild_id, user_id);
+
+-- The profile deletion cascade
+CREATE INDEX CONCURRENTLY IF NOT EXISTS store_user_id_idx
+ON public.store (user_id);
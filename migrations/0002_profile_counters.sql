@@ -0,0 +1,294 @@
+-- Per user counters, maintained by triggers, so the profile and the slot checks
+-- are primary key lookups instead of aggregates over the hot tables.
+
+-- Blocks the writes until the triggers are in place and the counters are filled
+LOCK TABLE public.profile, public.inventory, public.farm, public.factory, public.store
+IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TABLE IF NOT EXISTS public.profile_counters(
+    user_id bigint PRIMARY KEY,
+    inventory_size bigint NOT NULL DEFAULT 0, -- excludes chests (id >= 1000)
+    farm_slots_used integer NOT NULL DEFAULT 0,
+    nearest_harvest timestamp,
+    factory_queue_size integer NOT NULL DEFAULT 0,
+    nearest_factory_production timestamp,
+    factory_queue_ends timestamp
+);
+
+ALTER TABLE ONLY public.profile_counters
+    ADD CONSTRAINT profile_counters_user_fkey FOREIGN KEY (user_id) REFERENCES public.profile(user_id) ON DELETE CASCADE;
+
+-- Active trades per user per guild
+CREATE TABLE IF NOT EXISTS public.store_counters(
+    user_id bigint NOT NULL,
+    guild_id bigint NOT NULL,
+    trades integer NOT NULL DEFAULT 0,
+    CONSTRAINT PK_store_counters PRIMARY KEY (user_id, guild_id)
+);
+
+ALTER TABLE ONLY public.store_counters
+    ADD CONSTRAINT store_counters_user_fkey FOREIGN KEY (user_id) REFERENCES public.profile(user_id) ON DELETE CASCADE;
+
+-- The counters computed from the hot tables, for the filling and the consistency check
+CREATE OR REPLACE VIEW expected_profile_counters AS
+SELECT
+    profile.user_id,
+    coalesce(inv.inventory_size, 0)::bigint AS inventory_size,
+    coalesce(farm.farm_slots_used, 0)::integer AS farm_slots_used,
+    farm.nearest_harvest,
+    coalesce(factory.factory_queue_size, 0)::integer AS factory_queue_size,
+    factory.nearest_factory_production,
+    factory.factory_queue_ends
+FROM profile
+LEFT JOIN (
+    SELECT user_id, sum(amount) AS inventory_size
+    FROM inventory
+    WHERE item_id < 1000
+    GROUP BY user_id
+) inv USING (user_id)
+LEFT JOIN (
+    SELECT user_id, sum(fields_used) AS farm_slots_used, min(ends) AS nearest_harvest
+    FROM farm
+    GROUP BY user_id
+) farm USING (user_id)
+LEFT JOIN (
+    SELECT
+        user_id,
+        count(id) AS factory_queue_size,
+        min(ends) AS nearest_factory_production,
+        max(ends) AS factory_queue_ends
+    FROM factory
+    GROUP BY user_id
+) factory USING (user_id);
+
+CREATE OR REPLACE VIEW expected_store_counters AS
+SELECT user_id, guild_id, count(id)::integer AS trades
+FROM store
+GROUP BY user_id, guild_id;
+
+-- TRIGGERS
+
+CREATE OR REPLACE FUNCTION profile_counters_trigger() RETURNS trigger
+AS
+$$
+BEGIN
+    INSERT INTO profile_counters (user_id) VALUES (NEW.user_id) ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_counters_trigger() RETURNS trigger
+AS
+$$
+DECLARE
+    old_size integer := 0;
+    new_size integer := 0;
+
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.item_id < 1000 THEN
+        old_size := OLD.amount;
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.item_id < 1000 THEN
+        new_size := NEW.amount;
+    END IF;
+
+    IF TG_OP = 'UPDATE' AND OLD.user_id = NEW.user_id THEN
+        IF new_size <> old_size THEN
+            UPDATE profile_counters SET inventory_size = inventory_size - old_size + new_size
+            WHERE profile_counters.user_id = NEW.user_id;
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF old_size <> 0 THEN
+        UPDATE profile_counters SET inventory_size = inventory_size - old_size
+        WHERE profile_counters.user_id = OLD.user_id;
+    END IF;
+    IF new_size <> 0 THEN
+        UPDATE profile_counters SET inventory_size = inventory_size + new_size
+        WHERE profile_counters.user_id = NEW.user_id;
+    END IF;
+    RETURN NULL;
+
+END;
+$$ LANGUAGE plpgsql;
+
+-- The nearest harvest is looked up again with the (user_id, ends) index, as a minimum
+-- can't be maintained incrementally on deletion
+CREATE OR REPLACE FUNCTION farm_counters_trigger() RETURNS trigger
+AS
+$$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE profile_counters SET
+        farm_slots_used = farm_slots_used - coalesce(OLD.fields_used, 0)
+            + CASE WHEN TG_OP = 'UPDATE' AND NEW.user_id = OLD.user_id
+            THEN coalesce(NEW.fields_used, 0) ELSE 0 END,
+        nearest_harvest = (SELECT min(ends) FROM farm WHERE farm.user_id = OLD.user_id)
+        WHERE profile_counters.user_id = OLD.user_id;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR NEW.user_id <> OLD.user_id THEN
+        UPDATE profile_counters SET
+        farm_slots_used = farm_slots_used + coalesce(NEW.fields_used, 0),
+        nearest_harvest = (SELECT min(ends) FROM farm WHERE farm.user_id = NEW.user_id)
+        WHERE profile_counters.user_id = NEW.user_id;
+    END IF;
+    RETURN NULL;
+
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION factory_counters_trigger() RETURNS trigger
+AS
+$$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE profile_counters SET
+        factory_queue_size = factory_queue_size
+            - CASE WHEN TG_OP = 'DELETE' OR NEW.user_id <> OLD.user_id THEN 1 ELSE 0 END,
+        (nearest_factory_production, factory_queue_ends) = (
+            SELECT min(ends), max(ends) FROM factory WHERE factory.user_id = OLD.user_id
+        )
+        WHERE profile_counters.user_id = OLD.user_id;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR NEW.user_id <> OLD.user_id THEN
+        UPDATE profile_counters SET
+        factory_queue_size = factory_queue_size + 1,
+        (nearest_factory_production, factory_queue_ends) = (
+            SELECT min(ends), max(ends) FROM factory WHERE factory.user_id = NEW.user_id
+        )
+        WHERE profile_counters.user_id = NEW.user_id;
+    END IF;
+    RETURN NULL;
+
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION store_counters_trigger() RETURNS trigger
+AS
+$$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE store_counters SET trades = trades - 1
+        WHERE store_counters.user_id = OLD.user_id AND store_counters.guild_id = OLD.guild_id;
+    ELSE
+        INSERT INTO store_counters (user_id, guild_id, trades)
+        VALUES (NEW.user_id, NEW.guild_id, 1)
+        ON CONFLICT (user_id, guild_id)
+        DO UPDATE SET trades = store_counters.trades + 1;
+    END IF;
+    RETURN NULL;
+
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER profile_counters_insert
+AFTER INSERT ON public.profile
+FOR EACH ROW EXECUTE PROCEDURE profile_counters_trigger();
+
+CREATE TRIGGER inventory_counters_change
+AFTER INSERT OR DELETE OR UPDATE OF user_id, item_id, amount ON public.inventory
+FOR EACH ROW EXECUTE PROCEDURE inventory_counters_trigger();
+
+CREATE TRIGGER farm_counters_change
+AFTER INSERT OR DELETE OR UPDATE OF user_id, fields_used, ends ON public.farm
+FOR EACH ROW EXECUTE PROCEDURE farm_counters_trigger();
+
+CREATE TRIGGER factory_counters_change
+AFTER INSERT OR DELETE OR UPDATE OF user_id, ends ON public.factory
+FOR EACH ROW EXECUTE PROCEDURE factory_counters_trigger();
+
+-- Trades are never moved between users or guilds, so the updates are left out
+CREATE TRIGGER store_counters_change
+AFTER INSERT OR DELETE ON public.store
+FOR EACH ROW EXECUTE PROCEDURE store_counters_trigger();
+
+-- CONSISTENCY CHECK
+
+-- Recomputes the counters of one user. The counters row is locked first, so the concurrent
+-- changes of the user either are already committed or apply their deltas afterwards.
+CREATE OR REPLACE PROCEDURE repair_profile_counters(user_id bigint)
+AS
+$$
+BEGIN
+    INSERT INTO profile_counters (user_id) VALUES ($1) ON CONFLICT DO NOTHING;
+    PERFORM 1 FROM profile_counters WHERE profile_counters.user_id = $1 FOR UPDATE;
+
+    UPDATE profile_counters SET
+    inventory_size = expected.inventory_size,
+    farm_slots_used = expected.farm_slots_used,
+    nearest_harvest = expected.nearest_harvest,
+    factory_queue_size = expected.factory_queue_size,
+    nearest_factory_production = expected.nearest_factory_production,
+    factory_queue_ends = expected.factory_queue_ends
+    FROM expected_profile_counters expected
+    WHERE profile_counters.user_id = $1 AND expected.user_id = $1;
+
+    PERFORM 1 FROM store_counters WHERE store_counters.user_id = $1 FOR UPDATE;
+    DELETE FROM store_counters WHERE store_counters.user_id = $1;
+    INSERT INTO store_counters (user_id, guild_id, trades)
+    SELECT expected.user_id, expected.guild_id, expected.trades
+    FROM expected_store_counters expected
+    WHERE expected.user_id = $1;
+
+END;
+$$ LANGUAGE plpgsql;
+
+-- Returns the IDs of the users with drifted counters, repairing those if requested
+CREATE OR REPLACE FUNCTION check_profile_counters(repair boolean)
+RETURNS SETOF bigint
+AS
+$$
+DECLARE
+    drifted bigint;
+
+BEGIN
+    FOR drifted IN
+        SELECT expected.user_id
+        FROM expected_profile_counters expected
+        LEFT JOIN profile_counters counters USING (user_id)
+        WHERE counters.user_id IS NULL
+        OR (
+            expected.inventory_size,
+            expected.farm_slots_used,
+            expected.nearest_harvest,
+            expected.factory_queue_size,
+            expected.nearest_factory_production,
+            expected.factory_queue_ends
+        ) IS DISTINCT FROM (
+            counters.inventory_size,
+            counters.farm_slots_used,
+            counters.nearest_harvest,
+            counters.factory_queue_size,
+            counters.nearest_factory_production,
+            counters.factory_queue_ends
+        )
+        UNION
+        SELECT coalesce(expected.user_id, counters.user_id)
+        FROM expected_store_counters expected
+        FULL JOIN store_counters counters USING (user_id, guild_id)
+        WHERE coalesce(expected.trades, 0) <> coalesce(counters.trades, 0)
+    LOOP
+        IF repair THEN
+            CALL repair_profile_counters(drifted);
+        END IF;
+        RETURN NEXT drifted;
+    END LOOP;
+
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fill the counters of the existing users
+INSERT INTO profile_counters
+SELECT * FROM expected_profile_counters
+ON CONFLICT DO NOTHING;
+
+INSERT INTO store_counters
+SELECT * FROM expected_store_counters
+ON CONFLICT DO NOTHING;
+
+-- Replaced by the counters
+DROP FUNCTION IF EXISTS get_profile_stats(bigint, bigint);
+DROP TYPE IF EXISTS profile_stats;
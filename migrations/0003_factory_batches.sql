@@ -0,0 +1,95 @@
+-- Factory queue stored as batches: "amount" units of the item, each taking "unit_seconds",
+-- the first one starting at "starts". "ends" is the end of the whole batch.
+-- The finished units of a batch are computed from the time, collecting them moves "starts".
+
+LOCK TABLE public.factory IN SHARE ROW EXCLUSIVE MODE;
+
+ALTER TABLE public.factory
+    ADD COLUMN amount integer NOT NULL DEFAULT 1,
+    ADD COLUMN unit_seconds integer;
+
+-- The existing rows are batches of a single unit
+UPDATE public.factory SET unit_seconds = greatest(extract(epoch FROM ends - starts)::integer, 1);
+
+ALTER TABLE public.factory
+    ALTER COLUMN unit_seconds SET NOT NULL,
+    ADD CONSTRAINT factory_amount_check CHECK (amount > 0),
+    ADD CONSTRAINT factory_unit_seconds_check CHECK (unit_seconds > 0);
+
+-- The queue size is now the units in the batches and the nearest production is
+-- the end of the first unit of the first batch
+CREATE OR REPLACE VIEW expected_profile_counters AS
+SELECT
+    profile.user_id,
+    coalesce(inv.inventory_size, 0)::bigint AS inventory_size,
+    coalesce(farm.farm_slots_used, 0)::integer AS farm_slots_used,
+    farm.nearest_harvest,
+    coalesce(factory.factory_queue_size, 0)::integer AS factory_queue_size,
+    factory.nearest_factory_production,
+    factory.factory_queue_ends
+FROM profile
+LEFT JOIN (
+    SELECT user_id, sum(amount) AS inventory_size
+    FROM inventory
+    WHERE item_id < 1000
+    GROUP BY user_id
+) inv USING (user_id)
+LEFT JOIN (
+    SELECT user_id, sum(fields_used) AS farm_slots_used, min(ends) AS nearest_harvest
+    FROM farm
+    GROUP BY user_id
+) farm USING (user_id)
+LEFT JOIN (
+    SELECT
+        user_id,
+        sum(amount) AS factory_queue_size,
+        min(starts + make_interval(secs => unit_seconds)) AS nearest_factory_production,
+        max(ends) AS factory_queue_ends
+    FROM factory
+    GROUP BY user_id
+) factory USING (user_id);
+
+CREATE OR REPLACE FUNCTION factory_counters_trigger() RETURNS trigger
+AS
+$$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE profile_counters SET
+        factory_queue_size = factory_queue_size - OLD.amount
+            + CASE WHEN TG_OP = 'UPDATE' AND NEW.user_id = OLD.user_id THEN NEW.amount ELSE 0 END,
+        (nearest_factory_production, factory_queue_ends) = (
+            SELECT min(starts + make_interval(secs => unit_seconds)), max(ends)
+            FROM factory
+            WHERE factory.user_id = OLD.user_id
+        )
+        WHERE profile_counters.user_id = OLD.user_id;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR NEW.user_id <> OLD.user_id THEN
+        UPDATE profile_counters SET
+        factory_queue_size = factory_queue_size + NEW.amount,
+        (nearest_factory_production, factory_queue_ends) = (
+            SELECT min(starts + make_interval(secs => unit_seconds)), max(ends)
+            FROM factory
+            WHERE factory.user_id = NEW.user_id
+        )
+        WHERE profile_counters.user_id = NEW.user_id;
+    END IF;
+    RETURN NULL;
+
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER factory_counters_change ON public.factory;
+CREATE TRIGGER factory_counters_change
+AFTER INSERT OR DELETE OR UPDATE OF user_id, amount, starts, unit_seconds, ends ON public.factory
+FOR EACH ROW EXECUTE PROCEDURE factory_counters_trigger();
+
+-- Recomputed, as the unit durations of the existing rows were rounded to whole seconds
+UPDATE profile_counters SET
+factory_queue_size = expected.factory_queue_size,
+nearest_factory_production = expected.nearest_factory_production,
+factory_queue_ends = expected.factory_queue_ends
+FROM expected_profile_counters expected
+WHERE profile_counters.user_id = expected.user_id
+AND profile_counters.user_id IN (SELECT user_id FROM factory);
@@ -0,0 +1,49 @@
+-- Business missions stored in typed columns instead of the jsonpickle payload
+
+LOCK TABLE public.missions IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TYPE mission_request AS (
+    item_id smallint,
+    amount integer
+);
+
+-- A mission, as passed by the bot for the board generation
+CREATE TYPE business_mission AS (
+    name text,
+    requests mission_request[],
+    gold_reward integer,
+    xp_reward integer,
+    chest smallint -- 0 for no chest
+);
+
+ALTER TABLE public.missions
+    ADD COLUMN name text,
+    ADD COLUMN requests mission_request[],
+    ADD COLUMN gold_reward integer,
+    ADD COLUMN xp_reward integer,
+    ADD COLUMN chest smallint NOT NULL DEFAULT 0;
+
+-- Tuples in the payload are encoded as {"py/tuple": [item_id, amount]}
+UPDATE public.missions SET
+name = payload::jsonb ->> 'name',
+requests = ARRAY(
+    SELECT ROW(
+        (coalesce(request -> 'py/tuple', request) ->> 0)::smallint,
+        (coalesce(request -> 'py/tuple', request) ->> 1)::integer
+    )::mission_request
+    FROM jsonb_array_elements(payload::jsonb -> 'requests') request
+),
+gold_reward = (payload::jsonb ->> 'gold_reward')::integer,
+xp_reward = (payload::jsonb ->> 'xp_reward')::integer,
+chest = coalesce((payload::jsonb ->> 'chest')::smallint, 0);
+
+-- Missions are regenerated on the next board view, so the unreadable ones can go
+DELETE FROM public.missions
+WHERE name IS NULL OR gold_reward IS NULL OR xp_reward IS NULL OR cardinality(requests) = 0;
+
+ALTER TABLE public.missions
+    DROP COLUMN payload,
+    ALTER COLUMN name SET NOT NULL,
+    ALTER COLUMN requests SET NOT NULL,
+    ALTER COLUMN gold_reward SET NOT NULL,
+    ALTER COLUMN xp_reward SET NOT NULL;
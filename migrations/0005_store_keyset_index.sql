@@ -0,0 +1,13 @@
+-- migrate: no-transaction
+-- Keyset pagination of the trade listings: the pages are read in the ID order
+-- after or before the last seen ID, instead of fetching all of the guild's trades.
+
+-- Server trades list and on_guild_remove
+CREATE INDEX CONCURRENTLY IF NOT EXISTS store_guild_id_id_idx
+ON public.store (guild_id, id);
+
+-- Owned trades list, replaces the (guild_id, user_id) index
+CREATE INDEX CONCURRENTLY IF NOT EXISTS store_guild_id_user_id_id_idx
+ON public.store (guild_id, user_id, id);
+
+DROP INDEX CONCURRENTLY IF EXISTS store_guild_id_user_id_idx;
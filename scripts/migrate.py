@@ -0,0 +1,36 @@
+"""
+Applies the pending schema migrations to the database from config.json.
+Run from the repository root: python scripts/migrate.py
+"""
+import os
+import sys
+import json
+import asyncio
+
+import asyncpg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import migrations, static  # noqa: E402
+
+
+async def main() -> None:
+    with open(static.CONFIG_PATH, "r") as file:
+        postgres = json.load(file)['postgres']
+
+    conn = await asyncpg.connect(
+        user=postgres['user'],
+        password=postgres['password'],
+        database=postgres['database'],
+        host=postgres['host']
+    )
+    try:
+        applied = await migrations.migrate(conn)
+    finally:
+        await conn.close()
+
+    print(f"Applied {len(applied)} migrations" if applied else "The schema is up to date")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())